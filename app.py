@@ -1,28 +1,63 @@
 # -*- coding: utf-8 -*-
-import os, json, logging, secrets, base64
+import os, re, json, logging, secrets, base64, sqlite3
+import atexit, queue, tempfile, threading, time
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from datetime import datetime, timedelta, date
-from typing import Any, Dict, List, Optional
+from collections import namedtuple
+from functools import lru_cache
+from itertools import islice
+from datetime import datetime, timedelta, date, timezone
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
-from flask import Flask, render_template, redirect, request, flash, session, jsonify, abort, current_app
+from flask import Flask, render_template, redirect, request, flash, session, jsonify, abort, current_app, g, has_request_context
 import subprocess, shlex, traceback
 import shutil
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
 from dotenv import load_dotenv
 from markupsafe import Markup, escape
-from sqlalchemy import func, or_, UniqueConstraint   # <- مهم
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload, lazyload, load_only
+from sqlalchemy import event, insert, func, or_, and_, case, update, select, union_all, literal, literal_column, UniqueConstraint   # <- مهم
 
 try:
     from openai import OpenAI
 except Exception:
     OpenAI = None
 
+try:
+    from pydantic import BaseModel, Field
+except Exception:
+    BaseModel = None
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import fastjsonschema
+except Exception:
+    fastjsonschema = None
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
 from extensions import db
 from utils.backup_utils import ensure_dirs, autosave_record
 from blueprints.backup import backup_bp
 from autobackup import init_autobackup, register_autobackup_for
 from models.backup_models import Setting, BackupLog, UserSettings
 from utils.num_words_fa import amount_to_toman_words
+from utils.cash_post_utils import (
+    CASH_METHODS as _CASH_METHODS,
+    clean_cheque_number,
+    form_str as _form_str,
+    normalize_method,
+    to_float as _to_float,
+)
 from utils.date_utils import (
     to_jdate_str,
     now_info as date_now_info,
@@ -44,63 +79,66 @@ class LedgerEntry(db.Model):
     object_id = db.Column(db.String(64), nullable=True)
     action = db.Column(db.String(64), nullable=False)
     payload = db.Column(db.Text, nullable=True)
+    # payload فشرده با zstd (وقتی zstandard نصب است)؛ در این حالت ستون payload خالی می‌ماند
+    payload_z = db.Column(db.LargeBinary, nullable=True)
     prev_hash = db.Column(db.String(128), nullable=True)
     hash = db.Column(db.String(128), nullable=False, unique=True, index=True)
 
+    @property
+    def payload_text(self) -> Optional[str]:
+        """The JSON payload the hash was computed over."""
+        if self.payload_z is None:
+            return self.payload
+        if zstandard is None:
+            # بدون zstandard متن فشرده خواندنی نیست؛ None وانمود می‌کرد payload خالی است و hash را نامعتبر نشان می‌داد
+            raise RuntimeError("ledger payload is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(self.payload_z).decode("utf-8")
+
+
+# تاریخچهٔ یک سند در دفتر و فیلتر بر اساس نوع عملیات/بازهٔ زمانی
+db.Index("ix_ledger_obj", LedgerEntry.object_type, LedgerEntry.object_id)
+db.Index("ix_ledger_action_ts", LedgerEntry.action, LedgerEntry.created_at)
+
 
 def _compute_entry_hash(prev_hash: Optional[str], payload_text: str, ts_iso: str) -> str:
-    m = hashlib.sha256()
-    prev = (prev_hash or "")
-    m.update(prev.encode("utf-8"))
-    m.update(ts_iso.encode("utf-8"))
-    m.update((payload_text or "").encode("utf-8"))
-    return m.hexdigest()
+    # یک‌بار encode و یک فراخوانی sha256 (هم‌ارز سه update پشت‌سرهم)؛ الگوریتم عوض نمی‌شود تا زنجیرهٔ موجود معتبر بماند
+    return hashlib.sha256(f"{prev_hash or ''}{ts_iso}{payload_text or ''}".encode("utf-8")).hexdigest()
 
 
-def record_ledger(object_type: str, object_id: Optional[str], action: str, payload: Dict[str, Any]) -> LedgerEntry:
-    """Create a new ledger entry (append-only)."""
-    try:
-        # get last hash
-        last = db.session.query(LedgerEntry).order_by(LedgerEntry.id.desc()).first()
-        prev = last.hash if last else None
-        ts = datetime.utcnow().isoformat()
-        payload_text = json.dumps(payload, ensure_ascii=False, sort_keys=True)
-        h = _compute_entry_hash(prev, payload_text, ts)
-        entry = LedgerEntry(object_type=object_type, object_id=str(object_id) if object_id is not None else None, action=action, payload=payload_text, prev_hash=prev, hash=h)
-        db.session.add(entry)
-        db.session.commit()
+def record_ledger(
+    object_type: str, object_id: Optional[str], action: str, payload: Dict[str, Any], sync: bool = False
+) -> Optional[LedgerEntry]:
+    """Append a ledger entry.
 
-        # record ledger entry for invoice created via UI
-        try:
-            ledger_lines = []
-            for r in rows:
-                try:
-                    ledger_lines.append({"item_id": int(r['item'].id), "qty": float(r['qty']), "unit_price": float(r['unit_price'])})
-                except Exception:
-                    continue
-            ledger_payload = {
-                "invoice_id": inv.id,
-                "number": inv.number,
-                "kind": inv.kind,
-                "total": float(inv.total or 0.0),
-                "person_id": person.id if person else None,
-                "lines": ledger_lines,
-            }
-            try:
-                record_ledger("invoice", inv.id, "create", ledger_payload)
-            except Exception:
-                app.logger.exception("failed to write invoice ledger entry (ui)")
-        except Exception:
-            app.logger.exception("failed to prepare invoice ledger payload (ui)")
+    By default the entry is queued for the background batch writer, which
+    chains the hashes in queue order, and ``None`` is returned. ``sync=True``
+    writes it now and returns the stored ``LedgerEntry``.
+    """
+    try:
+        # sort_keys برای ترتیب قطعی (کلیدها را فراخوان‌ها می‌سازند)؛ جداکننده‌های فشرده متن ورودی hash را کوتاه‌تر می‌کنند
+        payload_text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        item = (
+            object_type,
+            str(object_id) if object_id is not None else None,
+            action,
+            payload_text,
+            datetime.utcnow(),
+        )
+        entry = None
+        if sync:
+            entry_hash = _insert_ledger_entries([item])[0]
+            entry = db.session.query(LedgerEntry).filter_by(hash=entry_hash).one()
+        else:
+            _enqueue_ledger_entry(item)
         return entry
     except Exception:
-        db.session.rollback()
         app.logger.exception('ledger record failed')
         raise
 
 # ----------------- Config -----------------
 load_dotenv()
 PROJECT_ROOT = Path(__file__).resolve().parent
+_PROJECT_ROOT_RESOLVED = PROJECT_ROOT.resolve()
 PORT = int(os.environ.get("PORT", "8000"))
 SECRET_KEY = os.environ.get("SECRET_KEY", "change-me-please")
 URL_PREFIX = os.environ.get("URL_PREFIX", "") or ""   # مثلا: /hesabpak
@@ -151,6 +189,16 @@ ASSISTANT_MODEL_CHOICES = [
     ("o4-mini", "o4 mini (چندحالته)"),
 ]
 
+# کلیدهای معتبر هر انتخاب؛ ثابت‌اند و یک‌بار ساخته می‌شوند
+_THEME_VALID = frozenset(k for k, _ in THEME_CHOICES)
+_SORT_VALID = frozenset(k for k, _ in SEARCH_SORT_CHOICES)
+_PRICE_VALID = frozenset(k for k, _ in PRICE_DISPLAY_MODES)
+_MODEL_VALID = frozenset(k for k, _ in ASSISTANT_MODEL_CHOICES)
+_DASH_VALID = tuple(k for k, _ in DASHBOARD_WIDGET_CHOICES)
+
+ASSISTANT_MODEL_LABELS = dict(ASSISTANT_MODEL_CHOICES)
+POS_DEVICE_LABELS = dict(POS_DEVICE_CHOICES)
+
 CASH_METHOD_LABELS = {
     "cash": "نقدی",
     "pos": "دستگاه پوز",
@@ -192,24 +240,26 @@ USER_ROLE_LABELS = {
 
 ASSIGNABLE_PERMISSIONS = [p for p in DEFAULT_PERMISSIONS]
 
+# نسخه‌های frozenset برای بررسی عضویت؛ فهرست‌های بالا ترتیب نمایش در قالب‌ها را نگه می‌دارند
+ADMIN_PERMISSION_SET = frozenset(ADMIN_PERMISSIONS)
+_ASSIGNABLE_PERMISSION_SET = frozenset(ASSIGNABLE_PERMISSIONS) & frozenset(PERMISSION_LABELS)
+
+
+@lru_cache(maxsize=256)
+def _permissions_for_role_cached(role: str, requested: tuple) -> tuple:
+    if role == "admin":
+        return tuple(ADMIN_PERMISSIONS)
+    allowed = sorted({p for p in requested if p in _ASSIGNABLE_PERMISSION_SET})
+    if role == "staff" and not allowed:
+        allowed = list(ASSIGNABLE_PERMISSIONS)
+    if "dashboard" not in allowed:
+        allowed.insert(0, "dashboard")
+    return tuple(allowed)
+
 
 def _permissions_for_role(role: str, requested) -> list:
     role = (role or "staff").strip().lower()
-    if role == "admin":
-        return ADMIN_PERMISSIONS
-    allowed = []
-    seen = set()
-    for p in requested or []:
-        if p in PERMISSION_LABELS and p in ASSIGNABLE_PERMISSIONS and p not in seen:
-            allowed.append(p)
-            seen.add(p)
-    if role == "staff":
-        base = sorted(allowed) if allowed else list(ASSIGNABLE_PERMISSIONS)
-    else:
-        base = sorted(allowed)
-    if "dashboard" not in base:
-        base.insert(0, "dashboard")
-    return base
+    return list(_permissions_for_role_cached(role, tuple(requested or ())))
 
 # ----------------- Flask & DB -----------------
 app = Flask(__name__, static_url_path=(URL_PREFIX + "/static") if URL_PREFIX else "/static")
@@ -224,6 +274,28 @@ app.config["SQLALCHEMY_DATABASE_URI"] = DB_URI
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 print(f"[DB] Using: {DB_PATH}")
+
+# WAL اختیاری است (SQLITE_WAL=1)؛ پشتیبان‌گیری/بازیابی فعلی فقط فایل اصلی را کپی می‌کند و فایل -wal را نمی‌بیند
+SQLITE_WAL = os.environ.get("SQLITE_WAL", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_on_connect(dbapi_conn, connection_record):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    try:
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        if SQLITE_WAL:
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA cache_size=-65536")
+            cur.execute("PRAGMA mmap_size=268435456")
+    finally:
+        cur.close()
+
+
 # Optionally start rates background updater on app startup if enabled via env
 try:
     RATES_AUTO_START = os.environ.get('RATES_AUTO_START', '').strip().lower()
@@ -255,7 +327,18 @@ _handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
 _handler.setFormatter(LocalTimeFormatter("%(asctime)s  %(levelname)s  %(message)s"))
 app.logger.addHandler(_handler)
 
+# نوشتن لاگ در ترد پس‌زمینه تا درخواست‌ها منتظر I/O فایل نمانند
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *app.logger.handlers, respect_handler_level=True)
+for _h in list(app.logger.handlers):
+    app.logger.removeHandler(_h)
+app.logger.addHandler(QueueHandler(_log_queue))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # ----------------- Models -----------------
+# پیش‌فرض‌های زمانی عمداً datetime.now (وقت محلی) در پایتون هستند: func.now()/CURRENT_TIMESTAMP در SQLite به UTC است
+# و ORM را مجبور به SELECT دوباره پس از درج می‌کند. مسیرهای دسته‌ای (ledger/audit/site view) created_at را خودشان می‌فرستند.
 class Account(db.Model):
     __tablename__ = "accounts"
     id        = db.Column(db.Integer, primary_key=True)
@@ -287,6 +370,12 @@ class Entity(db.Model):
     parent    = db.relationship("Entity", remote_side=[id], lazy="joined")
     __table_args__ = (UniqueConstraint("type","code", name="uq_entity_type_code"),)
 
+# جستجوی نام بدون حساسیت به حروف (lower(name) = ?) از این ایندکس استفاده می‌کند
+db.Index("ix_entity_type_lower_name", Entity.type, func.lower(Entity.name))
+# مرتب‌سازی «جدیدترین» جستجو به‌صورت پیمایش ایندکس با LIMIT اجرا می‌شود؛ (type, code) را uq_entity_type_code
+# و مرتب‌سازی نام را ix_entity_type_lower_name پوشش می‌دهد
+db.Index("ix_entity_type_updated", Entity.type, Entity.updated_at.desc(), Entity.id.desc())
+
 class Invoice(db.Model):
     __tablename__ = "invoices"
     id        = db.Column(db.Integer, primary_key=True)
@@ -301,6 +390,9 @@ class Invoice(db.Model):
 
     person    = db.relationship("Entity", lazy="joined")
 
+# ترتیب پیش‌فرض جستجو و فهرست‌ها: date DESC, number DESC
+db.Index("ix_invoices_date_number", Invoice.date.desc(), Invoice.number.desc())
+
 class InvoiceLine(db.Model):
     __tablename__ = "invoice_lines"
     id         = db.Column(db.Integer, primary_key=True)
@@ -322,6 +414,9 @@ class PriceHistory(db.Model):
     updated_at= db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
     __table_args__ = (UniqueConstraint("person_id", "item_id", name="uq_price_person_item"),)
 
+# آخرین قیمت هر کالا (partition by item_id order by updated_at desc) از این ایندکس خوانده می‌شود
+db.Index("ix_price_history_item_updated", PriceHistory.item_id, PriceHistory.updated_at.desc())
+
 class CashBox(db.Model):
     __tablename__ = "cash_boxes"
     id         = db.Column(db.Integer, primary_key=True)
@@ -334,6 +429,11 @@ class CashBox(db.Model):
     is_active  = db.Column(db.Boolean, nullable=False, default=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
+# بررسی تکراری‌بودن نام صندوق با lower(name) انجام می‌شود
+db.Index("ix_cashbox_name_lower", func.lower(CashBox.name))
+# ترتیب فهرست صندوق‌ها در مدیریت و فرم‌ها (kind DESC, is_active DESC, name)
+db.Index("ix_cashbox_listing", CashBox.kind.desc(), CashBox.is_active.desc(), CashBox.name)
+
 
 class CashDoc(db.Model):
     __tablename__ = "cash_docs"
@@ -357,6 +457,20 @@ class CashDoc(db.Model):
     person    = db.relationship("Entity", lazy="joined")
     cashbox   = db.relationship("CashBox", lazy="joined")
 
+# جمع صندوق‌ها (group by cashbox_id, doc_type) و بررسی استفادهٔ صندوق از این ایندکس استفاده می‌کنند
+db.Index("ix_cash_docs_cashbox_type", CashDoc.cashbox_id, CashDoc.doc_type)
+# ترتیب پیش‌فرض جستجوی اسناد نقدی: date DESC, number DESC
+db.Index("ix_cash_docs_date_number", CashDoc.date.desc(), CashDoc.number.desc())
+# شرط «روش = چک» با ثابت‌های درون SQL؛ SQLite ایندکس جزئی را فقط وقتی به‌کار می‌برد که شرط پرس‌وجو عیناً همین عبارت باشد (نه پارامتر)
+_CASHDOC_IS_CHEQUE = func.lower(func.coalesce(CashDoc.method, literal_column("''"))) == literal_column("'cheque'")
+db.Index(
+    "ix_cash_docs_cheque_date",
+    CashDoc.date.desc(),
+    CashDoc.number.desc(),
+    sqlite_where=_CASHDOC_IS_CHEQUE,
+    postgresql_where=_CASHDOC_IS_CHEQUE,
+)
+
 class AuditEvent(db.Model):
     __tablename__ = "audit_events"
     id         = db.Column(db.Integer, primary_key=True)
@@ -368,6 +482,9 @@ class AuditEvent(db.Model):
     payload    = db.Column(db.Text, nullable=True)
 
 
+db.Index("ix_audit_ctx_ts", AuditEvent.context, AuditEvent.created_at)
+
+
 class SiteView(db.Model):
     __tablename__ = "site_views"
     id = db.Column(db.Integer, primary_key=True)
@@ -378,6 +495,9 @@ class SiteView(db.Model):
     user = db.Column(db.String(64), nullable=True)
 
 
+db.Index("ix_siteview_path_ts", SiteView.path, SiteView.created_at)
+
+
 # --- Backup wiring (once) ---
 ensure_dirs(app)
 register_autobackup_for([Invoice, CashDoc])
@@ -422,13 +542,34 @@ def _normalize_user_entry(username: str, data: dict) -> dict:
     }
 
 
-def load_users_catalog() -> dict:
+# users.json در هر درخواست (user_loader) خوانده می‌شود؛ نسخهٔ پردازش‌شده تا تغییر mtime/اندازهٔ فایل نگه داشته می‌شود
+_users_cache: dict = {"stamp": None, "data": None}
+_users_cache_lock = threading.Lock()
+
+
+def _users_file_stamp() -> Optional[tuple]:
+    try:
+        st = os.stat(USERS_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _copy_users_catalog(catalog: dict) -> dict:
+    # فراخوان‌ها (مدیریت کاربران) ورودی‌ها را تغییر می‌دهند؛ نسخهٔ کش دست‌نخورده می‌ماند
+    return {username: dict(entry) for username, entry in catalog.items()}
+
+
+def _read_users_catalog() -> dict:
     try:
         with open(USERS_FILE, "r", encoding="utf-8") as f:
             raw = json.load(f)
     except Exception:
         raw = {"users": []}
+    return _build_users_catalog(raw)
+
 
+def _build_users_catalog(raw: dict) -> dict:
     catalog = {}
     for entry in raw.get("users", []):
         username = (entry or {}).get("username")
@@ -449,6 +590,17 @@ def load_users_catalog() -> dict:
     return catalog
 
 
+def load_users_catalog() -> dict:
+    stamp = _users_file_stamp()
+    with _users_cache_lock:
+        if stamp is not None and _users_cache["stamp"] == stamp:
+            return _copy_users_catalog(_users_cache["data"])
+        catalog = _read_users_catalog()
+        _users_cache["stamp"] = stamp
+        _users_cache["data"] = catalog
+        return _copy_users_catalog(catalog)
+
+
 def save_users_catalog(catalog: dict) -> None:
     payload = {
         "users": [
@@ -462,8 +614,11 @@ def save_users_catalog(catalog: dict) -> None:
             for username, data in sorted(catalog.items(), key=lambda kv: kv[0].lower())
         ]
     }
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    with _users_cache_lock:
+        with open(USERS_FILE, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        _users_cache["stamp"] = _users_file_stamp()
+        _users_cache["data"] = _build_users_catalog(payload)
 
 # ----------------- Auth -----------------
 login_manager = LoginManager(app)
@@ -482,7 +637,7 @@ class User(UserMixin):
         self.id = username
         self.username = username
         self.role = role or "staff"
-        self.permissions = set(permissions or [])
+        self.permissions = frozenset(permissions or ())
         self._active = bool(is_active)
 
     def has_permission(self, perm: str) -> bool:
@@ -518,12 +673,12 @@ def admin_required():
         abort(403)
 
 
-def user_permissions() -> set:
+def user_permissions() -> frozenset:
     if not current_user.is_authenticated:
-        return set()
+        return frozenset()
     if is_admin():
-        return set(ADMIN_PERMISSIONS)
-    return set(getattr(current_user, "permissions", set()))
+        return ADMIN_PERMISSION_SET
+    return getattr(current_user, "permissions", frozenset())
 
 
 def has_permission(perm: str) -> bool:
@@ -535,29 +690,29 @@ def has_permission(perm: str) -> bool:
 def ensure_permission(*perms: str) -> None:
     if not perms:
         return
-    if not current_user.is_authenticated:
+    user = current_user._get_current_object()
+    if not user.is_authenticated:
         abort(403)
-    if is_admin():
+    if user.role == "admin":
         return
-    allowed = user_permissions()
-    if any(p in allowed for p in perms if p):
-        return
-    abort(403)
+    # User.permissions از قبل frozenset است؛ isdisjoint بدون ساختن مجموعهٔ جدید
+    if user.permissions.isdisjoint(perms):
+        abort(403)
 
 def human_duration_from_login():
-    try:
-        ts = session.get("login_at_utc")
-        if not ts: return "—"
-        start = datetime.fromisoformat(ts)
-        delta: timedelta = datetime.utcnow() - start
-        total_seconds = int(delta.total_seconds())
-        h = total_seconds // 3600
-        m = (total_seconds % 3600) // 60
-        s = total_seconds % 60
-        if h > 0: return f"{h:02d}:{m:02d}:{s:02d} ساعت"
-        return f"{m:02d}:{s:02d} دقیقه"
-    except Exception:
-        return "—"
+    ts = session.get("login_at_utc")
+    if not ts: return "—"
+    if type(ts) is not int:
+        # نشست‌های قدیمی زمان ورود را به‌صورت رشتهٔ ISO (UTC) نگه داشته‌اند
+        try:
+            ts = int(datetime.fromisoformat(ts).replace(tzinfo=timezone.utc).timestamp())
+        except Exception:
+            return "—"
+    total_seconds = max(int(time.time()) - ts, 0)
+    h, rest = divmod(total_seconds, 3600)
+    m, s = divmod(rest, 60)
+    if h > 0: return f"{h:02d}:{m:02d}:{s:02d} ساعت"
+    return f"{m:02d}:{s:02d} دقیقه"
 
 @app.context_processor
 def inject_ctx():
@@ -569,7 +724,7 @@ def inject_ctx():
         "current_user_role": getattr(current_user, "role", None),
         "user_permissions": sorted(user_permissions()),
         "has_permission": has_permission,
-        "now_info": date_now_info(),
+        "now_info": _now_info(),
         "active_theme": _ui_theme_key(),
         "theme_choices": THEME_CHOICES,
         "search_sort_pref": _search_sort_key(),
@@ -582,8 +737,20 @@ def inject_ctx():
     }
 
 # === فیلتر جینجا برای جداکننده هزارگان ===
+_INF = float("inf")
+
+
 @app.template_filter('sep')
 def sep_filter(val):
+    # مسیر سریع برای int/float که بیشتر سلول‌های جدول‌ها هستند (bool عمداً به مسیر عمومی می‌رود)
+    t = type(val)
+    if t is int:
+        return f"{val:,}"
+    if t is float and val == val and val not in (_INF, -_INF):
+        i = int(val)
+        if abs(val - i) < 1e-9:
+            return f"{i:,}"
+        return f"{val:,.2f}"
     try:
         f = float(val)
         if abs(f - int(f)) < 1e-9:
@@ -607,73 +774,167 @@ def jdate_filter(val):
 
 # === کمک‌ها ===
 def generate_invoice_number():
-    last = db.session.query(Invoice).order_by(Invoice.id.desc()).first()
+    last = db.session.query(Invoice.id, Invoice.number).order_by(Invoice.id.desc()).limit(1).first()
     if last and (last.number or "").isdigit():
         nxt = int(last.number) + 1
     else:
         nxt = (last.id + 1) if last else 1
     return f"{nxt:08d}"
 
-def _to_float(x, default=0.0):
-    try:
-        if x is None: return default
-        x = str(x).strip().replace(',', '')
-        if x == '': return default
-        return float(x)
-    except:
-        return default
+def _add_invoice_unique(inv, retries: int = 3):
+    """Insert ``inv``; on a duplicate number roll back, regenerate it and retry (UNIQUE on invoices.number).
+
+    The rollback discards the whole transaction, so ``inv`` must be its first write;
+    callers that flush earlier rows pass ``retries=1`` and rebuild the document themselves.
+    """
+    for attempt in range(retries):
+        db.session.add(inv)
+        try:
+            db.session.flush()
+            return inv
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == retries - 1:
+                raise
+            inv.number = generate_invoice_number()
 
 def _now_info():
-    return date_now_info()
+    # یک «اکنون» برای کل درخواست؛ شماره‌های پیشنهادی و قالب‌ها همخوان می‌مانند
+    if not has_request_context():
+        return date_now_info()
+    info = g.get("_now_info")
+    if info is None:
+        info = g._now_info = date_now_info()
+    return info
+
+def _entity_by_code(kind: str, code: str) -> Optional["Entity"]:
+    """Entity by its unique (type, code).
+
+    Matched ids are memoised on ``g`` so repeated lookups in one request resolve
+    through the session identity map instead of another SELECT.
+    """
+    memo = g.setdefault("_entity_code_ids", {}) if has_request_context() else None
+    key = (kind, code)
+    if memo is not None and key in memo:
+        ent = db.session.get(Entity, memo[key])
+        if ent is not None and ent.type == kind and ent.code == code:
+            return ent
+    ent = Entity.query.filter_by(type=kind, code=code).first()
+    if ent is not None and memo is not None:
+        memo[key] = ent.id
+    return ent
+
+
+def _prefix_match(col, prefix: str):
+    """Case-insensitive ``col LIKE prefix%`` in a form an index can serve.
+
+    Postgres matches ``lower(col) LIKE`` against a ``text_pattern_ops`` index.
+    SQLite cannot use an expression index for LIKE, so a prefix without letters
+    or wildcards (codes, numbers) becomes a string range on the plain column.
+    """
+    low = prefix.lower()
+    if (
+        db.engine.dialect.name == "sqlite"
+        and low == prefix.upper()
+        and "%" not in prefix
+        and "_" not in prefix
+    ):
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return and_(col >= prefix, col < upper)
+    return func.lower(col).like(low + "%")
+
+
+def _adjust_balance(entity: "Entity", delta: float) -> None:
+    """Add ``delta`` to the entity balance with one UPDATE evaluated in the database."""
+    db.session.execute(
+        update(Entity)
+        .where(Entity.id == entity.id)
+        .values(balance=func.coalesce(Entity.balance, 0.0) + delta)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.expire(entity, ["balance"])
+    _invalidate_read_caches()
+
+
+def _invoice_for_prefill(invoice_id: int) -> Optional["Invoice"]:
+    """Invoice plus its person, limited to the columns the cash forms prefill from."""
+    return db.session.get(
+        Invoice, invoice_id,
+        options=[
+            load_only(Invoice.total, Invoice.number, Invoice.person_id),
+            joinedload(Invoice.person).options(
+                load_only(Entity.id, Entity.code, Entity.name, Entity.type),
+                lazyload(Entity.parent),
+            ),
+        ],
+    )
 
 def _pos_device_config():
     key = Setting.get("pos_device", "none") or "none"
-    label = dict(POS_DEVICE_CHOICES).get(key, POS_DEVICE_CHOICES[0][1])
+    label = POS_DEVICE_LABELS.get(key, POS_DEVICE_CHOICES[0][1])
     return key, label
 
+# تنظیماتی که inject_ctx در هر رندر می‌خواند؛ با یک SELECT برای کل درخواست روی g نگه داشته می‌شوند
+_CTX_SETTING_KEYS = ("ui_theme", "search_sort", "price_display_mode", "dashboard_widgets", "allow_negative_sales")
+
+
+def _ctx_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    if not has_request_context():
+        return Setting.get(key, default)
+    values = g.get("_ctx_settings")
+    if values is None:
+        rows = db.session.query(Setting.key, Setting.value).filter(Setting.key.in_(_CTX_SETTING_KEYS)).all()
+        values = g._ctx_settings = {k: v for k, v in rows}
+    value = values.get(key)
+    return value if value is not None else default
+
+
+@event.listens_for(Setting, "after_insert")
+@event.listens_for(Setting, "after_update")
+@event.listens_for(Setting, "after_delete")
+def _invalidate_ctx_settings(mapper, connection, target):
+    if has_request_context():
+        g.pop("_ctx_settings", None)
+
+
 def _ui_theme_key():
-    key = (Setting.get("ui_theme", "light") or "light").strip().lower()
-    valid = {k for k, _ in THEME_CHOICES}
-    if key not in valid:
+    key = (_ctx_setting("ui_theme", "light") or "light").strip().lower()
+    if key not in _THEME_VALID:
         key = "light"
     return key
 
 def _search_sort_key():
-    key = (Setting.get("search_sort", "recent") or "recent").strip().lower()
-    valid = {k for k, _ in SEARCH_SORT_CHOICES}
-    if key not in valid:
+    key = (_ctx_setting("search_sort", "recent") or "recent").strip().lower()
+    if key not in _SORT_VALID:
         key = "recent"
     return key
 
 def _price_display_mode():
-    key = (Setting.get("price_display_mode", "last") or "last").strip().lower()
-    valid = {k for k, _ in PRICE_DISPLAY_MODES}
-    if key not in valid:
+    key = (_ctx_setting("price_display_mode", "last") or "last").strip().lower()
+    if key not in _PRICE_VALID:
         key = "last"
     return key
 
 def _dashboard_widgets():
-    raw = Setting.get("dashboard_widgets", "") or ""
-    valid = [k for k, _ in DASHBOARD_WIDGET_CHOICES]
+    raw = _ctx_setting("dashboard_widgets", "") or ""
     try:
         data = json.loads(raw) if raw else []
         if not isinstance(data, list):
             data = []
     except Exception:
         data = []
-    filtered = [k for k in data if k in valid]
+    filtered = [k for k in data if k in _DASH_VALID]
     if not filtered:
-        filtered = list(valid)
+        filtered = list(_DASH_VALID)
     return filtered
 
 def _allow_negative_sales() -> bool:
-    val = (Setting.get("allow_negative_sales", "off") or "off").strip().lower()
+    val = (_ctx_setting("allow_negative_sales", "off") or "off").strip().lower()
     return val in ("on", "true", "1", "yes")
 
 def _assistant_model() -> str:
     key = (Setting.get("openai_model", ASSISTANT_MODEL_CHOICES[0][0]) or ASSISTANT_MODEL_CHOICES[0][0]).strip()
-    valid = {k for k, _ in ASSISTANT_MODEL_CHOICES}
-    if key not in valid:
+    if key not in _MODEL_VALID:
         key = ASSISTANT_MODEL_CHOICES[0][0]
     return key
 
@@ -692,6 +953,7 @@ def _mask_secret(value: str) -> str:
     return f"{value[:3]}{'*' * (len(value) - 6)}{value[-3:]}"
 
 AI_PENDING_TASKS: Dict[str, Dict[str, Any]] = {}
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(8 * 1024 * 1024)))
 
 AI_RESPONSE_SCHEMA = {
     "name": "hesabpak_assistant_response",
@@ -784,6 +1046,96 @@ AI_RESPONSE_SCHEMA = {
     },
 }
 
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _json_dumps(obj: Any) -> str:
+    """Compact UTF-8 JSON text; orjson when available, stdlib otherwise."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:  # orjson.JSONEncodeError (e.g. ints beyond 64 bits)
+            pass
+    return json.dumps(obj, ensure_ascii=False, default=str, separators=(",", ":"))
+
+if fastjsonschema is not None:
+    _VALIDATE_RESPONSE = fastjsonschema.compile(AI_RESPONSE_SCHEMA["schema"])
+else:
+    _VALIDATE_RESPONSE = None
+
+def _validate_ai_response(data: Any) -> Dict[str, Any]:
+    """Check a decoded assistant reply against AI_RESPONSE_SCHEMA; raise ValueError if malformed."""
+    if _VALIDATE_RESPONSE is not None:
+        try:
+            return _VALIDATE_RESPONSE(data)
+        except fastjsonschema.JsonSchemaException as exc:
+            raise ValueError(f"پاسخ دستیار با ساختار مورد انتظار مطابقت ندارد: {exc.message}") from exc
+    # بدون fastjsonschema فقط فیلدهای الزامی بررسی می‌شوند
+    if not isinstance(data, dict):
+        raise ValueError("پاسخ دستیار با ساختار مورد انتظار مطابقت ندارد: data must be object")
+    if not isinstance(data.get("reply"), str):
+        raise ValueError("پاسخ دستیار با ساختار مورد انتظار مطابقت ندارد: data.reply must be string")
+    if not isinstance(data.get("needs_confirmation"), bool):
+        raise ValueError("پاسخ دستیار با ساختار مورد انتظار مطابقت ندارد: data.needs_confirmation must be boolean")
+    return data
+
+# مدل Pydantic معادل AI_RESPONSE_SCHEMA برای structured outputs (responses.parse)
+if BaseModel is not None:
+    class _AIPartner(BaseModel):
+        name: str
+        code: Optional[str] = None
+        phone: Optional[str] = None
+        role: Optional[str] = None
+
+    class _AIInvoiceItem(BaseModel):
+        name: str
+        code: Optional[str] = None
+        qty: float
+        unit: Optional[str] = None
+        unit_price: Optional[float] = None
+        total: Optional[float] = None
+
+    class _AIInvoice(BaseModel):
+        kind: Literal["sales", "purchase", "unknown"] = "sales"
+        number: Optional[str] = None
+        date: Optional[str] = None
+        partner: _AIPartner
+        items: List[_AIInvoiceItem]
+        notes: Optional[str] = None
+
+    class _AICashPerson(BaseModel):
+        name: str
+        code: Optional[str] = None
+
+    class _AICash(BaseModel):
+        doc_type: Literal["receive", "payment", "unknown"] = "unknown"
+        number: Optional[str] = None
+        date: Optional[str] = None
+        person: Optional[_AICashPerson] = None
+        amount: float
+        method: Optional[str] = None
+        bank_account: Optional[str] = None
+        bank_name: Optional[str] = None
+        cheque_number: Optional[str] = None
+        cheque_due: Optional[str] = None
+
+    class _AIAction(BaseModel):
+        operation: Literal["write_file", "append_file", "delete_path"]
+        path: str
+        content: Optional[str] = None
+        description: Optional[str] = None
+
+    class HesabpakAssistantResponse(BaseModel):
+        reply: str
+        needs_confirmation: bool
+        follow_up: Optional[str] = None
+        uncertain_fields: List[str] = Field(default_factory=list)
+        invoice: Optional[_AIInvoice] = None
+        cash: Optional[_AICash] = None
+        actions: List[_AIAction] = Field(default_factory=list)
+else:
+    HesabpakAssistantResponse = None
+
 def _cleanup_ai_tasks():
     expired = []
     now = datetime.utcnow()
@@ -795,7 +1147,7 @@ def _cleanup_ai_tasks():
 
 def _register_ai_task(username: str, payload: Dict[str, Any]) -> str:
     _cleanup_ai_tasks()
-    token = secrets.token_hex(16)
+    token = secrets.token_urlsafe(16)
     AI_PENDING_TASKS[token] = {
         "username": username,
         "payload": payload,
@@ -836,6 +1188,11 @@ def _build_openai_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any
             mime = (att.get("mime_type") or "image/png").strip() or "image/png"
             if not data:
                 continue
+            # Reject oversize images from the encoded length before decoding anything
+            approx_bytes = (len(data.rstrip("=")) * 3) // 4
+            if approx_bytes > MAX_IMAGE_BYTES:
+                app.logger.warning("assistant image attachment too large (~%d bytes); skipped", approx_bytes)
+                continue
             # Validate base64 to avoid invalid payloads
             try:
                 base64.b64decode(data, validate=True)
@@ -861,14 +1218,16 @@ def _resolve_project_path(rel_path: str) -> Path:
     rel = Path(rel_path)
     if rel.is_absolute():
         raise ValueError("مسیر باید نسبی باشد.")
-    target = (PROJECT_ROOT / rel).resolve()
-    if PROJECT_ROOT not in target.parents and target != PROJECT_ROOT:
+    # بررسی امنیتی روی فایل‌سیستمی که در حال تغییر است (mkdir/unlink/symlink)؛ نتیجه عمداً کش نمی‌شود
+    target = (_PROJECT_ROOT_RESOLVED / rel).resolve()
+    if not target.is_relative_to(_PROJECT_ROOT_RESOLVED):
         raise ValueError("امکان دسترسی به مسیر خارج از پروژه وجود ندارد.")
     return target
 
 
 def _apply_assistant_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:
     summary = {"applied": 0, "failed": 0, "messages": [], "errors": []}
+    ready_dirs = set()
     for action in actions:
         if not isinstance(action, dict):
             summary["failed"] += 1
@@ -898,16 +1257,35 @@ def _apply_assistant_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:
                 content = action.get("content")
                 if not isinstance(content, str):
                     raise ValueError("محتوای فایل موجود نیست.")
-                target.parent.mkdir(parents=True, exist_ok=True)
-                target.write_text(content, encoding="utf-8")
+                if target.parent not in ready_dirs:
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    ready_dirs.add(target.parent)
+                # write to a uniquely named sibling temp file, then swap in atomically;
+                # نوشتن‌های هم‌زمان روی یک مسیر هر کدام فایل موقت خودشان را دارند
+                fh = tempfile.NamedTemporaryFile(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp", delete=False)
+                tmp = Path(fh.name)
+                try:
+                    with fh:
+                        fh.write(content.encode("utf-8"))
+                    # NamedTemporaryFile با مجوز 0600 ساخته می‌شود؛ مجوز فایل فعلی (یا پیش‌فرض) حفظ می‌شود
+                    if target.exists():
+                        shutil.copymode(target, tmp)
+                    else:
+                        tmp.chmod(0o644)
+                    os.replace(tmp, target)
+                finally:
+                    if tmp.exists():
+                        tmp.unlink()
                 summary["applied"] += 1
                 message = description or f"فایل «{rel_path}» بروزرسانی شد."
             elif operation == "append_file":
                 content = action.get("content")
                 if not isinstance(content, str):
                     raise ValueError("محتوای فایل موجود نیست.")
-                target.parent.mkdir(parents=True, exist_ok=True)
-                with target.open("a", encoding="utf-8") as fh:
+                if target.parent not in ready_dirs:
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    ready_dirs.add(target.parent)
+                with target.open("a", encoding="utf-8", buffering=1024 * 1024) as fh:
                     fh.write(content)
                 summary["applied"] += 1
                 message = description or f"محتوا به فایل «{rel_path}» افزوده شد."
@@ -981,23 +1359,41 @@ def _call_openai_assistant(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
     # network/client exceptions. Try the schema-enabled request first and
     # fall back gracefully. Any unexpected exception should be handled and
     # return a readable assistant fallback instead of bubbling up.
+    # Prefer structured outputs via responses.parse(): the SDK hands back the
+    # parsed model directly, so there is no block-walking or json.loads.
+    response = None
+    parsed = None
     try:
-        try:
-            response = client.responses.create(
-                model=model,
-                input=request_messages,
-                max_output_tokens=max_tokens,
-                temperature=temperature,
-                response_format={"type": "json_schema", "json_schema": AI_RESPONSE_SCHEMA},
-            )
-        except TypeError:
-            app.logger.warning("OpenAI client.responses.create() doesn't support 'response_format'; falling back to plain response")
-            response = client.responses.create(
-                model=model,
-                input=request_messages,
-                max_output_tokens=max_tokens,
-                temperature=temperature,
-            )
+        if HesabpakAssistantResponse is not None and hasattr(client.responses, "parse"):
+            try:
+                response = client.responses.parse(
+                    model=model,
+                    input=request_messages,
+                    max_output_tokens=max_tokens,
+                    temperature=temperature,
+                    text_format=HesabpakAssistantResponse,
+                )
+                parsed = getattr(response, "output_parsed", None)
+            except TypeError:
+                app.logger.warning("OpenAI client.responses.parse() doesn't support 'text_format'; falling back to create()")
+                response = None
+        if response is None:
+            try:
+                response = client.responses.create(
+                    model=model,
+                    input=request_messages,
+                    max_output_tokens=max_tokens,
+                    temperature=temperature,
+                    response_format={"type": "json_schema", "json_schema": AI_RESPONSE_SCHEMA},
+                )
+            except TypeError:
+                app.logger.warning("OpenAI client.responses.create() doesn't support 'response_format'; falling back to plain response")
+                response = client.responses.create(
+                    model=model,
+                    input=request_messages,
+                    max_output_tokens=max_tokens,
+                    temperature=temperature,
+                )
     except Exception as e:
         # Log full exception for diagnostics and return a safe fallback reply
         app.logger.exception("OpenAI assistant request failed: %s", e)
@@ -1010,6 +1406,12 @@ def _call_openai_assistant(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
             "invoice": None,
         }
 
+    if parsed is not None:
+        try:
+            return parsed.model_dump()
+        except Exception:
+            app.logger.exception("failed to dump parsed assistant response; falling back to raw output")
+
     content: Optional[str] = None
     try:
         output_blocks = getattr(response, "output", None) or []
@@ -1043,7 +1445,7 @@ def _call_openai_assistant(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
     # Try to parse JSON first. If it fails, attempt to extract a JSON substring
     # from the response text (common when the assistant includes explanation)
     try:
-        return json.loads(content)
+        data = _json_loads(content)
     except Exception as exc:
         app.logger.warning("failed to json-decode assistant content, trying to extract JSON: %s", exc)
         # Try to find a JSON object or array in the text
@@ -1054,8 +1456,8 @@ def _call_openai_assistant(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
             if m:
                 candidate = m.group(1)
                 try:
-                    return json.loads(candidate)
-                except Exception as exc2:
+                    return _validate_ai_response(_json_loads(candidate))
+                except ValueError as exc2:
                     app.logger.warning("extracted JSON still invalid: %s", exc2)
         except Exception:
             app.logger.exception("error while trying to extract JSON from assistant content")
@@ -1072,6 +1474,7 @@ def _call_openai_assistant(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
             "actions": [],
             "invoice": None,
         }
+    return _validate_ai_response(data)
 
 def _parse_invoice_date(raw: Optional[str]) -> Optional[date]:
     if not raw:
@@ -1090,27 +1493,32 @@ def _entity_level_from_code(code: str) -> int:
 
 def _generate_entity_code(kind: str, preferred: Optional[str] = None) -> str:
     kind = (kind or "item").strip()
-    if preferred and preferred.isdigit() and len(preferred) in (3, 6, 9):
+    if preferred and not preferred.isdigit():
+        preferred = None
+    if preferred and len(preferred) in (3, 6, 9):
         exists = Entity.query.filter_by(type=kind, code=preferred).first()
         if not exists:
             return preferred
 
     target_level = 1 if kind == "person" else 3
     prefix = ""
-    if preferred and preferred.isdigit() and len(preferred) > 3:
+    if preferred and len(preferred) > 3:
         prefix = preferred[: len(preferred) - 3]
         target_level = len(preferred) // 3
 
     target_length = {1: 3, 2: 6, 3: 9}.get(target_level, 9)
-    base_query = db.session.query(Entity.code).filter(Entity.type == kind)
-    if prefix:
-        base_query = base_query.filter(Entity.code.like(f"{prefix}%"))
-    base_query = base_query.filter(func.length(Entity.code) == target_length)
+    # بازهٔ رشته‌ای روی (type, code) از ایندکس یکتا استفاده می‌کند؛ length فقط کدهای بلندتر داخل بازه را حذف می‌کند
+    pad = target_length - len(prefix)
+    base_query = db.session.query(func.substr(Entity.code, len(prefix) + 1, 3)).filter(
+        Entity.type == kind,
+        Entity.code >= prefix + "0" * pad,
+        Entity.code < prefix + "9" * pad + chr(ord("9") + 1),
+        func.length(Entity.code) == target_length,
+    )
 
     existing = set()
-    for (code,) in base_query.all():
+    for (suffix,) in base_query.all():
         try:
-            suffix = code[len(prefix):len(prefix) + 3]
             existing.add(int(suffix))
         except Exception:
             continue
@@ -1123,17 +1531,56 @@ def _generate_entity_code(kind: str, preferred: Optional[str] = None) -> str:
         code += "000"
     return code[:target_length]
 
-def _resolve_entity(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+def _clean_entity_ref(payload: Dict[str, Any]) -> Tuple[str, str]:
+    """Strip ``name``/``code`` once; ``code`` is kept only when it is all digits."""
     name = (payload.get("name") or "").strip()
     code = (payload.get("code") or "").strip()
+    return name, code if code.isdigit() else ""
+
+def _entity_lookup_cache(kind: str, refs: List[Tuple[str, str]]):
+    """Load every entity of ``kind`` referenced by ``refs`` (by code or name) in one query.
+
+    ``refs`` are ``(name, code)`` tuples from ``_clean_entity_ref``.
+    Returns ``(by_code, by_lower_name)`` dicts suitable for ``_resolve_entity``.
+    """
+    codes = set()
+    names = set()
+    for name, code in refs:
+        if code:
+            codes.add(code)
+        if name:
+            names.add(name.lower())
+    by_code: Dict[str, Entity] = {}
+    by_lower_name: Dict[str, Entity] = {}
+    if not codes and not names:
+        return by_code, by_lower_name
+    conds = []
+    if codes:
+        conds.append(Entity.code.in_(codes))
+    if names:
+        conds.append(func.lower(Entity.name).in_(names))
+    for ent in Entity.query.filter(Entity.type == kind, or_(*conds)).order_by(Entity.id.asc()).all():
+        by_code.setdefault(ent.code, ent)
+        by_lower_name.setdefault((ent.name or "").lower(), ent)
+    return by_code, by_lower_name
+
+def _resolve_entity(kind: str, cleaned: Tuple[str, str], cache=None) -> Dict[str, Any]:
+    name, code = cleaned
     entity = None
-    if code and code.isdigit():
-        entity = Entity.query.filter_by(type=kind, code=code).first()
-    if not entity and name:
-        entity = Entity.query.filter(Entity.type == kind, Entity.name.ilike(name)).first()
+    if cache is not None:
+        by_code, by_lower_name = cache
+        if code:
+            entity = by_code.get(code)
+        if not entity and name:
+            entity = by_lower_name.get(name.lower())
+    else:
+        if code:
+            entity = _entity_by_code(kind, code)
+        if not entity and name:
+            entity = Entity.query.filter(Entity.type == kind, func.lower(Entity.name) == name.lower()).first()
     info = {
         "name": name,
-        "code": code if code and code.isdigit() else "",
+        "code": code,
         "entity": entity,
     }
     return info
@@ -1144,24 +1591,30 @@ def _prepare_invoice_plan(invoice_data: Dict[str, Any]) -> Dict[str, Any]:
         kind = "sales"
 
     partner_payload = invoice_data.get("partner") or {}
-    partner_info = _resolve_entity("person", partner_payload)
+    partner_info = _resolve_entity("person", _clean_entity_ref(partner_payload))
 
     parsed_date = _parse_invoice_date(invoice_data.get("date"))
     number = (invoice_data.get("number") or "").strip()
 
+    item_rows = []
+    for row in invoice_data.get("items") or []:
+        if not isinstance(row, dict):
+            continue
+        cleaned = _clean_entity_ref(row)
+        if cleaned[0]:
+            item_rows.append((row, cleaned))
+    item_cache = _entity_lookup_cache("item", [cleaned for _, cleaned in item_rows])
+
     items_preview = []
     missing_items = []
     total = 0.0
-    for row in invoice_data.get("items") or []:
-        name = (row.get("name") or "").strip()
-        if not name:
-            continue
+    for row, cleaned in item_rows:
+        name, code = cleaned
         qty = _to_float(row.get("qty"), 0.0)
         unit_price = _to_float(row.get("unit_price"), 0.0)
         unit = (row.get("unit") or "عدد").strip() or "عدد"
-        code = (row.get("code") or "").strip()
 
-        item_info = _resolve_entity("item", {"name": name, "code": code})
+        item_info = _resolve_entity("item", cleaned, item_cache)
         line_total = qty * unit_price if unit_price else 0.0
         total += line_total
 
@@ -1170,7 +1623,7 @@ def _prepare_invoice_plan(invoice_data: Dict[str, Any]) -> Dict[str, Any]:
             "qty": qty,
             "unit_price": unit_price,
             "unit": unit,
-            "code": code if code and code.isdigit() else "",
+            "code": code,
             "line_total": line_total,
             "entity_id": item_info["entity"].id if item_info["entity"] else None,
             "exists": bool(item_info["entity"]),
@@ -1181,7 +1634,7 @@ def _prepare_invoice_plan(invoice_data: Dict[str, Any]) -> Dict[str, Any]:
             missing_items.append({
                 "name": name,
                 "unit": unit,
-                "code": preview_entry["code"] or None,
+                "code": code or None,
                 "qty": qty,
                 "unit_price": unit_price,
             })
@@ -1217,7 +1670,7 @@ def _prepare_cash_plan(cash_data: Dict[str, Any]) -> Dict[str, Any]:
         doc_type = "unknown"
 
     person_payload = cash_data.get("person") or {}
-    person_info = _resolve_entity("person", person_payload)
+    person_info = _resolve_entity("person", _clean_entity_ref(person_payload))
 
     amount = _to_float(cash_data.get("amount"), 0.0)
     number = (cash_data.get("number") or "").strip()
@@ -1252,8 +1705,12 @@ def _prepare_cash_plan(cash_data: Dict[str, Any]) -> Dict[str, Any]:
     return plan
 
 
-def _apply_cash_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
-    """Apply a prepared cash plan: create CashDoc and update balances."""
+def _apply_cash_plan(plan: Dict[str, Any], commit: bool = True) -> Dict[str, Any]:
+    """Apply a prepared cash plan: create CashDoc and update balances.
+
+    With ``commit=False`` the work is only flushed; the caller commits and then
+    calls ``outcome["after_commit"]()`` to write the ledger entry.
+    """
     doc_type = (plan.get("doc_type") or "unknown").strip().lower()
     if doc_type not in ("receive", "payment"):
         # default to receive for positive amounts if unspecified
@@ -1261,12 +1718,11 @@ def _apply_cash_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
 
     person_entity = None
     if plan.get("person") and plan["person"].get("entity_id"):
-        person_entity = Entity.query.get(int(plan["person"]["entity_id"]))
+        person_entity = db.session.get(Entity, int(plan["person"]["entity_id"]))
     if not person_entity:
         # create or fetch by name/code
-        pname = plan.get("person", {}).get("name") or ""
-        pcode = plan.get("person", {}).get("code") or ""
-        person_info = _resolve_entity("person", {"name": pname, "code": pcode})
+        pname, pcode = _clean_entity_ref(plan.get("person") or {})
+        person_info = _resolve_entity("person", (pname, pcode))
         if person_info.get("entity"):
             person_entity = person_info["entity"]
         else:
@@ -1324,54 +1780,50 @@ def _apply_cash_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
     db.session.add(doc)
 
     # update person's balance same as receive/payment handlers
-    try:
-        if doc_type == "receive":
-            person_entity.balance = float(person_entity.balance or 0.0) - float(amount)
-        else:
-            person_entity.balance = float(person_entity.balance or 0.0) + float(amount)
-    except Exception:
-        # best-effort
-        if doc_type == "receive":
-            person_entity.balance = -float(amount)
-        else:
-            person_entity.balance = float(amount)
+    _adjust_balance(person_entity, -float(amount) if doc_type == "receive" else float(amount))
 
-    db.session.commit()
-    # record ledger entry for cash doc creation
-    try:
-        ledger_payload = {
-            "doc_id": doc.id,
-            "number": doc.number,
-            "doc_type": doc.doc_type,
-            "amount": float(doc.amount or 0.0),
-            "person_id": person_entity.id if person_entity else None,
-            "cashbox_id": cb.id if cb else None,
-        }
+    def write_ledger():
+        # record ledger entry for cash doc creation
         try:
-            record_ledger("cashdoc", doc.id, "create", ledger_payload)
+            ledger_payload = {
+                "doc_id": doc.id,
+                "number": doc.number,
+                "doc_type": doc.doc_type,
+                "amount": float(doc.amount or 0.0),
+                "person_id": person_entity.id if person_entity else None,
+                "cashbox_id": cb.id if cb else None,
+            }
+            try:
+                record_ledger("cashdoc", doc.id, "create", ledger_payload)
+            except Exception:
+                app.logger.exception("failed to write cashdoc ledger entry")
         except Exception:
-            app.logger.exception("failed to write cashdoc ledger entry")
-    except Exception:
-        app.logger.exception("failed to prepare cashdoc ledger payload")
+            app.logger.exception("failed to prepare cashdoc ledger payload")
 
-    return {"doc": doc, "person": person_entity, "cashbox": cb}
+    outcome = {"doc": doc, "person": person_entity, "cashbox": cb}
+    if not commit:
+        db.session.flush()
+        outcome["after_commit"] = write_ledger
+        return outcome
+    db.session.commit()
+    write_ledger()
+    return outcome
 
 def _ensure_entity(kind: str, data: Dict[str, Any]) -> Entity:
-    name = (data.get("name") or "").strip()
-    code = (data.get("code") or "").strip()
+    name, code = _clean_entity_ref(data)
     unit = (data.get("unit") or ("عدد" if kind == "item" else "شرکت")).strip()
     if not name:
         raise ValueError("نام موجودیت مشخص نشده است.")
 
     existing = None
-    if code and code.isdigit():
-        existing = Entity.query.filter_by(type=kind, code=code).first()
+    if code:
+        existing = _entity_by_code(kind, code)
     if not existing:
         existing = Entity.query.filter(Entity.type == kind, Entity.name == name).first()
     if existing:
         return existing
 
-    final_code = _generate_entity_code(kind, code if code and code.isdigit() else None)
+    final_code = _generate_entity_code(kind, code or None)
     level = _entity_level_from_code(final_code)
     parent_id = None
     if level == 2:
@@ -1386,27 +1838,40 @@ def _ensure_entity(kind: str, data: Dict[str, Any]) -> Entity:
     db.session.flush()
     return ent
 
-def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+def _apply_invoice_plan(plan: Dict[str, Any], commit: bool = True, retries: int = 3) -> Dict[str, Any]:
+    """Apply a prepared invoice plan; ``commit=False`` behaves as in ``_apply_cash_plan``."""
+    for attempt in range(retries):
+        try:
+            return _apply_invoice_plan_once(plan, commit)
+        except IntegrityError:
+            # شمارهٔ تکراری: تراکنش rollback شده و کل سند (طرف حساب و کالاهای تازه هم) با شمارهٔ جدید از نو ساخته می‌شود
+            db.session.rollback()
+            if attempt == retries - 1:
+                raise
+            plan = {**plan, "number": generate_invoice_number()}
+
+def _apply_invoice_plan_once(plan: Dict[str, Any], commit: bool) -> Dict[str, Any]:
     kind = plan.get("kind", "sales")
     partner_payload = plan.get("partner") or {}
     partner_entity = None
     if partner_payload.get("entity_id"):
-        partner_entity = Entity.query.get(int(partner_payload["entity_id"]))
+        partner_entity = db.session.get(Entity, int(partner_payload["entity_id"]))
     if not partner_entity:
         partner_entity = _ensure_entity("person", partner_payload)
 
     number = (plan.get("number") or "").strip()
     if not number:
         number = generate_invoice_number()
-    if Invoice.query.filter_by(number=number).first():
-        number = generate_invoice_number()
 
     inv_date = _parse_invoice_date(plan.get("date")) or datetime.utcnow().date()
 
     allow_negative = _allow_negative_sales()
     items_payload = []
     created_items = []
-    for row in plan.get("items") or []:
+    plan_items = plan.get("items") or []
+    ids = {int(r["entity_id"]) for r in plan_items if r.get("entity_id")}
+    by_id = {e.id: e for e in Entity.query.filter(Entity.id.in_(ids)).all()} if ids else {}
+    for row in plan_items:
         qty = _to_float(row.get("qty"), 0.0)
         if qty <= 0:
             continue
@@ -1414,9 +1879,10 @@ def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
         unit = (row.get("unit") or "عدد").strip() or "عدد"
         item_entity = None
         if row.get("entity_id"):
-            item_entity = Entity.query.get(int(row["entity_id"]))
+            item_entity = by_id.get(int(row["entity_id"]))
         if not item_entity:
-            item_entity = _ensure_entity("item", row)
+            name, code = _clean_entity_ref(row)
+            item_entity = _ensure_entity("item", {"name": name, "code": code, "unit": unit})
             created_items.append(item_entity)
 
         current_stock = float(item_entity.stock_qty or 0.0)
@@ -1434,10 +1900,13 @@ def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
         raise ValueError("هیچ ردیف کالایی معتبر نیست.")
 
     inv = Invoice(number=number, date=inv_date, person_id=partner_entity.id, kind=kind, discount=0.0, tax=0.0, total=0.0)
-    db.session.add(inv)
-    db.session.flush()
+    _add_invoice_unique(inv, retries=1)
 
     total = 0.0
+    lines = []
+    last_prices = {}
+    stock_deltas = {}
+    sign = -1.0 if kind == "sales" else 1.0
     for payload in items_payload:
         item = payload["entity"]
         qty = float(payload["qty"])
@@ -1445,7 +1914,7 @@ def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
         line_total = qty * unit_price
         total += line_total
 
-        db.session.add(
+        lines.append(
             InvoiceLine(
                 invoice_id=inv.id,
                 item_id=item.id,
@@ -1455,21 +1924,43 @@ def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
             )
         )
 
+        stock_deltas[item.id] = stock_deltas.get(item.id, 0.0) + sign * qty
         if kind == "sales":
-            try:
-                item.stock_qty = float(item.stock_qty or 0.0) - qty
-            except Exception:
-                item.stock_qty = 0.0 - qty
-            ph = PriceHistory.query.filter_by(person_id=partner_entity.id, item_id=item.id).first()
+            last_prices[item.id] = unit_price
+
+    db.session.bulk_save_objects(lines)
+
+    # یک UPDATE برای موجودی همهٔ کالاها به‌جای یک UPDATE به ازای هر ردیف
+    db.session.execute(
+        update(Entity)
+        .where(Entity.id.in_(stock_deltas.keys()))
+        .values(stock_qty=case(
+            {item_id: func.coalesce(Entity.stock_qty, 0.0) + delta for item_id, delta in stock_deltas.items()},
+            value=Entity.id,
+        ))
+        .execution_options(synchronize_session=False)
+    )
+    for payload in items_payload:
+        db.session.expire(payload["entity"], ["stock_qty"])
+
+    if last_prices:
+        existing_ph = {
+            ph.item_id: ph
+            for ph in PriceHistory.query.filter(
+                PriceHistory.person_id == partner_entity.id,
+                PriceHistory.item_id.in_(last_prices.keys()),
+            ).all()
+        }
+        missing_ph = []
+        for item_id, unit_price in last_prices.items():
+            ph = existing_ph.get(item_id)
             if not ph:
-                db.session.add(PriceHistory(person_id=partner_entity.id, item_id=item.id, last_price=unit_price))
+                missing_ph.append({"person_id": partner_entity.id, "item_id": item_id, "last_price": unit_price})
             else:
                 ph.last_price = unit_price
-        else:
-            try:
-                item.stock_qty = float(item.stock_qty or 0.0) + qty
-            except Exception:
-                item.stock_qty = 0.0 + qty
+        if missing_ph:
+            db.session.bulk_insert_mappings(PriceHistory, missing_ph)
+    _invalidate_read_caches()
 
     # total must be positive
     if float(total) <= 0:
@@ -1478,42 +1969,42 @@ def _apply_invoice_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
 
     inv.total = total
 
-    try:
-        if kind == "sales":
-            partner_entity.balance = float(partner_entity.balance or 0.0) + float(total)
-        else:
-            partner_entity.balance = float(partner_entity.balance or 0.0) - float(total)
-    except Exception:
-        partner_entity.balance = float(total) if kind == "sales" else -float(total)
-
-    db.session.commit()
+    _adjust_balance(partner_entity, -sign * float(total))
 
-    # record ledger entry for invoice creation (append-only)
-    try:
-        ledger_lines = [
-            {"item_id": int(p["entity"].id), "qty": float(p["qty"]), "unit_price": float(p["unit_price"]) }
-            for p in items_payload
-        ]
-        ledger_payload = {
-            "invoice_id": inv.id,
-            "number": inv.number,
-            "kind": inv.kind,
-            "total": float(inv.total or 0.0),
-            "partner_id": partner_entity.id if partner_entity else None,
-            "lines": ledger_lines,
-        }
+    def write_ledger():
+        # record ledger entry for invoice creation (append-only)
         try:
-            record_ledger("invoice", inv.id, "create", ledger_payload)
+            ledger_lines = [
+                {"item_id": int(p["entity"].id), "qty": float(p["qty"]), "unit_price": float(p["unit_price"]) }
+                for p in items_payload
+            ]
+            ledger_payload = {
+                "invoice_id": inv.id,
+                "number": inv.number,
+                "kind": inv.kind,
+                "total": float(inv.total or 0.0),
+                "partner_id": partner_entity.id if partner_entity else None,
+                "lines": ledger_lines,
+            }
+            try:
+                record_ledger("invoice", inv.id, "create", ledger_payload)
+            except Exception:
+                app.logger.exception("failed to write invoice ledger entry")
         except Exception:
-            app.logger.exception("failed to write invoice ledger entry")
-    except Exception:
-        app.logger.exception("failed to prepare invoice ledger payload")
+            app.logger.exception("failed to prepare invoice ledger payload")
 
-    return {
+    outcome = {
         "invoice": inv,
         "partner": partner_entity,
         "created_items": created_items,
     }
+    if not commit:
+        db.session.flush()
+        outcome["after_commit"] = write_ledger
+        return outcome
+    db.session.commit()
+    write_ledger()
+    return outcome
 
 
 def _find_entity_by_code_or_id(kind: str, code_or_id: str):
@@ -1527,17 +2018,19 @@ def _find_entity_by_code_or_id(kind: str, code_or_id: str):
 
 @app.before_request
 def _req_log():
-    if current_user.is_authenticated:
-        app.logger.info(f"USER={current_user.username}  IP={request.remote_addr}  {request.method} {request.path}  ARGS={dict(request.args)}")
-    else:
-        app.logger.info(f"ANON  IP={request.remote_addr}  {request.method} {request.path}  ARGS={dict(request.args)}")
-    # record site view for analytics
-    try:
-        sv = SiteView(ip=request.headers.get('X-Forwarded-For', request.remote_addr or ''), path=request.path, method=request.method, user=(getattr(current_user, 'username', None) if current_user and getattr(current_user, 'is_authenticated', False) else None))
-        db.session.add(sv)
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
+    if app.logger.isEnabledFor(logging.INFO):
+        if current_user.is_authenticated:
+            app.logger.info("USER=%s  IP=%s  %s %s  ARGS=%s", current_user.username, request.remote_addr, request.method, request.path, dict(request.args))
+        else:
+            app.logger.info("ANON  IP=%s  %s %s  ARGS=%s", request.remote_addr, request.method, request.path, dict(request.args))
+    # record site view for analytics (batched by the site-view writer thread)
+    _enqueue_site_view({
+        "created_at": datetime.now(),
+        "ip": request.headers.get('X-Forwarded-For', request.remote_addr or ''),
+        "path": request.path,
+        "method": request.method,
+        "user": (getattr(current_user, 'username', None) if current_user and getattr(current_user, 'is_authenticated', False) else None),
+    })
 
 def _level_by_code(code: str) -> int:
     L = len(code or "")
@@ -1547,6 +2040,64 @@ def _level_by_code(code: str) -> int:
     return 0
 
 
+# کش فهرست والدها برای فرم‌های طرف‌حساب/کالا؛ با هر تغییر Entity (و نوشتن‌های Core) پاک می‌شود.
+# کش در هر پروسه جداست؛ پروسه‌های دیگر حداکثر PARENTS_CACHE_SECONDS فهرست کهنه نشان می‌دهند
+_ParentOption = namedtuple("_ParentOption", "id code name")
+PARENTS_CACHE_SECONDS = 60
+_PARENTS_CACHE: Dict[int, Tuple[float, List[_ParentOption]]] = {}
+
+
+def _parents_by_level(level: int) -> List[_ParentOption]:
+    now = time.monotonic()
+    hit = _PARENTS_CACHE.get(level)
+    if hit and now - hit[0] < PARENTS_CACHE_SECONDS:
+        return hit[1]
+    rows = [
+        _ParentOption(*r)
+        for r in db.session.query(Entity.id, Entity.code, Entity.name)
+        .filter(Entity.level == level)
+        .order_by(Entity.code.asc())
+    ]
+    _PARENTS_CACHE[level] = (now, rows)
+    return rows
+
+
+@event.listens_for(Entity, "after_insert")
+@event.listens_for(Entity, "after_update")
+@event.listens_for(Entity, "after_delete")
+def _invalidate_parents_cache(mapper, connection, target):
+    _PARENTS_CACHE.clear()
+
+
+# صندوق‌های فعال برای فرم‌های دریافت/پرداخت؛ نسخه با هر تغییر CashBox (و نوشتن‌های Core) بالا می‌رود.
+# کش در هر پروسه جداست؛ پروسه‌های دیگر حداکثر CASHBOX_CACHE_SECONDS فهرست کهنه نشان می‌دهند
+_CashBoxOption = namedtuple("_CashBoxOption", "id name kind bank_name account_no")
+CASHBOX_CACHE_SECONDS = 60
+_cashbox_cache_version = 0
+
+
+@lru_cache(maxsize=4)
+def _active_cashboxes_cached(version: int, bucket: int) -> Tuple[_CashBoxOption, ...]:
+    rows = (
+        db.session.query(CashBox.id, CashBox.name, CashBox.kind, CashBox.bank_name, CashBox.account_no)
+        .filter(CashBox.is_active == True)
+        .order_by(CashBox.kind.desc(), CashBox.name.asc())
+    )
+    return tuple(_CashBoxOption(*r) for r in rows)
+
+
+def _active_cashboxes() -> Tuple[_CashBoxOption, ...]:
+    return _active_cashboxes_cached(_cashbox_cache_version, int(time.time() // CASHBOX_CACHE_SECONDS))
+
+
+@event.listens_for(CashBox, "after_insert")
+@event.listens_for(CashBox, "after_update")
+@event.listens_for(CashBox, "after_delete")
+def _invalidate_cashbox_cache(mapper, connection, target):
+    global _cashbox_cache_version
+    _cashbox_cache_version += 1
+
+
 def _suggest_next_entity_code(e_type: str) -> str:
     """Suggest the next available numeric code for entities of type e_type.
 
@@ -1637,20 +2188,81 @@ def validate_entity_form(form, for_update_id=None):
                         parent=parent, level=lvl)
 
 # ----------------- Routes: main -----------------
-@app.route(URL_PREFIX + "/")
-@login_required
-def index():
-    ensure_permission("dashboard")
-    now = _now_info()
-    today = now["datetime"].date()
-    horizon = today + timedelta(days=3)
+# کش نمودارها در هر پروسه جداست و با نوشتن‌های Core خالی می‌شود؛ پروسه‌های دیگر حداکثر CHART_CACHE_SECONDS کهنه می‌مانند
+CHART_CACHE_SECONDS = 30
 
-    inv_stats = (
+@lru_cache(maxsize=8)
+def _chart_payload(chart_days: tuple, max_inv, max_cd, bucket) -> Dict[str, List[float]]:
+    """Per-day dashboard chart series for ``chart_days``.
+
+    Cached by the latest invoice/cash doc ids plus a time bucket; callers must not mutate the lists.
+    """
+    # build per-day sales and purchase totals and invoice counts
+    inv_rows = (
+        db.session.query(Invoice.date, Invoice.kind, func.coalesce(Invoice.total, 0.0))
+        .filter(Invoice.date >= chart_days[0], Invoice.date <= chart_days[-1])
+        .all()
+    )
+    # هر روز یک خانهٔ ثابت در لیست‌ها دارد؛ ردیف‌ها مستقیم در همان خانه نوشته می‌شوند
+    idx = {d: i for i, d in enumerate(chart_days)}
+    n = len(chart_days)
+    sales_totals = [0.0] * n; purchase_totals = [0.0] * n; invoice_counts = [0] * n
+    receives_totals = [0.0] * n; payments_totals = [0.0] * n
+    for dt, kind, total in inv_rows:
+        i = idx.get(dt)
+        if i is None:
+            continue
+        try:
+            total_val = float(total or 0.0)
+        except Exception:
+            total_val = 0.0
+        if (kind or '') == 'sales':
+            sales_totals[i] += total_val
+            invoice_counts[i] += 1
+        else:
+            purchase_totals[i] += total_val
+
+    cash_rows = (
         db.session.query(
-            func.count(Invoice.id),
-            func.coalesce(func.sum(Invoice.total), 0.0),
+            CashDoc.date,
+            CashDoc.doc_type,
+            func.coalesce(func.sum(CashDoc.amount), 0.0),
         )
-        .filter(Invoice.date == today)
+        .filter(CashDoc.date >= chart_days[0], CashDoc.date <= chart_days[-1])
+        .group_by(CashDoc.date, CashDoc.doc_type)
+        .all()
+    )
+    for dt, doc_type, total in cash_rows:
+        i = idx.get(dt)
+        if i is None:
+            continue
+        if doc_type == "receive":
+            receives_totals[i] = float(total or 0.0)
+        elif doc_type == "payment":
+            payments_totals[i] = float(total or 0.0)
+
+    return {
+        "sales_totals": sales_totals,
+        "purchase_totals": purchase_totals,
+        "invoice_counts": invoice_counts,
+        "receives_totals": receives_totals,
+        "payments_totals": payments_totals,
+    }
+
+@app.route(URL_PREFIX + "/")
+@login_required
+def index():
+    ensure_permission("dashboard")
+    now = _now_info()
+    today = now["datetime"].date()
+    horizon = today + timedelta(days=3)
+
+    inv_stats = (
+        db.session.query(
+            func.count(Invoice.id),
+            func.coalesce(func.sum(Invoice.total), 0.0),
+        )
+        .filter(Invoice.date == today)
         .first()
     ) or (0, 0.0)
     today_invoice_count = int(inv_stats[0] or 0)
@@ -1679,7 +2291,7 @@ def index():
     today_payments_total = _sum_cash("payment")
 
     # Dashboard: show a single aggregated row for all active cashboxes (unified view)
-    active_ids = [b.id for b in CashBox.query.filter_by(is_active=True).all()]
+    active_ids = [b.id for b in _active_cashboxes()]
     q_recv = db.session.query(func.coalesce(func.sum(CashDoc.amount), 0.0)).filter(CashDoc.doc_type == "receive")
     q_pay  = db.session.query(func.coalesce(func.sum(CashDoc.amount), 0.0)).filter(CashDoc.doc_type == "payment")
     if active_ids:
@@ -1698,87 +2310,46 @@ def index():
     ]
 
     due_date_expr = func.coalesce(CashDoc.cheque_due_date, CashDoc.date)
-    upcoming_receive_cheques = (
-        CashDoc.query.filter(
-            CashDoc.doc_type == "receive",
-            func.lower(func.coalesce(CashDoc.method, "")) == "cheque",
-            due_date_expr >= today,
-            due_date_expr <= horizon,
-        )
-        .order_by(due_date_expr.asc())
-        .all()
-    )
-
-    upcoming_payment_cheques = (
-        CashDoc.query.filter(
-            CashDoc.doc_type == "payment",
-            func.lower(func.coalesce(CashDoc.method, "")) == "cheque",
-            due_date_expr >= today,
-            due_date_expr <= horizon,
+    def upcoming_cheques(doc_type: str):
+        # فقط ستون‌های لازم؛ بدون ساخت شیء ORM و بارگذاری روابط
+        rows = (
+            db.session.query(
+                CashDoc.id,
+                CashDoc.number,
+                CashDoc.amount,
+                due_date_expr.label("due_date"),
+                CashDoc.cheque_number,
+                Entity.name.label("person_name"),
+            )
+            .outerjoin(Entity, CashDoc.person_id == Entity.id)
+            .filter(
+                CashDoc.doc_type == doc_type,
+                _CASHDOC_IS_CHEQUE,
+                due_date_expr >= today,
+                due_date_expr <= horizon,
+            )
+            .order_by(due_date_expr.asc())
+            .all()
         )
-        .order_by(due_date_expr.asc())
-        .all()
-    )
-
-    def cheque_to_dict(doc: CashDoc):
-        due_dt = doc.cheque_due_date or doc.date
-        return {
-            "id": doc.id,
-            "number": doc.number,
-            "person": doc.person.name if doc.person else "—",
-            "amount": float(doc.amount or 0.0),
-            "date": to_jdate_str(due_dt) if due_dt else "—",
-            "cheque_number": doc.cheque_number,
-        }
+        return [
+            {
+                "id": r.id,
+                "number": r.number,
+                "person": r.person_name or "—",
+                "amount": float(r.amount or 0.0),
+                "date": to_jdate_str(r.due_date) if r.due_date else "—",
+                "cheque_number": r.cheque_number,
+            }
+            for r in rows
+        ]
 
     chart_days = [today - timedelta(days=i) for i in range(6, -1, -1)]
     chart_labels = [to_jdate_str(d) for d in chart_days]
 
-    # build per-day sales and purchase totals and invoice counts
-    inv_rows = (
-        db.session.query(Invoice.date, Invoice.kind, func.coalesce(Invoice.total, 0.0))
-        .filter(Invoice.date >= chart_days[0], Invoice.date <= today)
-        .all()
-    )
-    sales_total_map = {}
-    purchase_total_map = {}
-    sales_count_map = {}
-    for dt, kind, total in inv_rows:
-        try:
-            total_val = float(total or 0.0)
-        except Exception:
-            total_val = 0.0
-        if (kind or '') == 'sales':
-            sales_total_map[dt] = float(sales_total_map.get(dt, 0.0) + total_val)
-            sales_count_map[dt] = int(sales_count_map.get(dt, 0) + 1)
-        else:
-            purchase_total_map[dt] = float(purchase_total_map.get(dt, 0.0) + total_val)
-
-    cash_rows = (
-        db.session.query(
-            CashDoc.date,
-            CashDoc.doc_type,
-            func.coalesce(func.sum(CashDoc.amount), 0.0),
-        )
-        .filter(CashDoc.date >= chart_days[0], CashDoc.date <= today)
-        .group_by(CashDoc.date, CashDoc.doc_type)
-        .order_by(CashDoc.date)
-        .all()
-    )
-    receive_map = {}
-    payment_map = {}
-    for dt, doc_type, total in cash_rows:
-        total_val = float(total or 0.0)
-        if doc_type == "receive":
-            receive_map[dt] = total_val
-        elif doc_type == "payment":
-            payment_map[dt] = total_val
-
-    chart_sales_totals = [sales_total_map.get(day, 0.0) for day in chart_days]
-    chart_purchase_totals = [purchase_total_map.get(day, 0.0) for day in chart_days]
-    chart_invoice_counts = [sales_count_map.get(day, 0) for day in chart_days]
-    chart_receives_totals = [receive_map.get(day, 0.0) for day in chart_days]
-    chart_payments_totals = [payment_map.get(day, 0.0) for day in chart_days]
+    # آخرین idها تغییر داده را نشان می‌دهند؛ بازهٔ ۳۰ ثانیه‌ای ویرایش‌های درجا را هم پوشش می‌دهد
+    max_inv = db.session.query(func.max(Invoice.id)).scalar()
+    max_cd = db.session.query(func.max(CashDoc.id)).scalar()
+    charts = _chart_payload(tuple(chart_days), max_inv, max_cd, int(time.time() // CHART_CACHE_SECONDS))
 
     return render_template(
         "dashboard.html",
@@ -1794,18 +2365,18 @@ def index():
             "net_cash": today_receives_total - today_payments_total,
         },
         cash_balances=method_balances,
-        incoming_cheques=[cheque_to_dict(doc) for doc in upcoming_receive_cheques],
-        outgoing_cheques=[cheque_to_dict(doc) for doc in upcoming_payment_cheques],
+        incoming_cheques=upcoming_cheques("receive"),
+        outgoing_cheques=upcoming_cheques("payment"),
         chart_data={
             "labels": chart_labels,
-            "salesTotals": chart_sales_totals,
-            "purchaseTotals": chart_purchase_totals,
-            "invoiceCounts": chart_invoice_counts,
-            "receivesTotals": chart_receives_totals,
-            "paymentsTotals": chart_payments_totals,
+            "salesTotals": charts["sales_totals"],
+            "purchaseTotals": charts["purchase_totals"],
+            "invoiceCounts": charts["invoice_counts"],
+            "receivesTotals": charts["receives_totals"],
+            "paymentsTotals": charts["payments_totals"],
         },
         dashboard_widgets=_dashboard_widgets(),
-        assistant_model_label=dict(ASSISTANT_MODEL_CHOICES).get(_assistant_model(), _assistant_model()),
+        assistant_model_label=ASSISTANT_MODEL_LABELS.get(_assistant_model(), _assistant_model()),
         api_ready=bool(_openai_api_key()) and OpenAI is not None,
     )
 
@@ -1830,7 +2401,7 @@ def login():
                     is_active=entry.get("is_active", True),
                 )
             )
-            session["login_at_utc"] = datetime.utcnow().isoformat()
+            session["login_at_utc"] = int(time.time())
             flash("ورود موفق", "success")
             app.logger.info(f"LOGIN  USER={username}  IP={request.remote_addr}")
             return redirect(URL_PREFIX + "/")
@@ -1847,6 +2418,85 @@ def logout():
     return redirect(URL_PREFIX + "/login")
 
 # ----------------- Developer console -----------------
+def _script_add_entity(e_type: str, unit: str, label: str, parts: list) -> str:
+    code = parts[1]
+    name = " ".join(parts[2:]).strip().strip('"').strip("'")
+    form = {"type":e_type,"code":code,"name":name,"unit":unit,"serial_no":code}
+    errs, data = validate_entity_form(form)
+    if errs:
+        return "خطا: " + " | ".join(errs)
+    ent = Entity(
+        type=data["e_type"], code=data["code"], name=data["name"],
+        unit=data["unit"], serial_no=data["serial"] or data["code"],
+        parent_id=(data["parent"].id if data["parent"] else None),
+        level=data["level"]
+    )
+    db.session.add(ent); db.session.flush()
+    return f"ثبت شد: {label} {code} - {name}"
+
+def _cmd_add_item(parts: list) -> str:
+    return _script_add_entity("item", "عدد", "کالا", parts)
+
+def _cmd_add_person(parts: list) -> str:
+    return _script_add_entity("person", "شرکت", "شخص", parts)
+
+def _cmd_rename(parts: list) -> str:
+    etype = parts[1].lower()
+    code  = parts[2]
+    new_name = " ".join(parts[3:]).strip().strip('"').strip("'")
+    ent = Entity.query.filter_by(type=etype, code=code).first()
+    if not ent:
+        return "یافت نشد."
+    ent.name = new_name
+    return "نام تغییر کرد."
+
+def _cmd_delete(parts: list) -> str:
+    etype = parts[1].lower()
+    code  = parts[2]
+    ent = Entity.query.filter_by(type=etype, code=code).first()
+    if not ent:
+        return "یافت نشد."
+    db.session.delete(ent); db.session.flush()
+    return "حذف شد."
+
+def _cmd_seed_items(parts: list) -> str:
+    p1 = Entity.query.filter_by(type="item", code="101").first()
+    p2 = Entity.query.filter_by(type="item", code="101001").first()
+    p3 = Entity.query.filter_by(type="item", code="101001001").first()
+    if not p1:
+        p1 = Entity(type="item", code="101", name="لپتاپ", level=1)
+    if not p2:
+        p2 = Entity(type="item", code="101001", name="لپتاپ اچ‌پی", level=2, parent=p1)
+    if not p3:
+        p3 = Entity(type="item", code="101001001", name="HP 650", level=3, parent=p2)
+    db.session.add_all([p1, p2, p3])
+    db.session.flush()
+    return "نمونه کدینگ کالا ثبت شد."
+
+def _cmd_seed_accounts(parts: list) -> str:
+    root = parts[1]
+    title = " ".join(parts[2:]).strip().strip('"').strip("'") or "حساب ریشه"
+    if not root.isdigit() or len(root) not in (3,6,9):
+        return "کد ریشه نامعتبر است."
+    if not Account.query.filter_by(code=root).first():
+        db.session.add(Account(code=root, name=title, level={3:1,6:2,9:3}[len(root)], locked=True))
+    if root == "990":
+        s1 = root + "001"
+        if not Account.query.filter_by(code=s1).first():
+            par = Account.query.filter_by(code=root).first()
+            db.session.add(Account(code=s1, name="حقوق", level=2, parent=par, locked=True))
+    db.session.flush()
+    return "کدینگ حسابداری ثبت/به‌روزرسانی شد."
+
+_SCRIPT_DISPATCH = {
+    "ADD_ITEM": _cmd_add_item,
+    "ADD_PERSON": _cmd_add_person,
+    "RENAME": _cmd_rename,
+    "DELETE": _cmd_delete,
+    "SEED_ITEMS": _cmd_seed_items,
+    "SEED_ACCOUNTS": _cmd_seed_accounts,
+}
+
 def _run_script_lines(lines:list[str]):
     msgs = []
     for raw in lines:
@@ -1855,93 +2505,16 @@ def _run_script_lines(lines:list[str]):
             continue
         parts = line.split()
         cmd = parts[0].upper()
-        if cmd not in ALLOWED_CMDS:
+        handler = _SCRIPT_DISPATCH.get(cmd) if cmd in ALLOWED_CMDS else None
+        if handler is None:
             msgs.append(f"رد شد: دستور نامجاز {cmd}")
             continue
+        # هر خط جدا commit می‌شود؛ خطا فقط همان خط را برمی‌گرداند
         try:
-            if cmd == "ADD_ITEM":
-                code = parts[1]
-                name = " ".join(parts[2:]).strip().strip('"').strip("'")
-                form = {"type":"item","code":code,"name":name,"unit":"عدد","serial_no":code}
-                errs, data = validate_entity_form(form)
-                if errs:
-                    msgs.append("خطا: " + " | ".join(errs))
-                else:
-                    ent = Entity(
-                        type=data["e_type"], code=data["code"], name=data["name"],
-                        unit=data["unit"], serial_no=data["serial"] or data["code"],
-                        parent_id=(data["parent"].id if data["parent"] else None),
-                        level=data["level"]
-                    )
-                    db.session.add(ent); db.session.commit()
-                    msgs.append(f"ثبت شد: کالا {code} - {name}")
-
-            elif cmd == "ADD_PERSON":
-                code = parts[1]
-                name = " ".join(parts[2:]).strip().strip('"').strip("'")
-                form = {"type":"person","code":code,"name":name,"unit":"شرکت","serial_no":code}
-                errs, data = validate_entity_form(form)
-                if errs:
-                    msgs.append("خطا: " + " | ".join(errs))
-                else:
-                    ent = Entity(
-                        type=data["e_type"], code=data["code"], name=data["name"],
-                        unit=data["unit"], serial_no=data["serial"] or data["code"],
-                        parent_id=(data["parent"].id if data["parent"] else None),
-                        level=data["level"]
-                    )
-                    db.session.add(ent); db.session.commit()
-                    msgs.append(f"ثبت شد: شخص {code} - {name}")
-
-            elif cmd == "RENAME":
-                etype = parts[1].lower()
-                code  = parts[2]
-                new_name = " ".join(parts[3:]).strip().strip('"').strip("'")
-                ent = Entity.query.filter_by(type=etype, code=code).first()
-                if not ent:
-                    msgs.append("یافت نشد.")
-                else:
-                    ent.name = new_name
-                    db.session.commit()
-                    msgs.append("نام تغییر کرد.")
-
-            elif cmd == "DELETE":
-                etype = parts[1].lower()
-                code  = parts[2]
-                ent = Entity.query.filter_by(type=etype, code=code).first()
-                if not ent:
-                    msgs.append("یافت نشد.")
-                else:
-                    db.session.delete(ent); db.session.commit()
-                    msgs.append("حذف شد.")
-
-            elif cmd == "SEED_ITEMS":
-                if not Entity.query.filter_by(type="item", code="101").first():
-                    db.session.add(Entity(type="item", code="101", name="لپتاپ", level=1)); db.session.commit()
-                p1 = Entity.query.filter_by(type="item", code="101").first()
-                if not Entity.query.filter_by(type="item", code="101001").first():
-                    db.session.add(Entity(type="item", code="101001", name="لپتاپ اچ‌پی", level=2, parent_id=p1.id)); db.session.commit()
-                p2 = Entity.query.filter_by(type="item", code="101001").first()
-                if not Entity.query.filter_by(type="item", code="101001001").first():
-                    db.session.add(Entity(type="item", code="101001001", name="HP 650", level=3, parent_id=p2.id)); db.session.commit()
-                msgs.append("نمونه کدینگ کالا ثبت شد.")
-
-            elif cmd == "SEED_ACCOUNTS":
-                root = parts[1]
-                title = " ".join(parts[2:]).strip().strip('"').strip("'") or "حساب ریشه"
-                if not root.isdigit() or len(root) not in (3,6,9):
-                    msgs.append("کد ریشه نامعتبر است.")
-                else:
-                    if not Account.query.filter_by(code=root).first():
-                        db.session.add(Account(code=root, name=title, level={3:1,6:2,9:3}[len(root)], locked=True))
-                    if root == "990":
-                        s1 = root + "001"
-                        if not Account.query.filter_by(code=s1).first():
-                            par = Account.query.filter_by(code=root).first()
-                            db.session.add(Account(code=s1, name="حقوق", level=2, parent=par, locked=True))
-                    db.session.commit()
-                    msgs.append("کدینگ حسابداری ثبت/به‌روزرسانی شد.")
+            msgs.append(handler(parts))
+            db.session.commit()
         except Exception as ex:
+            db.session.rollback()
             msgs.append(f"خطا در اجرای دستور «{line}»: {ex}")
     return msgs
 
@@ -1958,6 +2531,18 @@ def developer_console():
     return render_template("developer.html", prefix=URL_PREFIX)
 
 # ----------------- Unified Invoice (Sales & Purchase) -----------------
+def _purchase_seq(number: Optional[str]) -> Optional[int]:
+    """Numeric value of a purchase invoice number, or None unless it is all (Persian/Arabic/Latin) digits."""
+    s = (number or "").strip()
+    return int(s) if s.isdecimal() else None
+
+
+def _next_purchase_number() -> str:
+    # شماره‌ها در پایتون تفسیر می‌شوند تا SQLite و سایر پایگاه‌ها یک تعریف مشترک داشته باشند
+    seqs = (_purchase_seq(num) for (num,) in db.session.query(Invoice.number).filter(Invoice.kind == "purchase"))
+    top = max((n for n in seqs if n is not None), default=None)
+    return str(top + 1) if top is not None else "1"
+
 @app.route(URL_PREFIX + "/invoice", methods=["GET", "POST"])
 @app.route(URL_PREFIX + "/sales", methods=["GET", "POST"])  # backward compatibility
 @app.route(URL_PREFIX + "/purchase", methods=["GET", "POST"])  # backward compatibility
@@ -1974,23 +2559,11 @@ def unified_invoice():
     else:
         ensure_permission("purchase")
     
-    now_info = _now_info()
-    
-    # Generate invoice number
-    if kind == "sales":
-        inv_number_generated = jalali_reference("INV", now_info["datetime"])
-    else:
-        # Purchase number logic
-        nums = []
-        for (num,) in db.session.query(Invoice.number).filter(Invoice.kind == "purchase").all():
-            s = (num or "").strip()
-            if s.isdigit():
-                try:
-                    nums.append(int(s))
-                except:
-                    pass
-        inv_number_generated = str(max(nums) + 1) if nums else "1"
-    
+    def generated_number(now_dt: Optional[datetime] = None) -> str:
+        if kind == "sales":
+            return jalali_reference("INV", now_dt or _now_info()["datetime"])
+        return _next_purchase_number()
+
     allow_negative = _allow_negative_sales()
 
     if request.method == "POST":
@@ -1999,17 +2572,18 @@ def unified_invoice():
         if form_kind not in ("sales", "purchase"):
             form_kind = kind
         
-        number = (request.form.get("inv_number") or "").strip() or inv_number_generated
+        # شمارهٔ خودکار فقط وقتی فرم شماره نداشته باشد ساخته می‌شود
+        number = (request.form.get("inv_number") or "").strip() or generated_number()
         inv_date = parse_gregorian_date(request.form.get("inv_date_greg"))
 
         person = None
         pid = (request.form.get("person_token") or "").strip()
         if pid.isdigit():
-            person = Entity.query.get(int(pid))
+            person = db.session.get(Entity, int(pid))
         if not person:
             pcode = (request.form.get("person_code") or "").strip()
             if pcode:
-                person = Entity.query.filter_by(type="person", code=pcode).first()
+                person = _entity_by_code("person", pcode)
         if not person or person.type != "person":
             person_label = "مشتری" if form_kind == "sales" else "تأمین‌کننده"
             flash(f"لطفاً {person_label} معتبر انتخاب کنید.", "danger")
@@ -2020,35 +2594,43 @@ def unified_invoice():
         unit_prices = request.form.getlist("unit_price[]")
         qtys        = request.form.getlist("qty[]")
 
+        # کالاهای همهٔ ردیف‌ها با دو کوئری (بر اساس id و کد) بارگذاری می‌شوند
+        numeric_ids = {int(x) for x in (v.strip() for v in item_ids) if x.isdigit()}
+        codes = {c for c in (v.strip() for v in item_codes) if c}
+        by_id = {e.id: e for e in Entity.query.filter(Entity.id.in_(numeric_ids)).all()} if numeric_ids else {}
+        by_code = {e.code: e for e in Entity.query.filter(Entity.type == "item", Entity.code.in_(codes)).all()} if codes else {}
+
         rows = []
         MAX_ROWS = 15
         pending_stock = {}
-        for i in range(min(len(item_ids), len(unit_prices), len(qtys))):
-            iid = (item_ids[i] or "").strip()
-            icode= (item_codes[i] or "").strip()
-            up   = _to_float(unit_prices[i], 0.0)
-            q    = _to_float(qtys[i], 0.0)
+        # lookups used per row bound to locals
+        to_float = _to_float
+        by_id_get = by_id.get
+        by_code_get = by_code.get
+        rows_append = rows.append
+        for iid, icode, up_raw, q_raw in islice(zip(item_ids, item_codes, unit_prices, qtys), MAX_ROWS):
+            iid  = (iid or "").strip()
+            icode= (icode or "").strip()
+            up   = to_float(up_raw, 0.0)
+            q    = to_float(q_raw, 0.0)
 
             item = None
             if iid.isdigit():
-                item = Entity.query.get(int(iid))
+                item = by_id_get(int(iid))
             if (not item) and icode:
-                item = Entity.query.filter_by(type="item", code=icode).first()
+                item = by_code_get(icode)
 
             if (item is not None) and item.type == "item" and q > 0 and up >= 0:
-                # Stock check only for sales
-                if form_kind == "sales" and not allow_negative:
-                    base_stock = float(pending_stock.get(item.id, item.stock_qty or 0.0))
-                    if base_stock - q < -1e-6:
+                # Stock check only for sales; stock_qty is read once per distinct item
+                if form_kind == "sales":
+                    base_stock = pending_stock.get(item.id)
+                    if base_stock is None:
+                        base_stock = float(item.stock_qty or 0.0)
+                    if not allow_negative and base_stock - q < -1e-6:
                         flash(f"موجودی کالا «{item.name}» برای فروش کافی نیست.", "danger")
                         return redirect(URL_PREFIX + f"/invoice?kind={form_kind}")
                     pending_stock[item.id] = base_stock - q
-                elif form_kind == "sales":
-                    current = float(pending_stock.get(item.id, item.stock_qty or 0.0))
-                    pending_stock[item.id] = current - q
-                rows.append({"item": item, "unit_price": up, "qty": q})
-            if len(rows) >= MAX_ROWS:
-                break
+                rows_append({"item": item, "unit_price": up, "qty": q})
 
         if not rows:
             flash("لطفاً حداقل یک ردیف کالای معتبر با تعداد وارد کنید.", "danger")
@@ -2063,9 +2645,6 @@ def unified_invoice():
             flash("جمع کل فاکتور باید بزرگ‌تر از صفر باشد.", "danger")
             return redirect(URL_PREFIX + f"/invoice?kind={form_kind}")
 
-        if Invoice.query.filter_by(number=number).first():
-            number = generate_invoice_number()
-
         inv = Invoice(
             number=number,
             date=inv_date,
@@ -2075,22 +2654,33 @@ def unified_invoice():
             tax=tax,
             total=total,
         )
-        db.session.add(inv)
-        db.session.flush()
+        _add_invoice_unique(inv)
+
+        price_rows = {
+            ph.item_id: ph
+            for ph in PriceHistory.query.filter(
+                PriceHistory.person_id == person.id,
+                PriceHistory.item_id.in_({r["item"].id for r in rows}),
+            ).all()
+        }
 
+        # ردیف‌ها با یک executemany درج می‌شوند (InvoiceLine رویداد before_insert ندارد)
+        db.session.bulk_insert_mappings(InvoiceLine, [
+            {
+                "invoice_id": inv.id,
+                "item_id": r["item"].id,
+                "qty": float(r["qty"]),
+                "unit_price": float(r["unit_price"]),
+                "line_total": float(r["qty"]) * float(r["unit_price"]),
+            }
+            for r in rows
+        ])
+
+        new_prices: Dict[int, float] = {}
         for r in rows:
             item = r["item"]
             qty  = float(r["qty"])
             up   = float(r["unit_price"])
-            line_total = qty * up
-
-            db.session.add(InvoiceLine(
-                invoice_id=inv.id,
-                item_id=item.id,
-                qty=qty,
-                unit_price=up,
-                line_total=line_total
-            ))
 
             # Update stock: sales decreases, purchase increases
             if form_kind == "sales":
@@ -2104,27 +2694,40 @@ def unified_invoice():
                 except Exception:
                     item.stock_qty = 0.0 + qty
 
-            ph = PriceHistory.query.filter_by(person_id=person.id, item_id=item.id).first()
-            if not ph:
-                ph = PriceHistory(person_id=person.id, item_id=item.id, last_price=up)
-                db.session.add(ph)
-            else:
+            ph = price_rows.get(item.id)
+            if ph:
                 ph.last_price = up
+            else:
+                new_prices[item.id] = up
+
+        if new_prices:
+            db.session.bulk_insert_mappings(PriceHistory, [
+                {"person_id": person.id, "item_id": iid, "last_price": price}
+                for iid, price in new_prices.items()
+            ])
+        _invalidate_read_caches()
 
         # Update person balance: sales increases balance (customer owes), purchase decreases (we owe vendor)
-        if form_kind == "sales":
-            try:
-                person.balance = float(person.balance or 0.0) + float(total)
-            except Exception:
-                person.balance = float(total)
-        else:  # purchase
-            try:
-                person.balance = float(person.balance or 0.0) - float(total)
-            except Exception:
-                person.balance = -float(total)
+        _adjust_balance(person, float(total) if form_kind == "sales" else -float(total))
 
         db.session.commit()
 
+        # record ledger entry for invoice created via UI
+        try:
+            record_ledger("invoice", inv.id, "create", {
+                "invoice_id": inv.id,
+                "number": inv.number,
+                "kind": inv.kind,
+                "total": float(inv.total or 0.0),
+                "person_id": person.id,
+                "lines": [
+                    {"item_id": int(r["item"].id), "qty": float(r["qty"]), "unit_price": float(r["unit_price"])}
+                    for r in rows
+                ],
+            })
+        except Exception:
+            app.logger.exception("failed to write invoice ledger entry (ui)")
+
         action_label = "فروش" if form_kind == "sales" else "خرید"
         flash(
             f"✅ فاکتور {action_label} «{inv.number}» ثبت شد برای «{person.name}» — {amount_to_toman_words(total)}",
@@ -2137,10 +2740,11 @@ def unified_invoice():
         else:
             return redirect(URL_PREFIX + f"/payment?invoice_id={inv.id}")
 
+    now_info = _now_info()
     return render_template(
         "invoice.html",
         prefix=URL_PREFIX,
-        inv_number=inv_number_generated,
+        inv_number=generated_number(now_info["datetime"]),
         current_jdate=now_info["jalali_date"],
         current_gdate=now_info["greg_date"],
         invoice_kind=kind,
@@ -2169,15 +2773,21 @@ def entities_list():
     base = Entity.query.filter_by(type=kind)
 
     if q:
-        starts = base.filter(or_(Entity.code.ilike(f"{q}%"), Entity.name.ilike(f"{q}%")))
-        contains = base.filter(or_(Entity.code.ilike(f"%{q}%"), Entity.name.ilike(f"%{q}%")))
-        rows = list(starts.order_by(Entity.level.asc(), Entity.code.asc()).all())
-        seen = {r.id for r in rows}
-        for e in contains.order_by(Entity.level.asc(), Entity.code.asc()).all():
-            if e.id not in seen:
-                rows.append(e); seen.add(e.id)
+        # یک کوئری: تطابق‌های پیشوندی اول، سپس بقیهٔ تطابق‌ها
+        prefix, contains = f"{q}%", f"%{q}%"
+        rank = case((or_(Entity.code.ilike(prefix), Entity.name.ilike(prefix)), 0), else_=1)
+        base = base.filter(or_(Entity.code.ilike(contains), Entity.name.ilike(contains)))
+        ordered = base.order_by(rank, Entity.level.asc(), Entity.code.asc())
     else:
-        rows = base.order_by(Entity.level.asc(), Entity.code.asc()).all()
+        ordered = base.order_by(Entity.level.asc(), Entity.code.asc())
+
+    # Pagination
+    total_count = base.count()
+    start = (page - 1) * per_page
+    end = start + per_page
+    rows = ordered.offset(start).limit(per_page).all()
+    has_prev = page > 1
+    has_next = end < total_count
 
     # Enrich with last prices and stock/balance
     enriched = []
@@ -2207,14 +2817,7 @@ def entities_list():
             item["balance"] = float(e.balance or 0.0)
             item["status"] = "بستانکار" if item["balance"] >= 0 else "بدهکار"
         enriched.append(item)
-
-    # Pagination
-    total_count = len(enriched)
-    start = (page - 1) * per_page
-    end = start + per_page
-    page_rows = enriched[start:end]
-    has_prev = page > 1
-    has_next = end < total_count
+    page_rows = enriched
 
     return render_template(
         "entities/list.html",
@@ -2252,8 +2855,8 @@ def entities_new():
         flash("ثبت شد.", "success")
         return redirect(URL_PREFIX + f"/entities?kind={ent.type}")
 
-    parents_lvl1 = Entity.query.filter_by(level=1).order_by(Entity.code.asc()).all()
-    parents_lvl2 = Entity.query.filter_by(level=2).order_by(Entity.code.asc()).all()
+    parents_lvl1 = _parents_by_level(1)
+    parents_lvl2 = _parents_by_level(2)
     # suggest next codes for both types so the template can prefill accordingly
     suggested_person_code = _suggest_next_entity_code("person")
     suggested_item_code = _suggest_next_entity_code("item")
@@ -2288,8 +2891,8 @@ def entities_edit(eid):
         flash("ویرایش شد.", "success")
         return redirect(URL_PREFIX + f"/entities?kind={ent.type}")
 
-    parents_lvl1 = Entity.query.filter_by(level=1).order_by(Entity.code.asc()).all()
-    parents_lvl2 = Entity.query.filter_by(level=2).order_by(Entity.code.asc()).all()
+    parents_lvl1 = _parents_by_level(1)
+    parents_lvl2 = _parents_by_level(2)
     return render_template("entities/edit.html", ent=ent, parents_lvl1=parents_lvl1, parents_lvl2=parents_lvl2, prefix=URL_PREFIX)
 
 @app.route(URL_PREFIX + "/entities/<int:eid>/delete", methods=["POST"])
@@ -2349,109 +2952,152 @@ def reports():
     except Exception:
         amount_max = None
 
-    rows = []
     totals = {"sales": 0.0, "purchase": 0.0, "receive": 0.0, "payment": 0.0}
 
+    # فاکتورها و اسناد نقدی در یک UNION ALL؛ مرتب‌سازی، صفحه‌بندی و جمع‌ها در SQL انجام می‌شود
+    selects = []
+
     # Invoices (sales/purchase)
     if typ in ("all", "invoice", "sales", "purchase"):
-        inv_q = db.session.query(Invoice).join(Entity, Invoice.person_id == Entity.id)
+        # Use explicit kind when available, otherwise infer from the number prefix
+        inv_kind = func.coalesce(
+            func.nullif(Invoice.kind, ""),
+            case((func.upper(Invoice.number).like("INV-%"), "sales"), else_="purchase"),
+        )
+        inv_amount = func.coalesce(Invoice.total, 0.0)
+        inv_sel = (
+            select(
+                literal("invoice").label("kind"),
+                Invoice.id.label("id"),
+                Invoice.number.label("number"),
+                Invoice.date.label("date_key"),
+                Entity.name.label("person"),
+                inv_amount.label("amount"),
+                inv_kind.label("invoice_kind"),
+                inv_kind.label("total_key"),
+                func.coalesce(Entity.balance, 0.0).label("person_balance"),
+                literal(None, CashDoc.cheque_number.type).label("cheque_number"),
+                literal(None, CashDoc.method.type).label("method"),
+                literal(None, CashBox.name.type).label("cashbox"),
+                literal(None, CashDoc.cheque_due_date.type).label("cheque_due_date"),
+            )
+            .select_from(Invoice)
+            .join(Entity, Invoice.person_id == Entity.id)
+        )
         if q:
-            inv_q = inv_q.filter(or_(
+            inv_sel = inv_sel.where(or_(
                 Invoice.number.ilike(f"%{q}%"),
                 Entity.name.ilike(f"%{q}%"),
                 Entity.code.ilike(f"%{q}%"),
             ))
         if person_filter and person_filter.isdigit():
-            inv_q = inv_q.filter(Invoice.person_id == int(person_filter))
+            inv_sel = inv_sel.where(Invoice.person_id == int(person_filter))
         if item_filter and item_filter.isdigit():
-            inv_q = inv_q.join(InvoiceLine, Invoice.id == InvoiceLine.invoice_id).filter(InvoiceLine.item_id == int(item_filter))
-        if df: inv_q = inv_q.filter(Invoice.date >= df)
-        if dt: inv_q = inv_q.filter(Invoice.date <= dt)
-        # Use explicit kind when available
+            inv_sel = inv_sel.where(Invoice.id.in_(
+                select(InvoiceLine.invoice_id).where(InvoiceLine.item_id == int(item_filter))
+            ))
+        if df: inv_sel = inv_sel.where(Invoice.date >= df)
+        if dt: inv_sel = inv_sel.where(Invoice.date <= dt)
         if typ == "sales":
-            inv_q = inv_q.filter(Invoice.kind == 'sales')
+            inv_sel = inv_sel.where(Invoice.kind == 'sales')
         elif typ == "purchase":
-            inv_q = inv_q.filter(Invoice.kind == 'purchase')
-
-        for inv in inv_q.order_by(Invoice.id.desc()).all():
-            kind = inv.kind or ("sales" if (inv.number or "").upper().startswith("INV-") else "purchase")
-            amt = float(inv.total or 0.0)
-            if amount_min is not None and amt < amount_min: 
-                continue
-            if amount_max is not None and amt > amount_max:
-                continue
-            totals[kind] += amt
-            rows.append({
-                "kind": "invoice",
-                "id": inv.id,
-                "number": inv.number,
-                "date": to_jdate_str(inv.date),
-                "date_key": inv.date,
-                "person": inv.person.name,
-                "amount": amt,
-                "invoice_kind": kind,
-                "person_balance": float(inv.person.balance or 0.0) if inv.person else None,
-            })
+            inv_sel = inv_sel.where(Invoice.kind == 'purchase')
+        if amount_min is not None:
+            inv_sel = inv_sel.where(inv_amount >= amount_min)
+        if amount_max is not None:
+            inv_sel = inv_sel.where(inv_amount <= amount_max)
+        selects.append(inv_sel)
 
     # Cash documents
     if typ in ("all", "receive", "payment", "cheque"):
-        cd_q = db.session.query(CashDoc).join(Entity, CashDoc.person_id == Entity.id)
+        cd_amount = func.coalesce(CashDoc.amount, 0.0)
+        cd_sel = (
+            select(
+                CashDoc.doc_type.label("kind"),
+                CashDoc.id.label("id"),
+                CashDoc.number.label("number"),
+                CashDoc.date.label("date_key"),
+                Entity.name.label("person"),
+                cd_amount.label("amount"),
+                literal(None, Invoice.kind.type).label("invoice_kind"),
+                CashDoc.doc_type.label("total_key"),
+                literal(None, Entity.balance.type).label("person_balance"),
+                CashDoc.cheque_number.label("cheque_number"),
+                CashDoc.method.label("method"),
+                CashBox.name.label("cashbox"),
+                CashDoc.cheque_due_date.label("cheque_due_date"),
+            )
+            .select_from(CashDoc)
+            .join(Entity, CashDoc.person_id == Entity.id)
+            .outerjoin(CashBox, CashDoc.cashbox_id == CashBox.id)
+        )
         if typ in ("receive", "payment"):
-            cd_q = cd_q.filter(CashDoc.doc_type == typ)
+            cd_sel = cd_sel.where(CashDoc.doc_type == typ)
         if typ == "cheque":
-            cd_q = cd_q.filter(func.lower(func.coalesce(CashDoc.method, "")) == "cheque")
+            cd_sel = cd_sel.where(_CASHDOC_IS_CHEQUE)
         if q:
-            cd_q = cd_q.filter(or_(
+            cd_sel = cd_sel.where(or_(
                 CashDoc.number.ilike(f"%{q}%"),
                 Entity.name.ilike(f"%{q}%"),
                 Entity.code.ilike(f"%{q}%"),
                 CashDoc.cheque_number.ilike(f"%{q}%"),
             ))
-        if df: cd_q = cd_q.filter(CashDoc.date >= df)
-        if dt: cd_q = cd_q.filter(CashDoc.date <= dt)
+        if df: cd_sel = cd_sel.where(CashDoc.date >= df)
+        if dt: cd_sel = cd_sel.where(CashDoc.date <= dt)
         if method:
-            cd_q = cd_q.filter(func.lower(func.coalesce(CashDoc.method, "")) == method)
+            cd_sel = cd_sel.where(func.lower(func.coalesce(CashDoc.method, "")) == method)
         if cashbox_id and cashbox_id.isdigit():
-            cd_q = cd_q.filter(CashDoc.cashbox_id == int(cashbox_id))
-
-        for d in cd_q.order_by(CashDoc.id.desc()).all():
-            amt = float(d.amount or 0.0)
-            if amount_min is not None and amt < amount_min: 
-                continue
-            if amount_max is not None and amt > amount_max:
-                continue
-            totals[d.doc_type] += amt
-            rows.append({
-                "kind": d.doc_type,
-                "id": d.id,
-                "number": d.number,
-                "date": to_jdate_str(d.date),
-                "date_key": d.date,
-                "person": d.person.name,
-                "amount": amt,
-                "cheque_number": d.cheque_number,
-                "method": d.method,
-                "cashbox": d.cashbox.name if d.cashbox else None,
-                "cheque_due": to_jdate_str(d.cheque_due_date) if d.cheque_due_date else None,
-            })
-
-    # Sort rows by date (gregorian) then id/number desc
-    rows.sort(key=lambda r: (r.get("date_key"), r.get("id", 0)), reverse=True)
+            cd_sel = cd_sel.where(CashDoc.cashbox_id == int(cashbox_id))
+        if amount_min is not None:
+            cd_sel = cd_sel.where(cd_amount >= amount_min)
+        if amount_max is not None:
+            cd_sel = cd_sel.where(cd_amount <= amount_max)
+        selects.append(cd_sel)
 
     # Pagination
-    total_count = len(rows)
     start = (page - 1) * per_page
     end = start + per_page
-    page_rows = rows[start:end]
+    total_count = 0
+    page_rows = []
+    if selects:
+        combined = (union_all(*selects) if len(selects) > 1 else selects[0]).subquery()
+        for key, amount_sum, count in db.session.execute(
+            select(combined.c.total_key, func.sum(combined.c.amount), func.count()).group_by(combined.c.total_key)
+        ):
+            totals[key] = totals.get(key, 0.0) + float(amount_sum or 0.0)
+            total_count += int(count or 0)
+
+        # Sort rows by date (gregorian) then id desc
+        page_q = (
+            select(combined)
+            .order_by(combined.c.date_key.desc(), combined.c.id.desc())
+            .limit(per_page)
+            .offset(start)
+        )
+        for r in db.session.execute(page_q).mappings():
+            row = {
+                "kind": r["kind"],
+                "id": r["id"],
+                "number": r["number"],
+                "date": to_jdate_str(r["date_key"]),
+                "date_key": r["date_key"],
+                "person": r["person"],
+                "amount": float(r["amount"] or 0.0),
+            }
+            if r["kind"] == "invoice":
+                row["invoice_kind"] = r["invoice_kind"]
+                row["person_balance"] = float(r["person_balance"] or 0.0)
+            else:
+                row["cheque_number"] = r["cheque_number"]
+                row["method"] = r["method"]
+                row["cashbox"] = r["cashbox"]
+                row["cheque_due"] = to_jdate_str(r["cheque_due_date"]) if r["cheque_due_date"] else None
+            page_rows.append(row)
     has_prev = page > 1
     has_next = end < total_count
 
     # Cashboxes for filter select
-    cashboxes = (
-        CashBox.query.filter_by(is_active=True)
-        .order_by(CashBox.kind.desc(), CashBox.name.asc())
-        .all()
-    )
+    cashboxes = _active_cashboxes()
 
     try:
         return render_template(
@@ -2493,7 +3139,7 @@ def reports():
             "</tr></thead><tbody>"
         ]
 
-        for r in rows:
+        for r in page_rows:
             label = {"invoice": "فاکتور فروش","receive": "دریافت","payment": "پرداخت"}.get(r["kind"], r["kind"])
             view = f"{URL_PREFIX}/invoice/{r['id']}" if r["kind"] == "invoice" else f"{URL_PREFIX}/cash/{r['id']}"
             edit = f"{view}/edit"
@@ -2522,541 +3168,134 @@ def reports():
 @login_required
 def invoice_view(inv_id):
     ensure_permission("reports", "sales", "purchase")
-    inv = Invoice.query.get_or_404(inv_id)
-    lines = InvoiceLine.query.filter_by(invoice_id=inv.id).all()
-    html = [
-        f"<b>شماره:</b> {inv.number}",
-        f"<br><b>تاریخ (شمسی):</b> { to_jdate_str(inv.date) }",
-        f"<br><b>مشتری:</b> {inv.person.name}",
-        f"<br><b>جمع:</b> {int(inv.total):,}",
-        "<hr><b>آیتم‌ها:</b>",
-        "<ul>" + "".join([f"<li>{ln.item.name} | {ln.qty} × {ln.unit_price} = {ln.line_total}</li>" for ln in lines]) + "</ul>"
-    ]
-    return render_template("page.html", title="فاکتور فروش", content=Markup("".join(html)), prefix=URL_PREFIX)
+    # person/item are joined-eager already; skip their self-joined Entity.parent, which the view never shows
+    inv = Invoice.query.options(joinedload(Invoice.person).lazyload(Entity.parent)).get_or_404(inv_id)
+    lines = (
+        InvoiceLine.query.options(joinedload(InvoiceLine.item).lazyload(Entity.parent))
+        .filter_by(invoice_id=inv.id)
+        .all()
+    )
+    return render_template("invoice_view.html", title="فاکتور فروش", inv=inv, lines=lines, prefix=URL_PREFIX)
 
 @app.route(URL_PREFIX + "/cash/<int:doc_id>")
 @login_required
 def cash_view(doc_id):
     ensure_permission("reports", "receive", "payment")
     doc = CashDoc.query.get_or_404(doc_id)
-    kind = "دریافت" if doc.doc_type == "receive" else "پرداخت"
-    cheque_meta = ""
-    if (doc.method or "").lower() == "cheque":
-        cheque_parts = []
-        if doc.cheque_number:
-            cheque_parts.append(f"شماره صیادی: <code>{doc.cheque_number}</code>")
-        if doc.cheque_bank:
-            cheque_parts.append(f"بانک: {doc.cheque_bank}")
-        if doc.cheque_branch:
-            cheque_parts.append(f"شعبه: {doc.cheque_branch}")
-        if doc.cheque_due_date:
-            cheque_parts.append(f"سررسید: {to_jdate_str(doc.cheque_due_date)}")
-        if doc.cheque_account:
-            cheque_parts.append(f"شماره حساب: {doc.cheque_account}")
-        if doc.cheque_owner:
-            cheque_parts.append(f"صاحب حساب: {doc.cheque_owner}")
-        if cheque_parts:
-            cheque_meta = "<br><b>جزئیات چک:</b> " + "<br>".join(cheque_parts)
-    cashbox_line = ""
-    if doc.cashbox:
-        box_label = doc.cashbox.name
-        if doc.cashbox.kind == "bank" and doc.cashbox.bank_name:
-            box_label += f" ({doc.cashbox.bank_name})"
-        cashbox_line = f"<br><b>صندوق/حساب:</b> {box_label}"
-    html = (
-        f"<b>نوع:</b> {kind}<br><b>شماره:</b> {doc.number}"
-        f"<br><b>تاریخ (شمسی):</b> {to_jdate_str(doc.date)}"
-        f"<br><b>طرف حساب:</b> {doc.person.name}"
-        f"<br><b>مبلغ:</b> {int(doc.amount):,}"
-        f"<br><b>روش:</b> {CASH_METHOD_LABELS.get(doc.method or '', doc.method or '—')}"
-        + cashbox_line
-        + cheque_meta
-    )
-    return render_template("page.html", title="سند نقدی", content=Markup(html), prefix=URL_PREFIX)
-
-# ===================== دریافت وجه =====================
-# ----------------- Unified Cash Doc (Receive & Payment) -----------------
-@app.route(URL_PREFIX + "/cash_doc", methods=["GET", "POST"])
-@app.route(URL_PREFIX + "/receive", methods=["GET", "POST"])
-@app.route(URL_PREFIX + "/payment", methods=["GET", "POST"])
-@login_required
-def unified_cash():
-    # تشخیص نوع سند از مسیر یا پارامتر
-    kind = request.args.get("kind", "").strip().lower()
-    if not kind:
-        if "/receive" in request.path:
-            kind = "receive"
-        elif "/payment" in request.path:
-            kind = "payment"
-        else:
-            kind = "receive"  # پیش‌فرض
-    
-    # بررسی دسترسی
-    ensure_permission(kind)
-    
-    now_info = _now_info()
-    if kind == "receive":
-        doc_number = jalali_reference("RCV", now_info["datetime"])
-    else:
-        doc_number = jalali_reference("PAY", now_info["datetime"])
-    
-    pos_device_key, pos_device_label = _pos_device_config()
-    prefill_amount = None
-    prefill_note = None
-    prefill_person = None
-    
-    # فقط صندوق‌های فعال را بیاور
-    cashboxes = (
-        CashBox.query.filter_by(is_active=True)
-        .order_by(CashBox.kind.desc(), CashBox.name.asc())
-        .all()
-    )
-    
-    if request.method == "GET":
-        invoice_id = (request.args.get("invoice_id") or "").strip()
-        if invoice_id.isdigit():
-            inv = Invoice.query.get(int(invoice_id))
-            if inv:
-                prefill_amount = float(inv.total or 0.0)
-                if inv.person:
-                    prefill_person = inv.person
-                if kind == "receive":
-                    prefill_note = f"دریافت بابت فاکتور فروش {inv.number}"
-                else:
-                    prefill_note = f"پرداخت بابت فاکتور خرید {inv.number}"
-        if prefill_amount is None:
-            try:
-                prefill_amount = float((request.args.get("amount") or "").replace(",", ""))
-            except Exception:
-                prefill_amount = None
-        pid = (request.args.get("person_id") or "").strip()
-        if not prefill_person and pid.isdigit():
-            prefill_person = Entity.query.get(int(pid))
-
-    if request.method == "POST":
-        # kind از form data
-        form_kind = request.form.get("cash_kind", kind).strip().lower()
-        
-        number = (request.form.get("doc_number") or "").strip() or doc_number
-        doc_date = parse_gregorian_date(request.form.get("doc_date_greg"))
-
-        person = None
-        pid = (request.form.get("person_token") or "").strip()
-        if pid.isdigit():
-            person = Entity.query.get(int(pid))
-        if not person:
-            pcode = (request.form.get("person_code") or "").strip()
-            if pcode:
-                person = Entity.query.filter_by(type="person", code=pcode).first()
-        if not person or person.type != "person":
-            flash("لطفاً طرف حساب معتبر انتخاب کنید.", "danger")
-            return redirect(URL_PREFIX + f"/cash_doc?kind={form_kind}")
-
-        amount = _to_float(request.form.get("amount"), 0.0)
-        if amount <= 0:
-            flash("مبلغ باید بزرگ‌تر از صفر باشد.", "danger")
-            return redirect(URL_PREFIX + f"/cash_doc?kind={form_kind}")
-        
-        method = (request.form.get("method") or "").strip().lower()
-        if method not in ("pos", "cash", "bank", "cheque"):
-            method = "cash"
-        note = (request.form.get("note") or "").strip() or None
-
-        cashbox = None
-        cashbox_raw = (request.form.get("cashbox_id") or "").strip()
-        if cashbox_raw.isdigit():
-            cashbox = CashBox.query.get(int(cashbox_raw))
-            if cashbox and not cashbox.is_active:
-                cashbox = None
-
-        cheque_number = "".join(ch for ch in (request.form.get("cheque_number") or "") if ch.isdigit())
-        cheque_bank = (request.form.get("cheque_bank") or "").strip() or None
-        cheque_branch = (request.form.get("cheque_branch") or "").strip() or None
-        cheque_account = (request.form.get("cheque_account") or "").strip() or None
-        cheque_owner = (request.form.get("cheque_owner") or "").strip() or None
-        cheque_due_date = parse_gregorian_date(
-            request.form.get("cheque_due_date"), allow_none=True
-        )
-        if cheque_due_date is None:
-            cheque_due_date = parse_jalali_date(
-                request.form.get("cheque_due_date_fa"), allow_none=True
-            )
-
-        # فقط برای چک نیاز به صندوق داریم
-        if method == "cheque":
-            if not cashbox or cashbox.kind != "bank":
-                flash("برای ثبت چک، یک حساب بانکی فعال انتخاب کنید.", "danger")
-                return redirect(URL_PREFIX + f"/cash_doc?kind={form_kind}")
-            if len(cheque_number) != 16:
-                flash("شماره صیادی چک باید ۱۶ رقم باشد.", "danger")
-                return redirect(URL_PREFIX + f"/cash_doc?kind={form_kind}")
-        elif method in ("cash", "bank"):
-            # اگر صندوق انتخاب شده، نوعش را بررسی کن
-            if cashbox:
-                required_kind = "cash" if method == "cash" else "bank"
-                if cashbox.kind != required_kind:
-                    flash("نوع صندوق با روش پرداخت مطابقت ندارد.", "warning")
-        else:
-            # برای POS و سایر روش‌ها چک را پاک کن
-            cheque_number = None
-            cheque_bank = None
-            cheque_branch = None
-            cheque_account = None
-            cheque_owner = None
-            cheque_due_date = None
-
-        # اگر چک نیست، مقادیر چک را null کن
-        if method != "cheque":
-            cheque_number = None
-            cheque_bank = None
-            cheque_branch = None
-            cheque_account = None
-            cheque_owner = None
-            cheque_due_date = None
-
-        doc = CashDoc(
-            doc_type=form_kind,
-            number=number,
-            date=doc_date,
-            person_id=person.id,
-            amount=amount,
-            method=method,
-            note=note,
-            cashbox_id=cashbox.id if cashbox else None,
-            cheque_number=cheque_number or None,
-            cheque_bank=cheque_bank,
-            cheque_branch=cheque_branch,
-            cheque_account=cheque_account,
-            cheque_owner=cheque_owner,
-            cheque_due_date=cheque_due_date,
-        )
-        db.session.add(doc)
-
-        # بروزرسانی balance: دریافت کم می‌کند، پرداخت اضافه می‌کند
-        try:
-            if form_kind == "receive":
-                person.balance = float(person.balance or 0.0) - float(amount)
-            else:  # payment
-                person.balance = float(person.balance or 0.0) + float(amount)
-        except Exception:
-            pass
-
-        db.session.commit()
-        
-        action_label = "دریافت" if form_kind == "receive" else "پرداخت"
-        flash(
-            f"✅ {action_label} «{number}» برای «{person.name}» — {amount_to_toman_words(amount)}",
-            "success",
-        )
-        return redirect(URL_PREFIX + f"/cash/{doc.id}")
-
     return render_template(
-        "cash_doc.html",
-        doc_number=doc_number,
+        "cash_view.html",
+        title="سند نقدی",
+        doc=doc,
+        method_label=CASH_METHOD_LABELS.get(doc.method or '', doc.method or '—'),
         prefix=URL_PREFIX,
-        current_jdate=now_info["jalali_date"],
-        current_gdate=now_info["greg_date"],
-        pos_device_key=pos_device_key,
-        pos_device_label=pos_device_label,
-        prefill_amount=prefill_amount,
-        prefill_person=prefill_person,
-        prefill_note=prefill_note,
-        cashboxes=cashboxes,
-        cash_kind=kind,
     )
 
-# ----------------- Old Receive (removed, now using unified_cash) -----------------
-@app.route(URL_PREFIX + "/receive_old", methods=["GET", "POST"])
-@login_required
-def receive_old():
-    ensure_permission("receive")
-    now_info = _now_info()
-    rec_number = jalali_reference("RCV", now_info["datetime"])
-    pos_device_key, pos_device_label = _pos_device_config()
-    prefill_amount = None
-    prefill_note = None
-    prefill_person = None
-    cashboxes = (
-        CashBox.query.filter_by(is_active=True)
-        .order_by(CashBox.kind.desc(), CashBox.name.asc())
-        .all()
-    )
-    if request.method == "GET":
-        invoice_id = (request.args.get("invoice_id") or "").strip()
-        if invoice_id.isdigit():
-            inv = Invoice.query.get(int(invoice_id))
-            if inv:
-                prefill_amount = float(inv.total or 0.0)
-                if inv.person:
-                    prefill_person = inv.person
-                prefill_note = f"دریافت بابت فاکتور فروش {inv.number}"
-        if prefill_amount is None:
-            try:
-                prefill_amount = float((request.args.get("amount") or "").replace(",", ""))
-            except Exception:
-                prefill_amount = None
-        pid = (request.args.get("person_id") or "").strip()
-        if not prefill_person and pid.isdigit():
-            prefill_person = Entity.query.get(int(pid))
-
-    if request.method == "POST":
-        number = (request.form.get("rec_number") or "").strip() or rec_number
-        rec_date = parse_gregorian_date(request.form.get("rec_date_greg"))
-
-        person = None
-        pid = (request.form.get("person_token") or "").strip()
-        if pid.isdigit():
-            person = Entity.query.get(int(pid))
-        if not person:
-            pcode = (request.form.get("person_code") or "").strip()
-            if pcode:
-                person = Entity.query.filter_by(type="person", code=pcode).first()
-        if not person or person.type != "person":
-            flash("لطفاً طرف حساب معتبر انتخاب کنید.", "danger")
-            return redirect(URL_PREFIX + "/receive")
-
-        amount = _to_float(request.form.get("amount"), 0.0)
-        if amount <= 0:
-            flash("مبلغ نامعتبر است.", "danger")
-            return redirect(URL_PREFIX + "/receive")
-        method = (request.form.get("method") or "").strip().lower()
-        if method not in ("pos", "cash", "bank", "cheque"):
-            method = "cash"
-        note = (request.form.get("note") or "").strip() or None
-
-        cashbox = None
-        cashbox_raw = (request.form.get("cashbox_id") or "").strip()
-        if cashbox_raw.isdigit():
-            cashbox = CashBox.query.get(int(cashbox_raw))
-            if cashbox and not cashbox.is_active:
-                cashbox = None
-
-        cheque_number = "".join(ch for ch in (request.form.get("cheque_number") or "") if ch.isdigit())
-        cheque_bank = (request.form.get("cheque_bank") or "").strip() or None
-        cheque_branch = (request.form.get("cheque_branch") or "").strip() or None
-        cheque_account = (request.form.get("cheque_account") or "").strip() or None
-        cheque_owner = (request.form.get("cheque_owner") or "").strip() or None
-        cheque_due_date = parse_gregorian_date(
-            request.form.get("cheque_due_date"), allow_none=True
-        )
-        if cheque_due_date is None:
-            cheque_due_date = parse_jalali_date(
-                request.form.get("cheque_due_date_fa"), allow_none=True
-            )
-        if cheque_due_date is None:
-            cheque_due_date = parse_jalali_date(
-                request.form.get("cheque_due_date_fa"), allow_none=True
-            )
-
-        if method in ("cash", "bank"):
-            required_kind = "cash" if method == "cash" else "bank"
-            if not cashbox or cashbox.kind != required_kind:
-                flash("لطفاً صندوق/حساب متناسب با روش دریافت را انتخاب کنید.", "danger")
-                return redirect(URL_PREFIX + "/receive")
-        if method == "cheque":
-            if not cashbox or cashbox.kind != "bank":
-                flash("برای ثبت چک، یک حساب بانکی فعال انتخاب کنید.", "danger")
-                return redirect(URL_PREFIX + "/receive")
-            if len(cheque_number) != 16:
-                flash("شماره صیادی چک باید ۱۶ رقم باشد.", "danger")
-                return redirect(URL_PREFIX + "/receive")
-        else:
-            cheque_number = None
-            cheque_bank = None
-            cheque_branch = None
-            cheque_account = None
-            cheque_owner = None
-            cheque_due_date = None
-
-        doc = CashDoc(
-            doc_type="receive",
-            number=number,
-            date=rec_date,
-            person_id=person.id,
-            amount=amount,
-            method=method,
-            note=note,
-            cashbox_id=cashbox.id if cashbox else None,
-            cheque_number=cheque_number or None,
-            cheque_bank=cheque_bank,
-            cheque_branch=cheque_branch,
-            cheque_account=cheque_account,
-            cheque_owner=cheque_owner,
-            cheque_due_date=cheque_due_date,
-        )
-        db.session.add(doc)
-
-        try:
-            person.balance = float(person.balance or 0.0) - float(amount)
-        except Exception:
-            pass
+# ===================== دریافت / پرداخت وجه =====================
+_CASH_DOC_REF_PREFIXES = {"receive": "RCV", "payment": "PAY"}
+_CASH_DOC_LABELS = {"receive": "دریافت", "payment": "پرداخت"}
+_CASH_DOC_PREFILL_NOTES = {
+    "receive": "دریافت بابت فاکتور فروش {}",
+    "payment": "پرداخت بابت فاکتور خرید {}",
+}
 
-        db.session.commit()
-        flash(
-            f"✅ دریافت «{number}» برای «{person.name}» — {amount_to_toman_words(amount)}",
-            "success",
-        )
-        return redirect(URL_PREFIX + f"/cash/{doc.id}")
 
-    return render_template(
-        "receive.html",
-        rec_number=rec_number,
-        prefix=URL_PREFIX,
-        current_jdate=now_info["jalali_date"],
-        current_gdate=now_info["greg_date"],
-        pos_device_key=pos_device_key,
-        pos_device_label=pos_device_label,
-        prefill_amount=prefill_amount,
-        prefill_person=prefill_person,
-        prefill_note=prefill_note,
-        cashboxes=cashboxes,
-    )
-
-# ===================== ویرایش سند نقدی =====================
-@app.route(URL_PREFIX + "/cash/<int:doc_id>/edit", methods=["GET","POST"])
-@login_required
-def cash_edit(doc_id):
-    admin_required()
-    doc = CashDoc.query.get_or_404(doc_id)
-    if request.method == "POST":
-        try:
-            new_amount = _to_float(request.form.get("amount"), doc.amount)
-            if new_amount <= 0:
-                flash("مبلغ سند باید بزرگ‌تر از صفر باشد.", "danger")
-                return redirect(URL_PREFIX + f"/cash/{doc.id}/edit")
-            doc.amount = new_amount
-            doc.note = (request.form.get("note") or "").strip() or None
-            m = (request.form.get("method") or "").strip().lower()
-            if m in ("pos","cash","bank","cheque"): doc.method = m
-            db.session.commit()
-            flash("ویرایش شد.", "success")
-        except Exception as ex:
-            flash(f"خطا: {ex}", "danger")
-        return redirect(URL_PREFIX + f"/cash/{doc.id}")
-    edit_html = f"""
-    <form method="post">
-      <div class="card" style="padding:10px">
-        <label class="lbl">مبلغ</label>
-        <input class="inp" name="amount" value="{int(doc.amount)}">
-        <label class="lbl" style="margin-top:8px">روش</label>
-        <select class="inp" name="method">
-          <option value="pos" {'selected' if (doc.method or '').lower()=='pos' else ''}>دستگاه پوز</option>
-          <option value="cash" {'selected' if (doc.method or '').lower()=='cash' else ''}>نقدی</option>
-          <option value="bank" {'selected' if (doc.method or '').lower()=='bank' else ''}>بانک</option>
-          <option value="cheque" {'selected' if (doc.method or '').lower()=='cheque' else ''}>چک</option>
-        </select>
-        <label class="lbl" style="margin-top:8px">یادداشت</label>
-        <textarea class="inp" name="note">{doc.note or ''}</textarea>
-        <div style="margin-top:10px"><button class="btn">ذخیره</button></div>
-      </div>
-    </form>
+def _handle_cash_doc(
+    kind: str,
+    *,
+    template_name: str,
+    number_field: str,
+    date_field: str,
+    redirect_url: str,
+    strict_cashbox: bool,
+    kind_field: Optional[str] = None,
+):
+    """GET/POST body shared by the receive/payment views.
+
+    ``number_field``/``date_field`` name the form inputs of ``template_name``;
+    ``redirect_url`` is formatted with the posted ``kind``. ``strict_cashbox``
+    rejects cash/bank documents without a matching cashbox instead of warning.
     """
-    return render_template("page.html", title="ویرایش سند دریافت/پرداخت", content=Markup(edit_html), prefix=URL_PREFIX)
+    ensure_permission(kind)
 
-# ===================== پرداخت =====================
-@app.route(URL_PREFIX + "/payment", methods=["GET", "POST"])
-@login_required
-def payment():
-    ensure_permission("payment")
     now_info = _now_info()
-    pay_number = jalali_reference("PAY", now_info["datetime"])
-    pos_device_key, pos_device_label = _pos_device_config()
-    prefill_amount = None
-    prefill_note = None
-    prefill_person = None
-    cashboxes = (
-        CashBox.query.filter_by(is_active=True)
-        .order_by(CashBox.kind.desc(), CashBox.name.asc())
-        .all()
-    )
-    if request.method == "GET":
-        invoice_id = (request.args.get("invoice_id") or "").strip()
-        if invoice_id.isdigit():
-            inv = Invoice.query.get(int(invoice_id))
-            if inv:
-                prefill_amount = float(inv.total or 0.0)
-                if inv.person:
-                    prefill_person = inv.person
-                prefill_note = f"پرداخت بابت فاکتور خرید {inv.number}"
-        if prefill_amount is None:
-            try:
-                prefill_amount = float((request.args.get("amount") or "").replace(",", ""))
-            except Exception:
-                prefill_amount = None
-        pid = (request.args.get("person_id") or "").strip()
-        if not prefill_person and pid.isdigit():
-            prefill_person = Entity.query.get(int(pid))
+    doc_number = jalali_reference(_CASH_DOC_REF_PREFIXES[kind], now_info["datetime"])
 
     if request.method == "POST":
-        number = (request.form.get("pay_number") or "").strip() or pay_number
-        pay_date = parse_gregorian_date(request.form.get("pay_date_greg"))
+        form = request.form
+        if kind_field:
+            posted_kind = _form_str(form, kind_field).lower()
+            if posted_kind in _CASH_DOC_LABELS and posted_kind != kind:
+                ensure_permission(posted_kind)
+                kind = posted_kind
+        back = URL_PREFIX + redirect_url.format(kind=kind)
+        label = _CASH_DOC_LABELS[kind]
+
+        number = _form_str(form, number_field) or doc_number
+        doc_date = parse_gregorian_date(form.get(date_field))
 
         person = None
-        pid = (request.form.get("person_token") or "").strip()
+        pid = _form_str(form, "person_token")
         if pid.isdigit():
-            person = Entity.query.get(int(pid))
+            person = db.session.get(Entity, int(pid))
         if not person:
-            pcode = (request.form.get("person_code") or "").strip()
+            pcode = _form_str(form, "person_code")
             if pcode:
-                person = Entity.query.filter_by(type="person", code=pcode).first()
-
+                person = _entity_by_code("person", pcode)
         if not person or person.type != "person":
             flash("لطفاً طرف حساب معتبر انتخاب کنید.", "danger")
-            return redirect(URL_PREFIX + "/payment")
+            return redirect(back)
 
-        def _to_float(x, dv=0.0):
-            try:
-                return float(str(x).replace(",", "").strip() or dv)
-            except Exception:
-                return dv
-        amount = _to_float(request.form.get("amount"), 0.0)
+        amount = _to_float(form.get("amount"), 0.0)
         if amount <= 0:
-            flash("مبلغ پرداخت باید بزرگ‌تر از صفر باشد.", "danger")
-            return redirect(URL_PREFIX + "/payment")
+            flash("مبلغ باید بزرگ‌تر از صفر باشد.", "danger")
+            return redirect(back)
 
-        method = (request.form.get("method") or "").strip().lower() or None
-        note   = (request.form.get("note") or "").strip() or None
+        method = normalize_method(form.get("method"))
+        note = _form_str(form, "note") or None
 
         cashbox = None
-        cashbox_raw = (request.form.get("cashbox_id") or "").strip()
+        cashbox_raw = _form_str(form, "cashbox_id")
         if cashbox_raw.isdigit():
-            cashbox = CashBox.query.get(int(cashbox_raw))
+            cashbox = db.session.get(CashBox, int(cashbox_raw))
             if cashbox and not cashbox.is_active:
                 cashbox = None
 
-        cheque_number = "".join(ch for ch in (request.form.get("cheque_number") or "") if ch.isdigit())
-        cheque_bank = (request.form.get("cheque_bank") or "").strip() or None
-        cheque_branch = (request.form.get("cheque_branch") or "").strip() or None
-        cheque_account = (request.form.get("cheque_account") or "").strip() or None
-        cheque_owner = (request.form.get("cheque_owner") or "").strip() or None
-        cheque_due_date = parse_gregorian_date(
-            request.form.get("cheque_due_date"), allow_none=True
-        )
+        # فیلدهای چک فقط برای روش چک خوانده می‌شوند
+        cheque_number = cheque_bank = cheque_branch = cheque_account = cheque_owner = cheque_due_date = None
+        if method == "cheque":
+            cheque_number = clean_cheque_number(form.get("cheque_number"))
+            cheque_bank = _form_str(form, "cheque_bank") or None
+            cheque_branch = _form_str(form, "cheque_branch") or None
+            cheque_account = _form_str(form, "cheque_account") or None
+            cheque_owner = _form_str(form, "cheque_owner") or None
+            cheque_due_date = parse_gregorian_date(
+                form.get("cheque_due_date"), allow_none=True
+            )
+            if cheque_due_date is None:
+                cheque_due_date = parse_jalali_date(
+                    form.get("cheque_due_date_fa"), allow_none=True
+                )
 
-        if method in ("cash", "bank"):
-            required_kind = "cash" if method == "cash" else "bank"
-            if not cashbox or cashbox.kind != required_kind:
-                flash("لطفاً حساب متناسب با روش پرداخت را انتخاب کنید.", "danger")
-                return redirect(URL_PREFIX + "/payment")
         if method == "cheque":
             if not cashbox or cashbox.kind != "bank":
-                flash("برای صدور چک، حساب بانکی معتبر انتخاب کنید.", "danger")
-                return redirect(URL_PREFIX + "/payment")
+                flash("برای ثبت چک، یک حساب بانکی فعال انتخاب کنید.", "danger")
+                return redirect(back)
             if len(cheque_number) != 16:
                 flash("شماره صیادی چک باید ۱۶ رقم باشد.", "danger")
-                return redirect(URL_PREFIX + "/payment")
-        else:
-            cheque_number = None
-            cheque_bank = None
-            cheque_branch = None
-            cheque_account = None
-            cheque_owner = None
-            cheque_due_date = None
+                return redirect(back)
+        elif method in ("cash", "bank"):
+            required_kind = "cash" if method == "cash" else "bank"
+            if strict_cashbox:
+                if not cashbox or cashbox.kind != required_kind:
+                    flash(f"لطفاً صندوق/حساب متناسب با روش {label} را انتخاب کنید.", "danger")
+                    return redirect(back)
+            elif cashbox and cashbox.kind != required_kind:
+                flash("نوع صندوق با روش پرداخت مطابقت ندارد.", "warning")
 
         doc = CashDoc(
-            doc_type="payment",
+            doc_type=kind,
             number=number,
-            date=pay_date,
+            date=doc_date,
             person_id=person.id,
             amount=amount,
             method=method,
@@ -3071,21 +3310,40 @@ def payment():
         )
         db.session.add(doc)
 
-        try:
-            person.balance = float(person.balance or 0.0) + float(amount)
-        except Exception:
-            pass
+        # بروزرسانی balance: دریافت کم می‌کند، پرداخت اضافه می‌کند
+        _adjust_balance(person, -float(amount) if kind == "receive" else float(amount))
 
         db.session.commit()
         flash(
-            f"✅ پرداخت «{number}» برای «{person.name}» — {amount_to_toman_words(amount)}",
+            f"✅ {label} «{number}» برای «{person.name}» — {amount_to_toman_words(amount)}",
             "success",
         )
         return redirect(URL_PREFIX + f"/cash/{doc.id}")
 
+    prefill_amount = None
+    prefill_note = None
+    prefill_person = None
+    invoice_id = (request.args.get("invoice_id") or "").strip()
+    if invoice_id.isdigit():
+        inv = _invoice_for_prefill(int(invoice_id))
+        if inv:
+            prefill_amount = float(inv.total or 0.0)
+            if inv.person:
+                prefill_person = inv.person
+            prefill_note = _CASH_DOC_PREFILL_NOTES[kind].format(inv.number)
+    if prefill_amount is None:
+        try:
+            prefill_amount = float((request.args.get("amount") or "").replace(",", ""))
+        except Exception:
+            prefill_amount = None
+    pid = (request.args.get("person_id") or "").strip()
+    if not prefill_person and pid.isdigit():
+        prefill_person = db.session.get(Entity, int(pid))
+
+    pos_device_key, pos_device_label = _pos_device_config()
     return render_template(
-        "payment.html",
-        pay_number=pay_number,
+        template_name,
+        **{number_field: doc_number},
         prefix=URL_PREFIX,
         current_jdate=now_info["jalali_date"],
         current_gdate=now_info["greg_date"],
@@ -3094,7 +3352,80 @@ def payment():
         prefill_amount=prefill_amount,
         prefill_person=prefill_person,
         prefill_note=prefill_note,
-        cashboxes=cashboxes,
+        # فقط صندوق‌های فعال
+        cashboxes=_active_cashboxes(),
+        cash_kind=kind,
+    )
+
+
+# ----------------- Unified Cash Doc (Receive & Payment) -----------------
+@app.route(URL_PREFIX + "/cash_doc", methods=["GET", "POST"])
+@app.route(URL_PREFIX + "/receive", methods=["GET", "POST"])
+@app.route(URL_PREFIX + "/payment", methods=["GET", "POST"])
+@login_required
+def unified_cash():
+    # تشخیص نوع سند از پارامتر یا مسیر
+    kind = request.args.get("kind", "").strip().lower()
+    if kind not in _CASH_DOC_LABELS:
+        kind = "payment" if "/payment" in request.path else "receive"
+    return _handle_cash_doc(
+        kind,
+        template_name="cash_doc.html",
+        number_field="doc_number",
+        date_field="doc_date_greg",
+        redirect_url="/cash_doc?kind={kind}",
+        strict_cashbox=False,
+        kind_field="cash_kind",
+    )
+
+# ----------------- Old Receive (removed, now using unified_cash) -----------------
+@app.route(URL_PREFIX + "/receive_old", methods=["GET", "POST"])
+@login_required
+def receive_old():
+    return _handle_cash_doc(
+        "receive",
+        template_name="receive.html",
+        number_field="rec_number",
+        date_field="rec_date_greg",
+        redirect_url="/receive",
+        strict_cashbox=True,
+    )
+
+# ===================== ویرایش سند نقدی =====================
+@app.route(URL_PREFIX + "/cash/<int:doc_id>/edit", methods=["GET","POST"])
+@login_required
+def cash_edit(doc_id):
+    admin_required()
+    doc = CashDoc.query.get_or_404(doc_id)
+    if request.method == "POST":
+        form = request.form
+        try:
+            new_amount = _to_float(form.get("amount"), doc.amount)
+            if new_amount <= 0:
+                flash("مبلغ سند باید بزرگ‌تر از صفر باشد.", "danger")
+                return redirect(URL_PREFIX + f"/cash/{doc.id}/edit")
+            doc.amount = new_amount
+            doc.note = _form_str(form, "note") or None
+            m = _form_str(form, "method").lower()
+            if m in _CASH_METHODS: doc.method = m
+            db.session.commit()
+            flash("ویرایش شد.", "success")
+        except Exception as ex:
+            flash(f"خطا: {ex}", "danger")
+        return redirect(URL_PREFIX + f"/cash/{doc.id}")
+    return render_template("cash_edit.html", title="ویرایش سند دریافت/پرداخت", doc=doc, prefix=URL_PREFIX)
+
+# ===================== پرداخت =====================
+@app.route(URL_PREFIX + "/payment", methods=["GET", "POST"])
+@login_required
+def payment():
+    return _handle_cash_doc(
+        "payment",
+        template_name="payment.html",
+        number_field="pay_number",
+        date_field="pay_date_greg",
+        redirect_url="/payment",
+        strict_cashbox=True,
     )
 
 # ----------------- Settings/Admin stubs -----------------
@@ -3112,7 +3443,7 @@ def settings_stub():
         form_id = (request.form.get("form_id") or "pos").strip().lower()
         if form_id == "pos":
             key = (request.form.get("pos_device") or "none").strip()
-            if key not in dict(POS_DEVICE_CHOICES):
+            if key not in POS_DEVICE_LABELS:
                 flash("دستگاه انتخاب‌شده نامعتبر است.", "danger")
                 return redirect(URL_PREFIX + "/settings")
             Setting.set("pos_device", key)
@@ -3125,35 +3456,30 @@ def settings_stub():
             allow_negative = request.form.get("allow_negative_sales") == "on"
             widget_keys = request.form.getlist("dashboard_widgets")
 
-            valid_themes = {k for k, _ in THEME_CHOICES}
-            if theme not in valid_themes:
+            if theme not in _THEME_VALID:
                 theme = _ui_theme_key()
 
-            valid_sorts = {k for k, _ in SEARCH_SORT_CHOICES}
-            if sort_key not in valid_sorts:
+            if sort_key not in _SORT_VALID:
                 sort_key = _search_sort_key()
 
-            valid_price = {k for k, _ in PRICE_DISPLAY_MODES}
-            if price_mode not in valid_price:
+            if price_mode not in _PRICE_VALID:
                 price_mode = _price_display_mode()
 
-            valid_widgets = {k for k, _ in DASHBOARD_WIDGET_CHOICES}
-            widgets_payload = [w for w in widget_keys if w in valid_widgets]
+            widgets_payload = [w for w in widget_keys if w in _DASH_VALID]
             if not widgets_payload:
-                widgets_payload = list(valid_widgets)
+                widgets_payload = list(_DASH_VALID)
 
             Setting.set("ui_theme", theme)
             Setting.set("search_sort", sort_key)
             Setting.set("price_display_mode", price_mode)
             Setting.set("allow_negative_sales", "on" if allow_negative else "off")
-            Setting.set("dashboard_widgets", json.dumps(widgets_payload, ensure_ascii=False))
+            Setting.set("dashboard_widgets", _json_dumps(widgets_payload))
             db.session.commit()
             flash("تنظیمات ظاهری و جستجو ذخیره شد.", "success")
         elif form_id == "ai":
             api_key = (request.form.get("openai_api_key") or "").strip()
             model = (request.form.get("openai_model") or _assistant_model()).strip()
-            valid_models = {k for k, _ in ASSISTANT_MODEL_CHOICES}
-            if model not in valid_models:
+            if model not in _MODEL_VALID:
                 model = _assistant_model()
             Setting.set("openai_api_key", api_key)
             Setting.set("openai_model", model)
@@ -3216,7 +3542,7 @@ def assistant_home():
         "assistant.html",
         prefix=URL_PREFIX,
         api_ready=api_ready,
-        assistant_model_label=dict(ASSISTANT_MODEL_CHOICES).get(_assistant_model(), _assistant_model()),
+        assistant_model_label=ASSISTANT_MODEL_LABELS.get(_assistant_model(), _assistant_model()),
     )
 
 @app.route(URL_PREFIX + "/assistant/api/chat", methods=["POST"])
@@ -3247,6 +3573,8 @@ def assistant_chat():
     applied_invoice_number = None
     apply_error = None
 
+    # فاکتور و سند نقدی پیشنهادی با یک commit ثبت می‌شوند
+    pending_outcomes: List[Dict[str, Any]] = []
     invoice_payload = result.get("invoice") if isinstance(result.get("invoice"), dict) else None
     if invoice_payload:
         plan = _prepare_invoice_plan(invoice_payload)
@@ -3258,10 +3586,9 @@ def assistant_chat():
 
         if not needs_confirmation:
             try:
-                outcome = _apply_invoice_plan(plan)
-                applied = True
+                outcome = _apply_invoice_plan(plan, commit=False)
+                pending_outcomes.append(outcome)
                 applied_invoice_number = outcome["invoice"].number
-                reply_text = (reply_text or "") + f"\nفاکتور «{applied_invoice_number}» با موفقیت ثبت شد."
             except Exception as exc:
                 db.session.rollback()
                 apply_error = str(exc)
@@ -3288,14 +3615,25 @@ def assistant_chat():
 
         if not needs_confirmation:
             try:
-                outcome_cash = _apply_cash_plan(cplan)
-                applied = True
+                outcome_cash = _apply_cash_plan(cplan, commit=False)
+                pending_outcomes.append(outcome_cash)
                 applied_cash_number = outcome_cash["doc"].number
-                reply_text = (reply_text or "") + f"\nسند نقدی «{applied_cash_number}» با موفقیت ثبت شد."
             except Exception as exc:
+                # rollback فاکتورِ در انتظار را هم برمی‌گرداند؛ فاکتور برای تأیید کاربر نگه داشته می‌شود
                 db.session.rollback()
                 apply_error = str(exc)
                 needs_confirmation = True
+                if pending_outcomes:
+                    pending_outcomes.clear()
+                    applied_invoice_number = None
+                    ticket = _register_ai_task(
+                        current_user.username,
+                        {
+                            "plan": invoice_preview,
+                            "reply": reply_text,
+                            "apply_error": apply_error,
+                        },
+                    )
 
         if needs_confirmation and not ticket:
             ticket = _register_ai_task(
@@ -3307,6 +3645,23 @@ def assistant_chat():
                 },
             )
 
+    if pending_outcomes:
+        try:
+            db.session.commit()
+        except Exception as exc:
+            db.session.rollback()
+            apply_error = str(exc)
+            needs_confirmation = True
+            applied_invoice_number = applied_cash_number = None
+        else:
+            applied = True
+            for outcome in pending_outcomes:
+                outcome["after_commit"]()
+            if applied_invoice_number:
+                reply_text = (reply_text or "") + f"\nفاکتور «{applied_invoice_number}» با موفقیت ثبت شد."
+            if applied_cash_number:
+                reply_text = (reply_text or "") + f"\nسند نقدی «{applied_cash_number}» با موفقیت ثبت شد."
+
     actions_summary = None
     actions_payload = result.get("actions") if isinstance(result.get("actions"), list) else []
     if actions_payload:
@@ -3916,31 +4271,28 @@ def admin_cashboxes():
                 flash("صندوق جدید ثبت شد.", "success")
         return redirect(URL_PREFIX + "/admin/cashboxes")
 
-    boxes = (
-        CashBox.query.order_by(CashBox.kind.desc(), CashBox.is_active.desc(), CashBox.name.asc())
-        .all()
-    )
-    totals_rows = (
+    # صندوق‌ها و جمع دریافت/پرداخت هرکدام در یک کوئری گروه‌بندی‌شده
+    rows = (
         db.session.query(
-            CashDoc.cashbox_id,
-            CashDoc.doc_type,
-            func.coalesce(func.sum(CashDoc.amount), 0.0),
+            CashBox,
+            func.coalesce(func.sum(case((CashDoc.doc_type == "receive", CashDoc.amount), else_=0.0)), 0.0),
+            func.coalesce(func.sum(case((CashDoc.doc_type == "payment", CashDoc.amount), else_=0.0)), 0.0),
         )
-        .filter(CashDoc.cashbox_id.isnot(None))
-        .group_by(CashDoc.cashbox_id, CashDoc.doc_type)
+        .outerjoin(CashDoc, CashDoc.cashbox_id == CashBox.id)
+        .group_by(CashBox.id)
+        .order_by(CashBox.kind.desc(), CashBox.is_active.desc(), CashBox.name.asc())
         .all()
     )
+    boxes = []
     totals_map = {}
-    for box_id, doc_type, total in totals_rows:
-        if box_id not in totals_map:
-            totals_map[box_id] = {"receive": 0.0, "payment": 0.0}
-        totals_map[box_id][doc_type] = float(total or 0.0)
     grand_net = 0.0
-    for box in boxes:
-        meta = totals_map.get(box.id, {"receive": 0.0, "payment": 0.0})
-        net = meta.get("receive", 0.0) - meta.get("payment", 0.0)
+    for box, receive_total, payment_total in rows:
+        receive_total = float(receive_total or 0.0)
+        payment_total = float(payment_total or 0.0)
+        boxes.append(box)
+        totals_map[box.id] = {"receive": receive_total, "payment": payment_total}
         if box.is_active:
-            grand_net += net
+            grand_net += receive_total - payment_total
     grand_net = float(grand_net)
     return render_template(
         "admin/cashboxes.html",
@@ -3951,18 +4303,16 @@ def admin_cashboxes():
     )
 
 
+def _cashbox_in_use(box_id: int) -> bool:
+    return bool(db.session.query(db.session.query(CashDoc.id).filter(CashDoc.cashbox_id == box_id).exists()).scalar())
+
+
 @app.route(URL_PREFIX + "/admin/cashboxes/<int:box_id>/delete", methods=["POST"])
 @login_required
 def admin_cashboxes_delete(box_id):
     admin_required()
     box = CashBox.query.get_or_404(box_id)
-    usage_exists = (
-        db.session.query(CashDoc.id)
-        .filter(CashDoc.cashbox_id == box.id)
-        .limit(1)
-        .first()
-    )
-    if usage_exists:
+    if _cashbox_in_use(box.id):
         box.is_active = False
         flash("به دلیل استفاده در اسناد، صندوق غیرفعال شد.", "warning")
     else:
@@ -3987,13 +4337,7 @@ def admin_cashboxes_remove_defaults():
     deactivated = 0
     for box in boxes:
         if (box.name or "").strip().lower() in DEFAULT_NAMES:
-            usage_exists = (
-                db.session.query(CashDoc.id)
-                .filter(CashDoc.cashbox_id == box.id)
-                .limit(1)
-                .first()
-            )
-            if usage_exists:
+            if _cashbox_in_use(box.id):
                 if box.is_active:
                     box.is_active = False
                     deactivated += 1
@@ -4024,6 +4368,239 @@ def api_num2words():
         return jsonify({"ok": False, "text": ""}), 400
 
 
+# رویدادهای ممیزی در یک نخ پس‌زمینه دسته‌ای درج می‌شوند تا درخواست منتظر commit نماند
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_SECONDS = 1.0
+_audit_queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=10000)
+_audit_thread: Optional[threading.Thread] = None
+_audit_thread_lock = threading.Lock()
+# رویدادهایی که به‌خاطر پر بودن صف کنار گذاشته شده‌اند
+_audit_dropped = 0
+
+
+def _write_audit_batch(batch: List[tuple]) -> None:
+    rows = [row for row, _ in batch]
+    with app.app_context():
+        try:
+            ids = db.session.execute(
+                insert(AuditEvent).returning(AuditEvent.id, sort_by_parameter_order=True), rows
+            ).scalars().all()
+            db.session.commit()
+        except Exception as exc:
+            db.session.rollback()
+            app.logger.exception(f"audit batch insert failed ({len(rows)} rows): {exc}")
+            return
+        for event_id, (row, payload) in zip(ids, batch):
+            try:
+                autosave_record(app, "AuditEvent", event_id, {
+                    "id": event_id,
+                    "context": row["context"],
+                    "action": row["action"],
+                    "payload": payload,
+                    "user": row["user"],
+                    "ip": row["ip_address"],
+                    "ts": row["created_at"].isoformat(timespec="seconds"),
+                })
+                app.logger.info(f"[audit] {row['context']}/{row['action']} by {row['user']} ({row['ip_address']})")
+            except Exception as exc:
+                app.logger.exception(f"audit autosave failed: {exc}")
+
+
+def _batch_writer_loop(q: "queue.Queue", batch_size: int, flush_seconds: float, write_batch) -> None:
+    """Drain ``q`` into batches of up to ``batch_size`` items or ``flush_seconds``; ``None`` stops."""
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + flush_seconds
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        write_batch(batch)
+        if stop:
+            return
+
+
+def _audit_writer_loop() -> None:
+    _batch_writer_loop(_audit_queue, AUDIT_BATCH_SIZE, AUDIT_FLUSH_SECONDS, _write_audit_batch)
+
+
+def _enqueue_audit_event(row: dict, payload: Any) -> None:
+    global _audit_thread, _audit_dropped
+    if _audit_thread is None or not _audit_thread.is_alive():
+        with _audit_thread_lock:
+            if _audit_thread is None or not _audit_thread.is_alive():
+                _audit_thread = threading.Thread(target=_audit_writer_loop, name="audit-writer", daemon=True)
+                _audit_thread.start()
+    try:
+        _audit_queue.put_nowait((row, payload))
+    except queue.Full:
+        # مثل آمار بازدید، نخ درخواست منتظر پایگاه داده نمی‌ماند؛ رویداد کنار گذاشته و شمرده می‌شود
+        _audit_dropped += 1
+        if _audit_dropped == 1 or _audit_dropped % 100 == 0:
+            app.logger.warning(
+                f"audit queue full; dropped {row['context']}/{row['action']} ({_audit_dropped} dropped so far)"
+            )
+
+
+def _stop_audit_writer(timeout: float = 5.0) -> None:
+    """Flush queued audit events and stop the writer thread."""
+    if _audit_thread is not None and _audit_thread.is_alive():
+        _audit_queue.put(None)
+        _audit_thread.join(timeout=timeout)
+
+
+atexit.register(_stop_audit_writer)
+
+
+# بازدیدها (SiteView) در هر درخواست ثبت می‌شوند؛ نوشتن دسته‌ای با یک executemany و یک commit
+SITE_VIEW_BATCH_SIZE = 500
+SITE_VIEW_FLUSH_SECONDS = 0.5
+_site_view_queue: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=10000)
+_site_view_thread: Optional[threading.Thread] = None
+_site_view_thread_lock = threading.Lock()
+
+
+def _write_site_view_batch(batch: List[dict]) -> None:
+    with app.app_context():
+        try:
+            db.session.execute(insert(SiteView), batch)
+            db.session.commit()
+        except Exception as exc:
+            db.session.rollback()
+            app.logger.error(f"site view batch insert failed ({len(batch)} rows): {exc}")
+
+
+def _site_view_writer_loop() -> None:
+    _batch_writer_loop(_site_view_queue, SITE_VIEW_BATCH_SIZE, SITE_VIEW_FLUSH_SECONDS, _write_site_view_batch)
+
+
+def _enqueue_site_view(row: dict) -> None:
+    global _site_view_thread
+    if _site_view_thread is None or not _site_view_thread.is_alive():
+        with _site_view_thread_lock:
+            if _site_view_thread is None or not _site_view_thread.is_alive():
+                _site_view_thread = threading.Thread(target=_site_view_writer_loop, name="site-view-writer", daemon=True)
+                _site_view_thread.start()
+    try:
+        _site_view_queue.put_nowait(row)
+    except queue.Full:
+        # آمار بازدید است؛ زیر بار سنگین به‌جای نوشتن همگام کنار گذاشته می‌شود
+        pass
+
+
+def _stop_site_view_writer(timeout: float = 5.0) -> None:
+    """Flush queued site views and stop the writer thread."""
+    if _site_view_thread is not None and _site_view_thread.is_alive():
+        _site_view_queue.put(None)
+        _site_view_thread.join(timeout=timeout)
+
+
+atexit.register(_stop_site_view_writer)
+
+# ثبت‌های دفتر (ledger) هم دسته‌ای در نخ پس‌زمینه نوشته می‌شوند؛ هر دسته یک تراکنش و یک commit
+LEDGER_BATCH_SIZE = 200
+LEDGER_FLUSH_SECONDS = 0.25
+_ledger_queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=10000)
+_ledger_thread: Optional[threading.Thread] = None
+_ledger_thread_lock = threading.Lock()
+# زنجیرهٔ prev_hash فقط زیر این قفل ساخته و درج می‌شود (نخ نویسنده و نوشتن همگام)
+_ledger_chain_lock = threading.Lock()
+# چند پروسه (Gunicorn/Passenger) در دفتر می‌نویسند: آخرین hash در همان تراکنش نوشتن خوانده می‌شود، نه از کش پروسه
+_LEDGER_PG_LOCK_KEY = 0x4C454447  # "LEDG"
+_LEDGER_INSERT = insert(LedgerEntry)
+# payloadهای کوچک‌تر از این با فشرده‌سازی کوچک نمی‌شوند؛ compressor فقط زیر _ledger_chain_lock استفاده می‌شود
+LEDGER_COMPRESS_MIN_BYTES = 256
+_ledger_compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+
+
+def _insert_ledger_entries(batch: List[tuple]) -> List[str]:
+    """Chain ``batch`` onto the last stored hash and insert it in one transaction.
+
+    Rows go through a single Core executemany insert on a dedicated
+    connection, so ``db.session`` is never committed or rolled back here.
+    The tail hash is read once per batch inside the write transaction, which
+    on SQLite starts with BEGIN IMMEDIATE so writers in other processes
+    cannot interleave. Needs an app context. Returns the new hashes in order.
+    """
+    with _ledger_chain_lock, db.engine.begin() as conn:
+        # اتصال جدا از db.session: تراکنش (و کار commit‌نشدهٔ) فراخوان دست نمی‌خورد
+        if conn.dialect.name == "sqlite":
+            # قفل نوشتن از ابتدا؛ خواندن hash آخر بعداً به «database is locked» ارتقا نمی‌خورد
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        elif conn.dialect.name == "postgresql":
+            conn.execute(select(func.pg_advisory_xact_lock(_LEDGER_PG_LOCK_KEY)))
+        prev = conn.execute(
+            select(LedgerEntry.hash).order_by(LedgerEntry.id.desc()).limit(1)
+        ).scalar()
+        rows = []
+        for object_type, object_id, action, payload_text, created_at in batch:
+            h = _compute_entry_hash(prev, payload_text, created_at.isoformat())
+            payload_z = None
+            if _ledger_compressor is not None and payload_text and len(payload_text) >= LEDGER_COMPRESS_MIN_BYTES:
+                payload_z = _ledger_compressor.compress(payload_text.encode("utf-8"))
+            rows.append({
+                "created_at": created_at,
+                "object_type": object_type,
+                "object_id": object_id,
+                "action": action,
+                "payload": None if payload_z is not None else payload_text,
+                "payload_z": payload_z,
+                "prev_hash": prev,
+                "hash": h,
+            })
+            prev = h
+        conn.execute(_LEDGER_INSERT, rows)
+    return [row["hash"] for row in rows]
+
+
+def _write_ledger_batch(batch: List[tuple]) -> None:
+    with app.app_context():
+        try:
+            _insert_ledger_entries(batch)
+        except Exception as exc:
+            app.logger.exception(f"ledger batch insert failed ({len(batch)} rows): {exc}")
+
+
+def _ledger_writer_loop() -> None:
+    _batch_writer_loop(_ledger_queue, LEDGER_BATCH_SIZE, LEDGER_FLUSH_SECONDS, _write_ledger_batch)
+
+
+def _enqueue_ledger_entry(item: tuple) -> None:
+    global _ledger_thread
+    if _ledger_thread is None or not _ledger_thread.is_alive():
+        with _ledger_thread_lock:
+            if _ledger_thread is None or not _ledger_thread.is_alive():
+                _ledger_thread = threading.Thread(target=_ledger_writer_loop, name="ledger-writer", daemon=True)
+                _ledger_thread.start()
+    try:
+        _ledger_queue.put_nowait(item)
+    except queue.Full:
+        # صف پر است؛ همین ثبت را مستقیم می‌نویسیم تا گم نشود
+        _insert_ledger_entries([item])
+
+
+def _stop_ledger_writer(timeout: float = 5.0) -> None:
+    """Flush queued ledger entries and stop the writer thread."""
+    if _ledger_thread is not None and _ledger_thread.is_alive():
+        _ledger_queue.put(None)
+        _ledger_thread.join(timeout=timeout)
+
+
+atexit.register(_stop_ledger_writer)
+
+
 @app.route(URL_PREFIX + "/api/audit/log", methods=["POST"])
 @login_required
 def api_audit_log():
@@ -4034,32 +4611,15 @@ def api_audit_log():
     ip = request.headers.get("X-Forwarded-For", request.remote_addr or "")
     username = getattr(current_user, "username", None)
 
-    event = AuditEvent(
-        user=username,
-        ip_address=ip,
-        context=context or "general",
-        action=action or "unknown",
-        payload=json.dumps(payload, ensure_ascii=False, default=str) if payload is not None else None,
-    )
-
-    db.session.add(event)
-    db.session.commit()
-
-    event_payload = {
-        "id": event.id,
-        "context": context,
-        "action": action,
-        "payload": payload,
+    row = {
+        "created_at": datetime.now(),
         "user": username,
-        "ip": ip,
-        "ts": datetime.now().isoformat(timespec="seconds"),
+        "ip_address": ip,
+        "context": context or "general",
+        "action": action or "unknown",
+        "payload": _json_dumps(payload) if payload is not None else None,
     }
-
-    try:
-        autosave_record(current_app, "AuditEvent", event.id, event_payload)
-        current_app.logger.info(f"[audit] {context}/{action} by {username} ({ip})")
-    except Exception as exc:
-        current_app.logger.exception(f"audit autosave failed: {exc}")
+    _enqueue_audit_event(row, payload)
 
     return jsonify({"ok": True})
 
@@ -4125,322 +4685,532 @@ def api_bank_detect():
 
 
 # ----------------- Search API -----------------
+@lru_cache(maxsize=2048)
+def _fa_number_str(f: float) -> str:
+    if abs(f - int(f)) < 1e-6:
+        return fa_digits(f"{int(f):,}")
+    return fa_digits(f"{f:,.2f}".rstrip("0").rstrip("."))
+
+_SEARCH_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+def _search_number(val: str) -> Optional[float]:
+    """Numeric value of a search query, or None; non-numbers skip float() entirely."""
+    txt = val.replace(",", "").strip()
+    return float(txt) if _SEARCH_NUM_RE.fullmatch(txt) else None
+
+@lru_cache(maxsize=4096)
+def _fmt_search_jalali(val) -> str:
+    """Persian-digit Jalali date, or "—"; memoised per distinct date."""
+    try:
+        return fa_digits(to_jdate_str(val)) if val else "—"
+    except Exception:
+        return "—"
+
+def _fmt_search_number(val) -> str:
+    """Persian-digit, thousands-separated number; memoised on the float value."""
+    try:
+        return _fa_number_str(float(val))
+    except Exception:
+        return str(val)
+
+# نسخه با رویدادهای mapper و _invalidate_read_caches (نوشتن‌های Core) بالا می‌رود؛ کش در هر پروسه جداست
+# و پروسه‌های دیگر حداکثر SEARCH_CACHE_SECONDS نتیجهٔ کهنه برمی‌گردانند
+SEARCH_CACHE_SECONDS = 3
+_search_cache_version = 0
+
+_SEARCH_TARGET_ORDER = ("item", "person", "invoice", "receive", "payment")
+_SEARCH_ALL_TARGETS = frozenset(_SEARCH_TARGET_ORDER)
+_SEARCH_CASH_TARGETS = frozenset(("receive", "payment"))
+_SEARCH_CHEQUE_KINDS = frozenset(("cheque", "check", "chak", "cek"))
+_SEARCH_ALIASES = {
+    "item": frozenset(("item",)),
+    "items": frozenset(("item",)),
+    "product": frozenset(("item",)),
+    "person": frozenset(("person",)),
+    "people": frozenset(("person",)),
+    "customer": frozenset(("person",)),
+    "vendor": frozenset(("person",)),
+    "invoice": frozenset(("invoice",)),
+    "invoices": frozenset(("invoice",)),
+    "sale": frozenset(("invoice",)),
+    "sales": frozenset(("invoice",)),
+    "factor": frozenset(("invoice",)),
+    "receive": frozenset(("receive",)),
+    "receipt": frozenset(("receive",)),
+    "payment": frozenset(("payment",)),
+    "payments": frozenset(("payment",)),
+    "cash": _SEARCH_CASH_TARGETS,
+    "cashdoc": _SEARCH_CASH_TARGETS,
+    "all": _SEARCH_ALL_TARGETS,
+    "any": _SEARCH_ALL_TARGETS,
+}
+_SEARCH_ALIASES.update(dict.fromkeys(_SEARCH_CHEQUE_KINDS, _SEARCH_CASH_TARGETS))
+# ترتیب ثابت شاخه‌ها برای هر مجموعهٔ هدف، یک‌بار ساخته می‌شود
+_SEARCH_ORDERED_TARGETS = {
+    targets: tuple(t for t in _SEARCH_TARGET_ORDER if t in targets)
+    for targets in set(_SEARCH_ALIASES.values())
+}
+
 @app.route(URL_PREFIX + "/api/search", methods=["GET"])
 @login_required
 def api_search():
     q_raw = (request.args.get("q") or "").strip()
     kind = (request.args.get("kind") or "").strip().lower()
+    # بدون عبارت جستجو فقط وقتی نوع صریحاً خواسته شده فهرست برمی‌گردد (مثلاً kind=item برای پیش‌بارگذاری)
+    if not q_raw and not kind:
+        return jsonify([])
     sort_key = (request.args.get("sort") or _search_sort_key()).strip().lower()
-    valid_sort_keys = {k for k, _ in SEARCH_SORT_CHOICES}
-    if sort_key not in valid_sort_keys:
+    if sort_key not in _SORT_VALID:
         sort_key = _search_sort_key()
     price_mode = _price_display_mode()
 
-    try:
-        limit = int(request.args.get("limit", 10))
-    except Exception:
-        limit = 10
+    limit_raw = (request.args.get("limit") or "").strip()
+    limit = int(limit_raw) if limit_raw.isdecimal() else 10
     limit = max(1, min(limit, 50))
 
-    def try_float(val):
-        try:
-            txt = str(val).replace(",", "").strip()
-            if not txt:
-                return None
-            return float(txt)
-        except Exception:
-            return None
-
-    def fmt_number(val):
-        try:
-            f = float(val)
-            if abs(f - int(f)) < 1e-6:
-                return fa_digits(f"{int(f):,}")
-            return fa_digits(f"{f:,.2f}".rstrip("0").rstrip("."))
-        except Exception:
-            return str(val)
+    # پاسخ به کاربر وابسته نیست؛ درخواست‌های تکراری تایپ در یک بازهٔ کوتاه از حافظه خوانده می‌شوند
+    body = _search_results_cached(
+        q_raw, kind, sort_key, limit, price_mode,
+        _search_cache_version, int(time.time() // SEARCH_CACHE_SECONDS),
+    )
+    return app.response_class(body, mimetype="application/json")
 
-    def fmt_jalali(val):
-        try:
-            return fa_digits(to_jdate_str(val)) if val else "—"
-        except Exception:
-            return "—"
 
-    q_number = try_float(q_raw)
+@lru_cache(maxsize=1024)
+def _search_results_cached(
+    q_raw: str, kind: str, sort_key: str, limit: int, price_mode: str, version: int, bucket: int
+) -> str:
+    """JSON text of the search results; serialised once per cache entry."""
+    q_number = _search_number(q_raw)
     term = f"%{q_raw}%" if q_raw else None
 
-    alias_map = {
-        "item": {"item"},
-        "items": {"item"},
-        "product": {"item"},
-        "person": {"person"},
-        "people": {"person"},
-        "customer": {"person"},
-        "vendor": {"person"},
-        "invoice": {"invoice"},
-        "invoices": {"invoice"},
-        "sale": {"invoice"},
-        "sales": {"invoice"},
-        "factor": {"invoice"},
-        "receive": {"receive"},
-        "receipt": {"receive"},
-        "payment": {"payment"},
-        "payments": {"payment"},
-        "cash": {"receive", "payment"},
-        "cashdoc": {"receive", "payment"},
-        "all": {"item", "person", "invoice", "receive", "payment"},
-        "any": {"item", "person", "invoice", "receive", "payment"},
-    }
-
-    default_targets = {"item", "person", "invoice", "receive", "payment"}
-    targets = alias_map.get(kind, default_targets if not kind else {kind})
-    cheque_only = kind in {"cheque", "check", "chak", "cek"}
-    if cheque_only:
-        targets = {"receive", "payment"}
-    # اگر مقدار ناشناس بود، به صورت عمومی جستجو کن
-    if not targets.intersection(default_targets):
-        targets = default_targets
-
-    ordered_targets = [t for t in ["item", "person", "invoice", "receive", "payment"] if t in targets]
-
-    results = []
+    cheque_only = kind in _SEARCH_CHEQUE_KINDS
+    # نوع ناشناس یا خالی = جستجوی عمومی
+    targets = _SEARCH_ALIASES.get(kind, _SEARCH_ALL_TARGETS)
+    ordered_targets = _SEARCH_ORDERED_TARGETS[targets]
 
-    def limit_left() -> int:
-        return max(0, limit - len(results))
+    # هر شاخه با ORDER BY/LIMIT خودش در یک UNION ALL می‌آید؛ یک رفت‌وبرگشت به پایگاه داده.
+    # ترتیب هر شاخه (برچسب ستون، نزولی؟) است تا همان ترتیب در پایتون هم روی ردیف‌ها اعمال شود
+    # مرتب‌سازی نام بدون حساسیت به حروف؛ روی entities از ix_entity_type_lower_name پیمایش می‌شود
+    name_key = func.lower(Entity.name).label("name_key")
+    no_date = literal(None, CashDoc.date.type)
+    no_text = literal(None, CashDoc.cheque_number.type)
+    no_ts = literal(None, Entity.updated_at.type)
+    branches = []
 
-    item_rows = []
     if "item" in ordered_targets:
-        remaining = limit_left()
-        if remaining:
-            query = db.session.query(Entity).filter(Entity.type == "item")
-            if term:
-                query = query.filter(
-                    or_(
-                        Entity.code.ilike(f"{q_raw}%"),
-                        Entity.name.ilike(term),
-                        Entity.serial_no.ilike(term),
-                    )
+        sel = select(
+            literal("item").label("kind"),
+            Entity.id.label("id"),
+            Entity.code.label("code"),
+            Entity.name.label("name"),
+            Entity.unit.label("unit"),
+            Entity.serial_no.label("serial_no"),
+            Entity.stock_qty.label("amount"),
+            no_date.label("date"),
+            no_text.label("cheque_number"),
+            no_date.label("cheque_due_date"),
+            no_text.label("cashbox"),
+            name_key,
+            Entity.updated_at.label("updated_at"),
+        ).where(Entity.type == "item")
+        if term:
+            sel = sel.where(
+                or_(
+                    _prefix_match(Entity.code, q_raw),
+                    Entity.name.ilike(term),
+                    Entity.serial_no.ilike(term),
                 )
-            if sort_key == "code":
-                query = query.order_by(Entity.code.asc())
-            elif sort_key == "name":
-                query = query.order_by(Entity.name.asc())
-            elif sort_key == "balance":
-                query = query.order_by(Entity.stock_qty.desc(), Entity.name.asc())
-            else:  # recent
-                query = query.order_by(Entity.updated_at.desc(), Entity.id.desc())
-
-            item_rows = query.limit(remaining).all()
-
-            price_map = {}
-            if item_rows:
-                item_ids = [it.id for it in item_rows]
-                if price_mode == "average":
-                    avg_rows = (
-                        db.session.query(InvoiceLine.item_id, func.avg(InvoiceLine.unit_price))
-                        .filter(InvoiceLine.item_id.in_(item_ids))
-                        .group_by(InvoiceLine.item_id)
-                        .all()
-                    )
-                    price_map = {iid: float(avg or 0.0) for iid, avg in avg_rows}
-                else:
-                    ph_rows = (
-                        db.session.query(PriceHistory)
-                        .filter(PriceHistory.item_id.in_(item_ids))
-                        .order_by(PriceHistory.item_id.asc(), PriceHistory.updated_at.desc())
-                        .all()
-                    )
-                    for ph in ph_rows:
-                        if ph.item_id not in price_map:
-                            price_map[ph.item_id] = float(ph.last_price or 0.0)
-
-            for e in item_rows:
-                meta_parts = []
-                if e.unit:
-                    meta_parts.append(e.unit)
-                if e.stock_qty is not None:
-                    meta_parts.append(f"موجودی: {fmt_number(e.stock_qty)}")
-                if e.serial_no:
-                    meta_parts.append(e.serial_no)
-                if price_map.get(e.id):
-                    price_label = "میانگین" if price_mode == "average" else "آخرین"
-                    meta_parts.append(f"{price_label} قیمت: {fmt_number(price_map[e.id])}")
-                results.append({
-                    "id": e.id,
-                    "type": "item",
-                    "code": e.code or "",
-                    "name": e.name or "",
-                    "stock": fmt_number(e.stock_qty) if e.stock_qty is not None else None,
-                    "price": fmt_number(price_map.get(e.id)) if price_map.get(e.id) is not None else None,
-                    "extra": e.unit or "",
-                    "meta": " • ".join(meta_parts) if meta_parts else "",
-                })
-                if limit_left() == 0:
-                    break
-
-    if "person" in ordered_targets and limit_left():
-        remaining = limit_left()
-        query = db.session.query(Entity).filter(Entity.type == "person")
+            )
+        if sort_key == "code":
+            order = (("code", False),)
+        elif sort_key == "name":
+            order = (("name_key", False),)
+        elif sort_key == "balance":
+            order = (("amount", True), ("name_key", False))
+        else:  # recent
+            order = (("updated_at", True), ("id", True))
+        branches.append((sel, order))
+
+    if "person" in ordered_targets:
+        sel = select(
+            literal("person").label("kind"),
+            Entity.id.label("id"),
+            Entity.code.label("code"),
+            Entity.name.label("name"),
+            Entity.unit.label("unit"),
+            no_text.label("serial_no"),
+            Entity.balance.label("amount"),
+            no_date.label("date"),
+            no_text.label("cheque_number"),
+            no_date.label("cheque_due_date"),
+            no_text.label("cashbox"),
+            name_key,
+            Entity.updated_at.label("updated_at"),
+        ).where(Entity.type == "person")
         if term:
-            query = query.filter(
+            sel = sel.where(
                 or_(
-                    Entity.code.ilike(f"{q_raw}%"),
+                    _prefix_match(Entity.code, q_raw),
                     Entity.name.ilike(term),
                     Entity.unit.ilike(term),
                 )
             )
         if sort_key == "name":
-            query = query.order_by(Entity.name.asc())
+            order = (("name_key", False),)
         elif sort_key == "code":
-            query = query.order_by(Entity.code.asc())
+            order = (("code", False),)
         elif sort_key == "balance":
-            query = query.order_by(Entity.balance.desc(), Entity.name.asc())
+            order = (("amount", True), ("name_key", False))
         else:
-            query = query.order_by(Entity.updated_at.desc(), Entity.id.desc())
-
-        rows = query.limit(remaining).all()
-        for e in rows:
-            meta_parts = []
-            if e.unit:
-                meta_parts.append(e.unit)
-            meta_parts.append(f"مانده: {fmt_number(e.balance or 0)}")
-            results.append({
-                "id": e.id,
-                "type": "person",
-                "code": e.code or "",
-                "name": e.name or "",
-                "balance": fmt_number(e.balance or 0.0),
-                "extra": e.unit or "",
-                "meta": " • ".join(meta_parts),
-            })
-            if limit_left() == 0:
-                break
-
-    if "invoice" in ordered_targets and limit_left():
-        remaining = limit_left()
-        query = db.session.query(Invoice)
+            order = (("updated_at", True), ("id", True))
+        branches.append((sel, order))
+
+    if "invoice" in ordered_targets:
+        sel = (
+            select(
+                literal("invoice").label("kind"),
+                Invoice.id.label("id"),
+                Invoice.number.label("code"),
+                Entity.name.label("name"),
+                no_text.label("unit"),
+                no_text.label("serial_no"),
+                Invoice.total.label("amount"),
+                Invoice.date.label("date"),
+                no_text.label("cheque_number"),
+                no_date.label("cheque_due_date"),
+                no_text.label("cashbox"),
+                name_key,
+                no_ts.label("updated_at"),
+            )
+            .select_from(Invoice)
+            .join(Entity, Invoice.person_id == Entity.id)
+        )
         conds = []
         if term:
             conds.append(Invoice.number.ilike(term))
-            conds.append(Invoice.person.has(Entity.name.ilike(term)))
+            conds.append(Entity.name.ilike(term))
         if q_number is not None:
             conds.append(Invoice.total == q_number)
         if conds:
-            query = query.filter(or_(*conds))
+            sel = sel.where(or_(*conds))
         if sort_key == "code":
-            query = query.order_by(Invoice.number.asc())
+            order = (("code", False),)
         elif sort_key == "name":
-            query = query.join(Entity, Invoice.person_id == Entity.id).order_by(Entity.name.asc())
+            order = (("name_key", False),)
         else:
-            query = query.order_by(Invoice.date.desc(), Invoice.number.desc())
-
-        rows = query.limit(remaining).all()
-        for inv in rows:
-            meta_parts = []
-            if inv.date:
-                meta_parts.append(fmt_jalali(inv.date))
-            if inv.total is not None:
-                meta_parts.append(f"مبلغ: {fmt_number(inv.total)}")
-            results.append({
-                "id": inv.id,
-                "type": "invoice",
-                "code": inv.number or "",
-                "name": (inv.person.name if inv.person else ""),
-                "amount": float(inv.total or 0.0),
-                "meta": " • ".join(meta_parts),
-            })
-            if limit_left() == 0:
-                break
-
-    if limit_left() and {"receive", "payment"}.intersection(ordered_targets):
-        remaining = limit_left()
-        query = db.session.query(CashDoc)
+            order = (("date", True), ("code", True))
+        branches.append((sel, order))
+
+    if _SEARCH_CASH_TARGETS.intersection(ordered_targets):
+        sel = (
+            select(
+                CashDoc.doc_type.label("kind"),
+                CashDoc.id.label("id"),
+                CashDoc.number.label("code"),
+                Entity.name.label("name"),
+                no_text.label("unit"),
+                no_text.label("serial_no"),
+                CashDoc.amount.label("amount"),
+                CashDoc.date.label("date"),
+                CashDoc.cheque_number.label("cheque_number"),
+                CashDoc.cheque_due_date.label("cheque_due_date"),
+                CashBox.name.label("cashbox"),
+                name_key,
+                no_ts.label("updated_at"),
+            )
+            .select_from(CashDoc)
+            .join(Entity, CashDoc.person_id == Entity.id)
+            .outerjoin(CashBox, CashDoc.cashbox_id == CashBox.id)
+        )
         conds = []
         if term:
             conds.append(CashDoc.number.ilike(term))
-            conds.append(CashDoc.person.has(Entity.name.ilike(term)))
-            conds.append(CashDoc.cheque_number.ilike(term))
+            conds.append(Entity.name.ilike(term))
+            # شمارهٔ چک با پیشوند جستجو می‌شود تا ایندکس cheque_number به‌کار رود
+            conds.append(_prefix_match(CashDoc.cheque_number, q_raw))
         if q_number is not None:
             conds.append(CashDoc.amount == q_number)
         if conds:
-            query = query.filter(or_(*conds))
-
-        # محدود کردن بر اساس doc_type
-        if targets == {"receive"}:
-            query = query.filter(CashDoc.doc_type == "receive")
-        elif targets == {"payment"}:
-            query = query.filter(CashDoc.doc_type == "payment")
-        elif "receive" in targets and "payment" not in targets:
-            query = query.filter(CashDoc.doc_type == "receive")
-        elif "payment" in targets and "receive" not in targets:
-            query = query.filter(CashDoc.doc_type == "payment")
+            sel = sel.where(or_(*conds))
+
+        # محدود کردن بر اساس doc_type داخل SQL تا LIMIT دقیق بماند
+        sel = sel.where(CashDoc.doc_type.in_([t for t in ordered_targets if t in _SEARCH_CASH_TARGETS]))
         if cheque_only:
-            query = query.filter(func.lower(func.coalesce(CashDoc.method, "")) == "cheque")
+            sel = sel.where(_CASHDOC_IS_CHEQUE)
 
         if sort_key == "code":
-            query = query.order_by(CashDoc.number.asc())
+            order = (("code", False),)
         elif sort_key == "name":
-            query = query.join(Entity, CashDoc.person_id == Entity.id).order_by(Entity.name.asc())
+            order = (("name_key", False),)
         elif sort_key == "balance":
-            query = query.order_by(CashDoc.amount.desc(), CashDoc.date.desc())
+            order = (("amount", True), ("date", True))
         else:
-            query = query.order_by(CashDoc.date.desc(), CashDoc.number.desc())
+            order = (("date", True), ("code", True))
+        branches.append((sel, order))
+
+    # LIMIT داخل هر شاخه می‌ماند (بدون تابع پنجره‌ای)؛ UNION ALL ترتیب را تضمین نمی‌کند،
+    # پس حداکثر limit ردیف هر شاخه در پایتون با همان کلیدها دوباره مرتب می‌شود
+    selects = []
+    for branch, (sel, order) in enumerate(branches):
+        cols = sel.selected_columns
+        limited = (
+            sel.add_columns(literal(branch).label("branch"))
+            .order_by(*(cols[label].desc() if desc else cols[label].asc() for label, desc in order))
+            .limit(limit)
+            .subquery()
+        )
+        selects.append(select(limited))
+    by_branch: List[list] = [[] for _ in branches]
+    if selects:
+        for row in db.session.execute(union_all(*selects) if len(selects) > 1 else selects[0]):
+            by_branch[row.branch].append(row)
+    rows = []
+    for branch_rows, (_, order) in zip(by_branch, branches):
+        # مرتب‌سازی پایدار از آخرین کلید به اولی؛ NULL مثل SQLite کوچک‌ترین مقدار است
+        for label, desc in reversed(order):
+            branch_rows.sort(key=lambda r: (r._mapping[label] is not None, r._mapping[label]), reverse=desc)
+        rows.extend(branch_rows)
 
-        rows = query.limit(remaining).all()
-        for doc in rows:
-            if doc.doc_type not in targets and len(targets) != len(default_targets):
-                continue
-            meta_parts = []
-            if doc.date:
-                meta_parts.append(fmt_jalali(doc.date))
-            meta_parts.append(f"مبلغ: {fmt_number(doc.amount)}")
-            if doc.cheque_number:
-                meta_parts.append(f"چک: {fa_digits(doc.cheque_number)}")
-            if doc.cheque_due_date:
-                meta_parts.append(f"سررسید: {fmt_jalali(doc.cheque_due_date)}")
-            if doc.cashbox:
-                meta_parts.append(f"صندوق: {doc.cashbox.name}")
+    results = []
+    remaining_total = limit
+
+    price_map = {}
+    item_ids = [r[1] for r in rows[:limit] if r[0] == "item"]
+    if item_ids:
+        if price_mode == "average":
+            avg_rows = db.session.execute(
+                select(InvoiceLine.item_id, func.avg(InvoiceLine.unit_price))
+                .where(InvoiceLine.item_id.in_(item_ids))
+                .group_by(InvoiceLine.item_id)
+            ).all()
+            price_map = {iid: float(avg or 0.0) for iid, avg in avg_rows}
+        else:
+            # فقط یک ردیف (جدیدترین) برای هر کالا از پایگاه داده برمی‌گردد
+            latest = (
+                select(
+                    PriceHistory.item_id.label("item_id"),
+                    PriceHistory.last_price.label("last_price"),
+                    func.row_number().over(
+                        partition_by=PriceHistory.item_id,
+                        order_by=(PriceHistory.updated_at.desc(), PriceHistory.id.desc()),
+                    ).label("rn"),
+                )
+                .where(PriceHistory.item_id.in_(item_ids))
+                .subquery()
+            )
+            ph_rows = db.session.execute(
+                select(latest.c.item_id, latest.c.last_price).where(latest.c.rn == 1)
+            ).all()
+            price_map = {iid: float(price or 0.0) for iid, price in ph_rows}
+
+    # ردیف‌ها تاپل‌های Core هستند؛ ستون‌ها به ترتیب projection باز می‌شوند
+    for kind_r, rid, code, name, unit, serial_no, amount, rdate, cheque_number, cheque_due, cashbox, *_ in rows:
+        meta_parts = []
+        if kind_r == "item":
+            if unit:
+                meta_parts.append(unit)
+            if amount is not None:
+                meta_parts.append(f"موجودی: {_fmt_search_number(amount)}")
+            if serial_no:
+                meta_parts.append(serial_no)
+            price = price_map.get(rid)
+            if price:
+                price_label = "میانگین" if price_mode == "average" else "آخرین"
+                meta_parts.append(f"{price_label} قیمت: {_fmt_search_number(price)}")
             results.append({
-                "id": doc.id,
-                "type": doc.doc_type,
-                "code": doc.number or "",
-                "name": (doc.person.name if doc.person else ""),
-                "amount": float(doc.amount or 0.0),
+                "id": rid,
+                "type": "item",
+                "code": code or "",
+                "name": name or "",
+                "stock": _fmt_search_number(amount) if amount is not None else None,
+                "price": _fmt_search_number(price) if price is not None else None,
+                "extra": unit or "",
+                "meta": " • ".join(meta_parts) if meta_parts else "",
+            })
+        elif kind_r == "person":
+            if unit:
+                meta_parts.append(unit)
+            meta_parts.append(f"مانده: {_fmt_search_number(amount or 0)}")
+            results.append({
+                "id": rid,
+                "type": "person",
+                "code": code or "",
+                "name": name or "",
+                "balance": _fmt_search_number(amount or 0.0),
+                "extra": unit or "",
                 "meta": " • ".join(meta_parts),
             })
-            if limit_left() == 0:
-                break
-
-    return jsonify(results[:limit])
+        elif kind_r == "invoice":
+            if rdate:
+                meta_parts.append(_fmt_search_jalali(rdate))
+            if amount is not None:
+                meta_parts.append(f"مبلغ: {_fmt_search_number(amount)}")
+            results.append({
+                "id": rid,
+                "type": "invoice",
+                "code": code or "",
+                "name": name or "",
+                "amount": float(amount or 0.0),
+                "meta": " • ".join(meta_parts),
+            })
+        else:
+            if rdate:
+                meta_parts.append(_fmt_search_jalali(rdate))
+            meta_parts.append(f"مبلغ: {_fmt_search_number(amount)}")
+            if cheque_number:
+                meta_parts.append(f"چک: {fa_digits(cheque_number)}")
+            if cheque_due:
+                meta_parts.append(f"سررسید: {_fmt_search_jalali(cheque_due)}")
+            if cashbox:
+                meta_parts.append(f"صندوق: {cashbox}")
+            results.append({
+                "id": rid,
+                "type": kind_r,
+                "code": code or "",
+                "name": name or "",
+                "amount": float(amount or 0.0),
+                "meta": " • ".join(meta_parts),
+            })
+        remaining_total -= 1
+        if remaining_total == 0:
+            break
+
+    return _json_dumps(results)
+
+
+@event.listens_for(Entity, "after_insert")
+@event.listens_for(Entity, "after_update")
+@event.listens_for(Entity, "after_delete")
+@event.listens_for(Invoice, "after_insert")
+@event.listens_for(Invoice, "after_update")
+@event.listens_for(Invoice, "after_delete")
+@event.listens_for(CashDoc, "after_insert")
+@event.listens_for(CashDoc, "after_update")
+@event.listens_for(CashDoc, "after_delete")
+@event.listens_for(PriceHistory, "after_insert")
+@event.listens_for(PriceHistory, "after_update")
+def _invalidate_search_cache(mapper, connection, target):
+    global _search_cache_version
+    _search_cache_version += 1
+
+
+def _invalidate_read_caches() -> None:
+    """Invalidate the read caches after a Core write; bulk inserts and ``update()`` skip the mapper events."""
+    global _search_cache_version, _cashbox_cache_version
+    _search_cache_version += 1
+    _PARENTS_CACHE.clear()
+    _cashbox_cache_version += 1
+    _chart_payload.cache_clear()
 
 # ----------------- DB init & run -----------------
-def _ensure_column_sqlite(table:str, col:str, coltype:str, default_val:str="0"):
+# (table, column, type, default) — ستون‌هایی که بعد از نسخهٔ اول به جدول‌ها اضافه شده‌اند
+_LATE_COLUMNS = (
+    ("entities", "stock_qty", "REAL", "0"),
+    ("entities", "balance", "REAL", "0"),
+    ("cash_docs", "cashbox_id", "INTEGER", "NULL"),
+    ("cash_docs", "cheque_number", "TEXT", "NULL"),
+    ("cash_docs", "cheque_bank", "TEXT", "NULL"),
+    ("cash_docs", "cheque_branch", "TEXT", "NULL"),
+    ("cash_docs", "cheque_account", "TEXT", "NULL"),
+    ("cash_docs", "cheque_owner", "TEXT", "NULL"),
+    ("cash_docs", "cheque_due_date", "TEXT", "NULL"),
+    # invoices.kind بدون پیش‌فرض 'sales' اضافه می‌شود تا فاکتورهای خرید موجود فروش
+    # علامت نخورند؛ مقدار درست را backfill پایین می‌نویسد
+    ("invoices", "kind", "TEXT", "NULL"),
+    ("ledger_entries", "payload_z", "BLOB", "NULL"),
+)
+
+def _ensure_columns_sqlite(specs):
+    """Add missing columns with one introspection per table and a single commit."""
+    from sqlalchemy import inspect as sa_inspect, text
     try:
-        from sqlalchemy import text
-        info = db.session.execute(text(f"PRAGMA table_info({table});")).fetchall()
-        cols = {row[1] for row in info}
-        if col not in cols:
+        insp = sa_inspect(db.engine)
+        existing = {}
+        for table, _, _, _ in specs:
+            if table not in existing:
+                existing[table] = {c["name"] for c in insp.get_columns(table)}
+    except Exception as ex:
+        app.logger.error(f"reading table columns failed: {ex}")
+        return
+    added = False
+    for table, col, coltype, default_val in specs:
+        if col in existing[table]:
+            continue
+        try:
             db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {col} {coltype} DEFAULT {default_val};"))
-            db.session.commit()
+            existing[table].add(col)
+            added = True
+        except Exception as ex:
+            app.logger.error(f"ALTER TABLE failed for {table}.{col}: {ex}")
+    if added:
+        db.session.commit()
+
+def _ensure_indexes_sqlite():
+    # create_all فقط برای جدول‌های جدید ایندکس می‌سازد؛ برای دیتابیس‌های موجود اینجا اضافه می‌شوند
+    try:
+        from sqlalchemy import text
+        existing = {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type='index'")).fetchall()}
     except Exception as ex:
-        app.logger.error(f"ALTER TABLE failed for {table}.{col}: {ex}")
+        app.logger.error(f"listing indexes failed: {ex}")
+        return
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=db.engine)
+            except Exception as ex:
+                app.logger.error(f"CREATE INDEX failed for {index.name}: {ex}")
+
+# جستجوی زیررشته‌ای (ilike '%q%') در api_search روی Postgres با ایندکس‌های trigram سرویس می‌شود؛
+# SQLite این الگو را با هیچ ایندکسی نمی‌تواند سرویس دهد، پس آنجا کاری انجام نمی‌شود
+_SEARCH_TRGM_INDEXES = (
+    ("ix_entities_name_trgm", "entities", "name"),
+    ("ix_entities_serial_no_trgm", "entities", "serial_no"),
+    ("ix_entities_unit_trgm", "entities", "unit"),
+    ("ix_invoices_number_trgm", "invoices", "number"),
+    ("ix_cash_docs_number_trgm", "cash_docs", "number"),
+    ("ix_cash_docs_cheque_number_trgm", "cash_docs", "cheque_number"),
+)
+# پیشوند کد (lower(code) LIKE 'q%') در locale غیر C فقط با text_pattern_ops از B-tree استفاده می‌کند
+_SEARCH_PATTERN_INDEXES = (
+    ("ix_entities_lower_code_pattern", "entities", "code"),
+    ("ix_cash_docs_lower_cheque_number_pattern", "cash_docs", "cheque_number"),
+)
+
+def _ensure_search_indexes_postgres():
+    if db.engine.dialect.name != "postgresql":
+        return
+    from sqlalchemy import text
+    # CREATE INDEX CONCURRENTLY داخل تراکنش مجاز نیست
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except Exception as ex:
+            app.logger.error(f"CREATE EXTENSION pg_trgm failed: {ex}")
+            return
+        for name, table, col in _SEARCH_TRGM_INDEXES:
+            try:
+                conn.execute(text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({col} gin_trgm_ops)"
+                ))
+            except Exception as ex:
+                app.logger.error(f"CREATE INDEX failed for {name}: {ex}")
+        for name, table, col in _SEARCH_PATTERN_INDEXES:
+            try:
+                conn.execute(text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} (lower({col}) text_pattern_ops)"
+                ))
+            except Exception as ex:
+                app.logger.error(f"CREATE INDEX failed for {name}: {ex}")
 
 with app.app_context():
     db.create_all()
-    _ensure_column_sqlite("entities", "stock_qty", "REAL", "0")
-    _ensure_column_sqlite("entities", "balance",   "REAL", "0")
-    _ensure_column_sqlite("cash_docs", "cashbox_id", "INTEGER", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_number", "TEXT", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_bank", "TEXT", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_branch", "TEXT", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_account", "TEXT", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_owner", "TEXT", "NULL")
-    _ensure_column_sqlite("cash_docs", "cheque_due_date", "TEXT", "NULL")
-    _ensure_column_sqlite("invoices", "kind", "TEXT", "'sales'")
-    # ensure invoices.kind column exists; do NOT force a 'sales' default that would
-    # incorrectly mark existing purchase invoices as sales. Use NULL as default so
-    # we can run a reliable backfill below.
-    _ensure_column_sqlite("invoices", "kind", "TEXT", "NULL")
+    _ensure_columns_sqlite(_LATE_COLUMNS)
+    # ایندکس‌ها بعد از ستون‌های اضافه‌شده ساخته می‌شوند (مثلاً cash_docs.cashbox_id)
+    _ensure_indexes_sqlite()
+    _ensure_search_indexes_postgres()
 
     # Backfill invoice.kind for all existing invoices using the number prefix
     # heuristic. Run unconditionally to correct any rows that may have been
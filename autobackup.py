@@ -1,8 +1,12 @@
 # autobackup.py
 # طوری طراحی شده که برای مدل‌های «سند» (مثل Sale, Purchase, Voucher و ...) JSON بکاپ بسازد.
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
 from flask import current_app
 from sqlalchemy import event
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session, object_session
 from utils.backup_utils import autosave_record
 
 # لیست مدل‌هایی که سند حسابداری محسوب می‌کنی:
@@ -19,23 +23,56 @@ def _obj_to_dict(obj):
         res[col.key] = getattr(obj, col.key)
     return res
 
+# نوشتن فایل gzip بیرون از flush/درخواست انجام می‌شود؛ یک worker ترتیب رکوردها را حفظ می‌کند
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autosave")
+# کارهای صف‌شده پیش از خروج پروسه نوشته می‌شوند
+atexit.register(_writer.shutdown, wait=True)
+
+# رکوردهای flush‌شده تا commit در session.info می‌مانند؛ rollback/close آن‌ها را دور می‌ریزد
+_PENDING_KEY = "autosave_pending"
+
+def _log_failure(app, label, future):
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error(f"autosave {label} failed: {exc}", exc_info=exc)
+
+def _submit(app, model_name, pk_value, payload, label):
+    future = _writer.submit(autosave_record, app, model_name, pk_value, payload)
+    future.add_done_callback(lambda f: _log_failure(app, label, f))
+
+def _queue_for_commit(model_name, target, default_pk, label):
+    # payload همین حالا گرفته می‌شود؛ بعد از commit ویژگی‌ها expire شده‌اند
+    payload = _obj_to_dict(target)
+    pending = object_session(target).info.setdefault(_PENDING_KEY, [])
+    pending.append((current_app._get_current_object(), model_name,
+                    payload.get("id") or payload.get("uuid") or default_pk, payload, label))
+
 def _attach_listeners(Model):
     @event.listens_for(Model, "after_insert")
     def _after_insert(mapper, connection, target):
         try:
-            payload = _obj_to_dict(target)
-            autosave_record(current_app, Model.__name__, payload.get("id") or payload.get("uuid") or "new", payload)
+            _queue_for_commit(Model.__name__, target, "new", "insert")
         except Exception as e:
             current_app.logger.exception(f"autosave insert failed: {e}")
 
     @event.listens_for(Model, "after_update")
     def _after_update(mapper, connection, target):
         try:
-            payload = _obj_to_dict(target)
-            autosave_record(current_app, Model.__name__, payload.get("id") or payload.get("uuid") or "upd", payload)
+            _queue_for_commit(Model.__name__, target, "upd", "update")
         except Exception as e:
             current_app.logger.exception(f"autosave update failed: {e}")
 
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    for item in session.info.pop(_PENDING_KEY, ()):
+        _submit(*item)
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session, transaction):
+    # after_commit پیش از این اجرا شده؛ هرچه مانده مال تراکنشی است که commit نشد
+    if transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
 def init_autobackup(app):
     with app.app_context():
         for m in TARGET_MODELS:
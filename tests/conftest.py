@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# app.py پایگاه‌داده را هنگام import در DATA_DIR می‌سازد؛ پیش از import به یک پوشهٔ موقت اشاره می‌کنیم
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="hesabpak-tests-")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def hesab():
+    import app as hesab_app
+    return hesab_app
+
+
+@pytest.fixture
+def ctx(hesab):
+    with hesab.app.test_request_context():
+        yield hesab
+        hesab.db.session.rollback()
+
+
+@pytest.fixture
+def person_and_item(ctx):
+    db = ctx.db
+    n = ctx.Entity.query.count()
+    person = ctx.Entity(type="person", code=f"{n + 1:03d}", name=f"طرف {n}")
+    item = ctx.Entity(type="item", code=f"{n + 2:03d}", name=f"کالا {n}", stock_qty=0.0)
+    db.session.add_all([person, item])
+    db.session.commit()
+    return person, item
@@ -0,0 +1,32 @@
+import sqlite3
+
+
+def _committed_codes(hesab):
+    # اتصال جداگانه فقط داده‌های commit‌شده را می‌بیند
+    with sqlite3.connect(str(hesab.DB_PATH)) as conn:
+        return {row[0] for row in conn.execute("SELECT code FROM entities")}
+
+
+def test_script_lines_commit_alone_and_roll_back_alone(ctx, monkeypatch):
+    seen_mid_script = {}
+
+    def boom(parts):
+        ctx.db.session.add(ctx.Entity(type="item", code="799", name="نیمه‌کاره", level=1))
+        ctx.db.session.flush()
+        raise RuntimeError("boom")
+
+    def peek(parts):
+        seen_mid_script["codes"] = _committed_codes(ctx)
+        return "ok"
+
+    monkeypatch.setattr(ctx, "ALLOWED_CMDS", ctx.ALLOWED_CMDS | {"BOOM", "PEEK"})
+    monkeypatch.setitem(ctx._SCRIPT_DISPATCH, "BOOM", boom)
+    monkeypatch.setitem(ctx._SCRIPT_DISPATCH, "PEEK", peek)
+
+    msgs = ctx._run_script_lines(["ADD_ITEM 701 الف", "BOOM", "PEEK", "ADD_ITEM 702 ب"])
+
+    assert any("boom" in m for m in msgs)
+    assert "701" in seen_mid_script["codes"]
+    codes = _committed_codes(ctx)
+    assert {"701", "702"} <= codes
+    assert "799" not in codes
@@ -0,0 +1,34 @@
+import pytest
+
+
+def _python_next_number(numbers):
+    # منطق قبلی unified_invoice، مرجع مقایسه
+    nums = []
+    for num in numbers:
+        s = (num or "").strip()
+        if s.isdigit():
+            try:
+                nums.append(int(s))
+            except ValueError:
+                pass
+    return str(max(nums) + 1) if nums else "1"
+
+
+@pytest.mark.parametrize("numbers", [
+    ["7", "12", "abc"],
+    ["۱۲۳", "45"],
+    ["\t99\n", "100x", " 98 "],
+    ["٤٢", "۴۱", "4۰"],
+    ["\xa0250", "²"],
+])
+def test_next_purchase_number_matches_python_rules(ctx, person_and_item, numbers):
+    person, _ = person_and_item
+    ctx.Invoice.query.filter(ctx.Invoice.kind == "purchase").delete()
+    for number in numbers:
+        ctx.db.session.add(ctx.Invoice(
+            number=number,
+            date=ctx.datetime.now().date(), person_id=person.id, kind="purchase", total=1.0,
+        ))
+    ctx.db.session.flush()
+    stored = [n for (n,) in ctx.db.session.query(ctx.Invoice.number).filter(ctx.Invoice.kind == "purchase")]
+    assert ctx._next_purchase_number() == _python_next_number(stored)
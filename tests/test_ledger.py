@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+_WRITER = textwrap.dedent("""
+    import sys
+    import app
+    tag = sys.argv[1]
+    with app.app.app_context():
+        for i in range(25):
+            app.record_ledger("test", f"{tag}{i}", "create", {"i": i, "tag": tag}, sync=True)
+""")
+
+
+def _assert_linear_chain(hesab):
+    rows = hesab.db.session.query(hesab.LedgerEntry).order_by(hesab.LedgerEntry.id).all()
+    prev = None
+    for row in rows:
+        assert row.prev_hash == prev
+        assert row.hash == hesab._compute_entry_hash(prev, row.payload_text, row.created_at.isoformat())
+        prev = row.hash
+    return rows
+
+
+def test_ledger_chain_stays_linear_across_processes(ctx):
+    before = ctx.LedgerEntry.query.count()
+    ctx.db.session.rollback()
+    env = dict(os.environ)
+    procs = [
+        subprocess.Popen([sys.executable, "-c", _WRITER, tag], cwd=str(REPO_ROOT), env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for tag in ("a", "b", "c")
+    ]
+    for proc in procs:
+        _, err = proc.communicate(timeout=120)
+        assert proc.returncode == 0, err.decode("utf-8", "replace")
+    rows = _assert_linear_chain(ctx)
+    assert len(rows) == before + 75
+
+
+def test_sync_ledger_write_leaves_session_transaction_alone(ctx):
+    ctx.db.session.rollback()
+    ctx.db.session.add(ctx.Entity(type="item", code="881", name="در انتظار", level=1))
+    entry = ctx.record_ledger("test", "pending", "create", {"pending": True}, sync=True)
+    assert entry is not None
+    ctx.db.session.rollback()
+    assert ctx.Entity.query.filter_by(code="881").count() == 0
+    assert ctx.LedgerEntry.query.filter_by(hash=entry.hash).count() == 1
@@ -0,0 +1,14 @@
+import json
+
+
+def _cached_balance(hesab, person):
+    body = hesab._search_results_cached(person.code, "person", "code", 10, "last", hesab._search_cache_version, 0)
+    return next(r["balance"] for r in json.loads(body) if r["id"] == person.id)
+
+
+def test_core_balance_update_invalidates_search_cache(ctx, person_and_item):
+    person, _ = person_and_item
+    before = _cached_balance(ctx, person)
+    ctx._adjust_balance(person, 2500.0)
+    ctx.db.session.commit()
+    assert _cached_balance(ctx, person) != before
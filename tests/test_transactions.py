@@ -0,0 +1,64 @@
+import pytest
+
+
+def _row_counts(hesab):
+    return (
+        hesab.Invoice.query.count(),
+        hesab.InvoiceLine.query.count(),
+        hesab.PriceHistory.query.count(),
+    )
+
+
+def test_zero_total_invoice_plan_leaves_no_rows(ctx, person_and_item):
+    person, item = person_and_item
+    before = _row_counts(ctx)
+    plan = {
+        "kind": "purchase",
+        "partner": {"entity_id": person.id},
+        "items": [{"entity_id": item.id, "qty": 2, "unit_price": 0}],
+    }
+    with pytest.raises(ValueError):
+        ctx._apply_invoice_plan(plan)
+    ctx.db.session.rollback()
+    assert _row_counts(ctx) == before
+    assert float(ctx.db.session.get(ctx.Entity, item.id).stock_qty or 0.0) == 0.0
+
+
+def _purchase_plan(person, item, unit_price):
+    return {
+        "kind": "purchase",
+        "partner": {"entity_id": person.id},
+        "items": [{"entity_id": item.id, "qty": 1, "unit_price": unit_price}],
+    }
+
+
+def test_uncommitted_invoice_plan_is_rolled_back(ctx, person_and_item):
+    person, item = person_and_item
+    before = _row_counts(ctx)
+    outcome = ctx._apply_invoice_plan(_purchase_plan(person, item, 1000), commit=False)
+    assert outcome["invoice"].id is not None
+    ctx.db.session.rollback()
+    assert _row_counts(ctx) == before
+
+
+def test_failing_invoice_in_assistant_batch_leaves_no_rows(ctx, person_and_item):
+    # همان ترتیب assistant_chat: فاکتور با commit=False، خطا، rollback کل تراکنش
+    person, item = person_and_item
+    before = _row_counts(ctx)
+    try:
+        ctx._apply_invoice_plan(_purchase_plan(person, item, 0), commit=False)
+    except ValueError:
+        ctx.db.session.rollback()
+    else:
+        pytest.fail("zero-total invoice plan must raise")
+    ctx.db.session.commit()
+    assert _row_counts(ctx) == before
+
+
+def test_duplicate_plan_number_is_regenerated(ctx, person_and_item):
+    person, item = person_and_item
+    first = ctx._apply_invoice_plan(_purchase_plan(person, item, 500))
+    plan = {**_purchase_plan(person, item, 700), "number": first["invoice"].number}
+    second = ctx._apply_invoice_plan(plan)
+    assert second["invoice"].number != first["invoice"].number
+    assert ctx.Invoice.query.filter_by(number=first["invoice"].number).count() == 1
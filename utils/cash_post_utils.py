@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Typed helpers for sanitising receive/payment form input.
+
+The module has no Flask or SQLAlchemy imports and is fully annotated.
+"""
+from __future__ import annotations
+
+import re
+from typing import Any, FrozenSet, Mapping, Optional
+
+CASH_METHODS: FrozenSet[str] = frozenset(("pos", "cash", "bank", "cheque"))
+
+_NON_DIGITS_RE = re.compile(r"\D+")
+
+
+def to_float(x: Any, default: float = 0.0) -> float:
+    """``float`` of a form/JSON value; thousands separators allowed, ``default`` on failure."""
+    if x is None:
+        return default
+    t = type(x)
+    if t is float:
+        return x
+    if t is int:
+        return float(x)
+    try:
+        s = x if t is str else str(x)
+        s = s.strip().replace(",", "")
+        if s == "":
+            return default
+        return float(s)
+    except (TypeError, ValueError):
+        return default
+
+
+def form_str(form: Mapping[str, Any], name: str) -> str:
+    """Stripped form value, or "" when the field is missing."""
+    value = form.get(name)
+    return value.strip() if value else ""
+
+
+def clean_cheque_number(raw: Optional[str]) -> str:
+    """Digits of a Sayad cheque number (spaces/dashes removed)."""
+    return _NON_DIGITS_RE.sub("", raw or "")
+
+
+def normalize_method(raw: Optional[str], default: str = "cash") -> str:
+    """Lower-cased cash method, or ``default`` when it is not one of ``CASH_METHODS``."""
+    method = (raw or "").strip().lower()
+    return method if method in CASH_METHODS else default
@@ -11,6 +11,7 @@ application.
 from __future__ import annotations
 
 from datetime import datetime, date
+from functools import lru_cache
 from typing import Dict, Optional, Tuple, Union
 
 # --- تبدیل میلادی به جلالی (بدون وابستگی خارجی) ---
@@ -193,6 +194,11 @@ def jalali_reference_core(dt: Optional[datetime] = None) -> str:
     """Return ``YYYYMMDD-HHMMSS`` using Jalali date parts from ``dt``."""
 
     dt = dt or now_greg_datetime()
+    return _reference_core_for_second(dt.replace(microsecond=0))
+
+
+@lru_cache(maxsize=256)
+def _reference_core_for_second(dt: datetime) -> str:
     jy, jm, jd = to_jdate_parts(dt)
     return f"{jy:04d}{jm:02d}{jd:02d}-{dt:%H%M%S}"
 
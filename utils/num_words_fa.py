@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
 from typing import Union
 
 NumberLike = Union[int, float, str, Decimal]
@@ -88,18 +89,28 @@ def _chunk_to_words(n: int) -> str:
     return " و ".join(parts)
 
 
-def number_to_persian_words(value: NumberLike) -> str:
-    """Convert a number to Persian words (supports up to the trillions)."""
+def _round_to_int(value: NumberLike) -> int:
+    if type(value) is int:
+        return value
     try:
         number = Decimal(str(value).replace(",", "")).quantize(Decimal("1"), rounding=ROUND_HALF_UP)
     except Exception:
         raise ValueError("value is not a valid number")
+    return int(number)
+
 
+def number_to_persian_words(value: NumberLike) -> str:
+    """Convert a number to Persian words (supports up to the trillions)."""
+    return _int_to_persian_words(_round_to_int(value))
+
+
+@lru_cache(maxsize=4096)
+def _int_to_persian_words(number: int) -> str:
     if number == 0:
         return _ONES[0]
 
     negative = number < 0
-    number = abs(int(number))
+    number = abs(number)
 
     words: list[str] = []
     group_index = 0
@@ -124,5 +135,9 @@ def number_to_persian_words(value: NumberLike) -> str:
 
 def amount_to_toman_words(value: NumberLike) -> str:
     """Return a sentence describing the amount in tomans."""
-    words = number_to_persian_words(value)
-    return f"{words} تومان"
+    return _toman_words(_round_to_int(value))
+
+
+@lru_cache(maxsize=4096)
+def _toman_words(amount: int) -> str:
+    return f"{_int_to_persian_words(amount)} تومان"